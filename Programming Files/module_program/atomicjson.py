@@ -0,0 +1,29 @@
+"""
+Atomic JSON files for state kept between restarts of rpmain.py (machine state, focus map and focus cache).
+"""
+import json
+import os
+
+
+def atomic_write_json(path, data, name="File"):
+    """
+    Replaces a JSON file atomically: the data is written to a temporary file, flushed to disk, then renamed over the old
+    file, so a crash or power cut leaves either the old or the new file, never a partly written one.
+    Parameters:
+        path: Location of the file
+        data: Object to save (must be JSON serialisable)
+        name: Name of the file contents used in the message printed if it cannot be written
+    Returns:
+        True if the file was written, False if it could not be (the error is printed)
+    """
+    tempPath = path + ".tmp"
+    try:
+        with open(tempPath, "w") as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tempPath, path)
+    except OSError as e:
+        print(f"{name} not saved: {e}")
+        return False
+    return True
@@ -0,0 +1,193 @@
+import threading
+import time
+
+FRAMETIMEOUT = 5.0 # s to wait for a frame before giving up
+CONFIRMEDCONTROLS = ("ExposureTime", "AnalogueGain") # controls reported in the frame metadata
+CONTROLTOLERANCE = 0.02 # relative difference allowed between a requested and reported control (the sensor rounds them)
+
+
+class CameraStream:
+    """
+    Keeps a Picamera2 camera streaming instead of starting and stopping it for every capture, and hands out frames
+    by exposure time. Starting the sensor (and letting exposure and gain settle) takes far longer than a frame, so this
+    is only paid once. Frames already queued by Picamera2 may have been exposed before the request (eg. while the stage
+    was still moving), so request_frame skips any frame whose exposure started before the requested time.
+    Picamera2 applies new controls a few frames after set_controls, so set_controls returns a token and frames are only
+    returned once the frame metadata shows the new exposure time and gain are active.
+    Attributes:
+        picam: Picamera2 object (or simulation.FakePicamera2)
+        clock: Provides monotonic_ns() on the same clock as the frame SensorTimestamp (the time module)
+        config: Camera configuration in use (None until reconfigure is called if it was not passed in)
+        running (bool): True while the camera is streaming
+        startCount (int): Number of times the camera has been started
+        framesSkipped (int): Frames discarded because they were exposed before the requested time
+        captureLock (threading.Lock): Thread lock for taking frames from the camera
+        controls (dict): Controls last sent to the camera
+        controlToken (int): Token of the last control change
+        confirmedToken (int): Token of the last control change confirmed by the frame metadata
+        confirmedAfter: Exposure start (ns) of the frame that confirmed it. Later frames use the new controls
+        controlFrames (int): Frames waited for the last control change to be confirmed
+        controlLock (threading.Lock): Thread lock for the control tokens
+    """
+    def __init__(self, picam, clock=time, config=None):
+        self.picam = picam
+        self.clock = clock
+        self.config = config
+        self.running = False
+        self.startCount = 0
+        self.framesSkipped = 0
+        self.captureLock = threading.Lock()
+        self.controls = {}
+        self.controlToken = 0
+        self.confirmedToken = 0
+        self.confirmedAfter = 0
+        self.controlFrames = 0
+        self._expected = {}
+        self._controlsSent = 0
+        self.controlLock = threading.Lock()
+
+    def start(self):
+        """Starts the camera streaming if it is not already running"""
+        with self.captureLock:
+            if not self.running:
+                self.picam.start()
+                self.running = True
+                self.startCount = self.startCount + 1
+
+    def stop(self):
+        """Stops the camera streaming (eg. before changing the camera configuration)"""
+        with self.captureLock:
+            if self.running:
+                self.picam.stop()
+                self.running = False
+
+    def reconfigure(self, config):
+        """
+        Switches the camera to another configuration, restarting the stream if it was running.
+        Picamera2 resets the controls when it is configured, so every control is sent again by the next set_controls.
+        If the camera rejects the configuration, the previous configuration is restored and the stream restarted
+        before the error is raised, so the camera keeps working.
+        Parameters:
+            config: Picamera2 camera configuration
+        """
+        with self.captureLock:
+            wasRunning = self.running
+            if self.running:
+                self.picam.stop()
+                self.running = False
+            try:
+                self.picam.configure(config)
+                self.config = config
+            except Exception:
+                if self.config is not None:
+                    self.picam.configure(self.config)
+                raise
+            finally:
+                with self.controlLock:
+                    self.controls = {}
+                if wasRunning:
+                    self.picam.start()
+                    self.running = True
+                    self.startCount = self.startCount + 1
+
+    def now(self):
+        """Returns the current time (ns) on the frame timestamp clock"""
+        return self.clock.monotonic_ns()
+
+    def set_controls(self, controls):
+        """
+        Sends the controls that differ from the ones already sent to the camera.
+        Parameters:
+            controls: Dictionary of Picamera2 controls
+        Returns:
+            Token to pass to wait_for_controls. Unchanged controls return the current token without sending anything
+        """
+        with self.controlLock:
+            changed = {name: value for name, value in controls.items() if self.controls.get(name) != value}
+            if not changed:
+                return self.controlToken
+            self.picam.set_controls(changed)
+            self.controls.update(changed)
+            self.controlToken = self.controlToken + 1
+            self._controlsSent = self.now()
+            self._expected = {name: self.controls[name] for name in CONFIRMEDCONTROLS if name in self.controls}
+            # Controls that do not appear in the metadata cannot be confirmed
+            if not any(name in changed for name in CONFIRMEDCONTROLS):
+                self.confirmedToken = self.controlToken
+            return self.controlToken
+
+    def _controls_match(self, metadata, expected):
+        """Returns True if the frame metadata shows the expected control values"""
+        for name, value in expected.items():
+            reported = metadata.get(name)
+            if reported is not None and abs(reported - value) > CONTROLTOLERANCE*abs(value):
+                return False
+        return True
+
+    def wait_for_controls(self, token=None, timeout=FRAMETIMEOUT):
+        """
+        Waits until the frame metadata shows the controls of a set_controls call are active.
+        Parameters:
+            token: Token returned by set_controls (the latest change if None)
+            timeout: Time (s) to wait. The controls are treated as active afterwards so captures do not keep waiting
+        Returns:
+            True if the controls were confirmed, False if the wait timed out
+        """
+        with self.controlLock:
+            token = self.controlToken if token is None else token
+            if token <= self.confirmedToken:
+                return True
+            expected, after = dict(self._expected), self._controlsSent
+        self.start()
+        deadline = self.now() + int(timeout*1e9)
+        frames = 0
+        with self.captureLock:
+            while True:
+                request = self.picam.capture_request()
+                try:
+                    metadata = request.get_metadata()
+                finally:
+                    request.release()
+                frames = frames + 1
+                timestamp = metadata.get("SensorTimestamp", after)
+                confirmed = timestamp >= after and self._controls_match(metadata, expected)
+                if confirmed or self.now() > deadline:
+                    break
+        with self.controlLock:
+            if token > self.confirmedToken:
+                self.confirmedToken, self.confirmedAfter, self.controlFrames = token, timestamp, frames
+        if not confirmed:
+            print(f"Camera controls {expected} not confirmed within {timeout} s")
+        return confirmed
+
+    def request_frame(self, after=None, stream="main", timeout=FRAMETIMEOUT):
+        """
+        Returns the first frame whose exposure started at or after a given time, and after any pending control change is active.
+        Parameters:
+            after: Time (ns, from now()) the exposure must start after. The time of the call is used if None
+            stream: Name of the stream to return ("main" or "lores")
+            timeout: Time (s) to wait for a suitable frame
+        Returns:
+            Tuple of (image array, frame metadata dictionary)
+        """
+        if after is None:
+            after = self.now()
+        if self.confirmedToken < self.controlToken:
+            self.wait_for_controls(timeout=timeout)
+        after = max(after, self.confirmedAfter)
+        self.start()
+        deadline = self.now() + int(timeout*1e9)
+
+        with self.captureLock:
+            while True:
+                request = self.picam.capture_request()
+                try:
+                    metadata = request.get_metadata()
+                    if metadata.get("SensorTimestamp", after) >= after:
+                        return request.make_array(stream), metadata
+                finally:
+                    request.release()
+
+                self.framesSkipped = self.framesSkipped + 1
+                if self.now() > deadline:
+                    raise TimeoutError(f"No frame exposed after {after} ns within {timeout} s")
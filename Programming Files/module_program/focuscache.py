@@ -0,0 +1,91 @@
+import json
+import threading
+from atomicjson import atomic_write_json
+
+DEFAULTWINDOW = 1.0 # mm either side of the predicted focus searched without any prediction history
+MINWINDOW = 0.1 # mm, smallest half width of the search window
+WINDOWMARGIN = 3 # half width as a multiple of the largest recent prediction error
+ERRORHISTORY = 5 # number of recent prediction errors used for the window
+
+
+class FocusCache:
+    """
+    Best focus height of every layer of every sample, kept in a JSON file so it survives restarts of rpmain.py.
+    The focus of the next layer is predicted from the last measured layer of the same sample moved by the material removed
+    in between. The error of each prediction is recorded, and the autofocus window shrinks as the predictions get more accurate.
+    Attributes:
+        path: Location of the focus cache file
+        samples (dict): {sampleID: {"layers": {layer: z in mm}, "errors": [recent prediction errors in mm]}}
+        saveLock (threading.Lock): Thread lock for updating and writing the cache
+    """
+    def __init__(self, path):
+        self.path = path
+        self.samples = {}
+        self.saveLock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the focus cache file.
+        Returns:
+            True if a focus cache was read
+        """
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+            # JSON keys are strings, layers are stored as ints
+            self.samples = {sampleID: {"layers": {int(layer): float(z) for layer, z in entry["layers"].items()},
+                                       "errors": [float(error) for error in entry["errors"]]}
+                            for sampleID, entry in data.items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Focus cache not loaded: {e}")
+            return False
+        return True
+
+    def save(self):
+        """Writes the focus cache file atomically"""
+        atomic_write_json(self.path, self.samples, "Focus cache")
+
+    def predict(self, sampleID, layer, mmPerLayer):
+        """
+        Predicts the focus height of a layer from the closest measured layer at or below it.
+        Parameters:
+            sampleID: Sample name
+            layer: Layer number (polishing steps completed)
+            mmPerLayer: Material removed at each polishing step (mm). The surface moves down, so the focus z increases
+        Returns:
+            Predicted focus z (mm), or None if no earlier layer of the sample was measured
+        """
+        with self.saveLock:
+            layers = self.samples.get(str(sampleID), {}).get("layers", {})
+            measured = [previous for previous in layers if previous <= layer]
+            if not measured:
+                return None
+            previous = max(measured)
+            return layers[previous] + mmPerLayer*(layer - previous)
+
+    def window(self, sampleID):
+        """
+        Returns the half width (mm) of the autofocus window around a prediction: a margin over the largest recent
+        prediction error, or DEFAULTWINDOW if no prediction has been checked yet
+        """
+        with self.saveLock:
+            errors = self.samples.get(str(sampleID), {}).get("errors", [])
+            if not errors:
+                return DEFAULTWINDOW
+            return min(DEFAULTWINDOW, max(MINWINDOW, WINDOWMARGIN*max(errors)))
+
+    def record(self, sampleID, layer, z, predicted=None):
+        """
+        Records the measured focus height of a layer and saves the cache.
+        Parameters:
+            sampleID: Sample name
+            layer: Layer number
+            z: Measured best focus (mm)
+            predicted: Focus predicted before the search (mm), used to track the prediction error
+        """
+        with self.saveLock:
+            entry = self.samples.setdefault(str(sampleID), {"layers": {}, "errors": []})
+            entry["layers"][int(layer)] = z
+            if predicted is not None:
+                entry["errors"] = (entry["errors"] + [abs(z - predicted)])[-ERRORHISTORY:]
+            self.save()
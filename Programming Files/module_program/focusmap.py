@@ -0,0 +1,147 @@
+import json
+import threading
+from atomicjson import atomic_write_json
+
+MODELS = ("plane", "bilinear")
+
+
+def _solve(matrix, vector):
+    """
+    Solves a small linear system by Gaussian elimination with partial pivoting.
+    Returns:
+        List of unknowns, or None if the system is singular (eg. all points on one line)
+    """
+    size = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, size):
+            factor = rows[r][col]/rows[col][col]
+            for c in range(col, size + 1):
+                rows[r][c] = rows[r][c] - factor*rows[col][c]
+    solution = [0.0]*size
+    for r in range(size - 1, -1, -1):
+        solution[r] = (rows[r][size] - sum(rows[r][c]*solution[c] for c in range(r + 1, size)))/rows[r][r]
+    return solution
+
+
+class FocusSurface:
+    """
+    Surface z(x, y) fitted by least squares to measured in-focus heights, used to set the focus height of each tile
+    on a stage that is not level.
+    The plane model is z = a + bx + cy, the bilinear model adds a twist term dxy (exact for four corner points).
+    With too few points for the model a simpler one is used (plane with three points, flat with one or two).
+    Attributes:
+        points (list): (x, y, z) in mm of the measured in-focus positions
+        model: "plane" or "bilinear" (the model actually fitted)
+        coefficients (list): a, b, c (and d for bilinear)
+    """
+    def __init__(self, points, model="plane"):
+        if model not in MODELS:
+            raise ValueError(f"Unknown focus surface model '{model}'")
+        self.points = [tuple(point) for point in points]
+        self.model = model
+        self.coefficients = [0.0, 0.0, 0.0]
+        self.fit()
+
+    def _terms(self, x, y):
+        return [1.0, x, y, x*y] if self.model == "bilinear" else [1.0, x, y]
+
+    def fit(self):
+        """Fits the model to the points by least squares (normal equations)"""
+        if not self.points:
+            return
+        if self.model == "bilinear" and len(self.points) < 4:
+            self.model = "plane"
+        coefficients = None
+        if len(self.points) >= 3:
+            terms = [self._terms(x, y) for x, y, z in self.points]
+            size = len(terms[0])
+            matrix = [[sum(row[i]*row[j] for row in terms) for j in range(size)] for i in range(size)]
+            vector = [sum(row[i]*point[2] for row, point in zip(terms, self.points)) for i in range(size)]
+            coefficients = _solve(matrix, vector)
+            if coefficients is None and self.model == "bilinear":
+                # Points in a shape the twist term cannot be fitted to (eg. three corners and the centre)
+                self.model = "plane"
+                return self.fit()
+        if coefficients is None:
+            # Not enough points for a tilt: flat surface at the mean height
+            self.model = "plane"
+            coefficients = [sum(point[2] for point in self.points)/len(self.points), 0.0, 0.0]
+        self.coefficients = coefficients
+
+    def z_at(self, x, y):
+        """Returns the fitted focus height (mm) at stage position (x, y) in mm"""
+        return sum(c*t for c, t in zip(self.coefficients, self._terms(x, y)))
+
+    def residuals(self):
+        """Returns the measured minus fitted height (mm) of each point"""
+        return [z - self.z_at(x, y) for x, y, z in self.points]
+
+    def to_dict(self):
+        """Returns the surface as a dictionary that can be sent as JSON"""
+        return {"model": self.model, "points": self.points, "coefficients": self.coefficients,
+                "max_residual": max([abs(r) for r in self.residuals()], default=0.0)}
+
+
+class FocusMap:
+    """
+    Focus surface of the bare stage, measured by OpticalModule.calibrate_platform and kept in a JSON file so it survives restarts.
+    The stage surface gives the tilt only. A scan focuses once on the sample and shifts the surface to pass through that
+    position (see surface_through), so the sample thickness does not matter.
+    Attributes:
+        path: Location of the focus map file
+        surface (FocusSurface): Fitted stage surface, None until calibrated
+        saveLock (threading.Lock): Thread lock for updating and writing the map
+    """
+    def __init__(self, path):
+        self.path = path
+        self.surface = None
+        self.saveLock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the focus map file.
+        Returns:
+            True if a focus map was read
+        """
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+            self.surface = FocusSurface(data["points"], data["model"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Focus map not loaded: {e}")
+            return False
+        return True
+
+    def save(self):
+        """Writes the focus map file atomically"""
+        data = {"model": self.surface.model, "points": self.surface.points}
+        atomic_write_json(self.path, data, "Focus map")
+
+    def update(self, points, model="bilinear"):
+        """
+        Fits a new stage surface and saves it.
+        Parameters:
+            points: (x, y, z) in mm of in-focus positions on the stage
+            model: "plane" or "bilinear"
+        Returns:
+            The new FocusSurface
+        """
+        with self.saveLock:
+            self.surface = FocusSurface(points, model)
+            self.save()
+        return self.surface
+
+    def surface_through(self, x, y, z):
+        """
+        Returns the stage surface shifted to pass through a measured in-focus position (eg. autofocus on the sample),
+        or a flat surface at that height if the stage has not been calibrated.
+        """
+        if self.surface is None:
+            return FocusSurface([(x, y, z)])
+        offset = z - self.surface.z_at(x, y)
+        return FocusSurface([(px, py, pz + offset) for px, py, pz in self.surface.points], self.surface.model)
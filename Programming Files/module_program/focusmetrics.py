@@ -0,0 +1,195 @@
+"""
+Focus metrics computed with NumPy on a downsampled greyscale (luminance) view of an image.
+Full resolution frames are reduced by taking every nth pixel (a view, nothing is copied) before being converted to
+float32 in a preallocated buffer, so scoring a frame does not allocate any full size arrays.
+Every metric also accepts a stack of frames (n, height, width) and scores all of them in one vectorised call.
+Metrics are means over the image so scores of different resolutions are comparable.
+"""
+import time
+import numpy as np
+
+FOCUSWIDTH = 1014 # width (pixels) images are downsampled to before scoring
+LUMAWEIGHTS = (0.114, 0.587, 0.299) # BGR weights for converting colour images to luminance
+
+
+def downsample_factor(shape, width=FOCUSWIDTH):
+    """Returns the pixel step that reduces an image of the given shape to about the given width"""
+    return max(1, shape[1]//width)
+
+def _buffer(buffers, name, shape):
+    """Returns a float32 work array, reused from buffers if one of the right shape was already allocated"""
+    if buffers is None:
+        return np.empty(shape, np.float32)
+    array = buffers.get(name)
+    if array is None or array.shape != shape:
+        array = np.empty(shape, np.float32)
+        buffers[name] = array
+    return array
+
+def _mean(array):
+    """Mean over the last two axes (one value per frame)"""
+    return array.mean(axis=(-2, -1), dtype=np.float64)
+
+def prepare(image, factor=None, buffers=None, colour=None):
+    """
+    Downsamples an image (or stack of images) and converts it to float32 luminance.
+    Parameters:
+        image: Greyscale (height, width) or BGR (height, width, 3) array, or a stack of either
+        factor: Pixel step used for downsampling (from downsample_factor if None)
+        buffers: Dictionary of work arrays to reuse (allocated on first use)
+        colour: True if the last axis holds colour channels. Guessed from the shape if None
+    Returns:
+        float32 array of shape (..., height/factor, width/factor)
+    """
+    if colour is None:
+        colour = image.ndim >= 3 and image.shape[-1] in (3, 4)
+    spatial = image.shape[-3:-1] if colour else image.shape[-2:]
+    if factor is None:
+        factor = downsample_factor(spatial)
+    view = image[..., ::factor, ::factor, :] if colour else image[..., ::factor, ::factor]
+    luma = _buffer(buffers, "luma", view.shape[:-1] if colour else view.shape)
+    if colour:
+        channel = _buffer(buffers, "channel", luma.shape)
+        np.multiply(view[..., 0], LUMAWEIGHTS[0], out=luma, casting="unsafe")
+        for i in (1, 2):
+            np.multiply(view[..., i], LUMAWEIGHTS[i], out=channel, casting="unsafe")
+            luma += channel
+    else:
+        np.copyto(luma, view, casting="unsafe")
+    return luma
+
+def laplacian_variance(luma, buffers=None):
+    """Variance of the 4-neighbour Laplacian (the kernel used by cv2.Laplacian)"""
+    shape = luma.shape[:-2] + (luma.shape[-2] - 2, luma.shape[-1] - 2)
+    laplacian = _buffer(buffers, "inner", shape)
+    centre = _buffer(buffers, "temp", shape)
+    np.add(luma[..., 1:-1, :-2], luma[..., 1:-1, 2:], out=laplacian)
+    laplacian += luma[..., :-2, 1:-1]
+    laplacian += luma[..., 2:, 1:-1]
+    np.multiply(luma[..., 1:-1, 1:-1], 4, out=centre)
+    laplacian -= centre
+    mean = _mean(laplacian)
+    np.square(laplacian, out=laplacian)
+    return _mean(laplacian) - mean**2
+
+def tenengrad(luma, buffers=None):
+    """Mean squared Sobel gradient magnitude"""
+    rows, cols = luma.shape[-2:]
+    lead = luma.shape[:-2]
+    # Sobel kernels are separable: a central difference in one direction smoothed by (1, 2, 1) in the other
+    rowDiff = _buffer(buffers, "rowDiff", lead + (rows, cols - 2))
+    colDiff = _buffer(buffers, "colDiff", lead + (rows - 2, cols))
+    gx = _buffer(buffers, "inner", lead + (rows - 2, cols - 2))
+    gy = _buffer(buffers, "temp", lead + (rows - 2, cols - 2))
+    np.subtract(luma[..., 2:], luma[..., :-2], out=rowDiff)
+    np.subtract(luma[..., 2:, :], luma[..., :-2, :], out=colDiff)
+    np.add(rowDiff[..., :-2, :], rowDiff[..., 2:, :], out=gx)
+    gx += rowDiff[..., 1:-1, :]
+    gx += rowDiff[..., 1:-1, :]
+    np.add(colDiff[..., :-2], colDiff[..., 2:], out=gy)
+    gy += colDiff[..., 1:-1]
+    gy += colDiff[..., 1:-1]
+    np.square(gx, out=gx)
+    np.square(gy, out=gy)
+    gx += gy
+    return _mean(gx)
+
+def brenner(luma, buffers=None):
+    """Mean squared difference between pixels two columns apart (Brenner gradient)"""
+    rowDiff = _buffer(buffers, "rowDiff", luma.shape[:-1] + (luma.shape[-1] - 2,))
+    np.subtract(luma[..., 2:], luma[..., :-2], out=rowDiff)
+    np.square(rowDiff, out=rowDiff)
+    return _mean(rowDiff)
+
+def normalised_variance(luma, buffers=None):
+    """Intensity variance divided by the mean intensity (insensitive to the brightness of the light)"""
+    squared = _buffer(buffers, "squared", luma.shape)
+    mean = _mean(luma)
+    np.square(luma, out=squared)
+    variance = _mean(squared) - mean**2
+    return np.divide(variance, mean, out=np.zeros_like(variance), where=mean > 0)
+
+METRICS = {"laplacian": laplacian_variance, "tenengrad": tenengrad, "brenner": brenner, "normalised_variance": normalised_variance}
+
+
+class FocusScorer:
+    """
+    Scores single frames, keeping its work arrays between calls so they are only allocated for the first frame of each size.
+    Attributes:
+        width: Width (pixels) images are downsampled to
+        buffers (dict): Preallocated work arrays
+    """
+    def __init__(self, width=FOCUSWIDTH):
+        self.width = width
+        self.buffers = {}
+
+    def score(self, image, metric="laplacian"):
+        """
+        Returns the focus score of one greyscale or BGR image.
+        Parameters:
+            image: Image array
+            metric: "laplacian", "tenengrad", "brenner" or "normalised_variance"
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown focus metric '{metric}'")
+        colour = image.ndim == 3
+        factor = downsample_factor(image.shape[:2], self.width)
+        return float(METRICS[metric](prepare(image, factor, self.buffers, colour), self.buffers))
+
+def score_stack(stack, metric="laplacian", width=FOCUSWIDTH, buffers=None):
+    """
+    Scores a stack of frames in one vectorised call.
+    Parameters:
+        stack: Array of shape (n, height, width) or (n, height, width, 3), or a list of equally sized frames
+        metric: "laplacian", "tenengrad", "brenner" or "normalised_variance"
+        width: Width (pixels) frames are downsampled to
+        buffers: Dictionary of work arrays to reuse between stacks of the same size (allocated for this call if None)
+    Returns:
+        Array of n focus scores
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown focus metric '{metric}'")
+    stack = np.asarray(stack)
+    colour = stack.ndim == 4
+    spatial = stack.shape[1:3]
+    if buffers is None:
+        buffers = {}
+    return METRICS[metric](prepare(stack, downsample_factor(spatial, width), buffers, colour), buffers)
+
+def benchmark(resolutions=((1014, 760), (2028, 1520), (4056, 3040)), repeats=5, stackSize=8, colour=True, clock=time):
+    """
+    Times every metric on random frames of several resolutions.
+    Parameters:
+        resolutions: (width, height) of the frames timed
+        repeats: Number of frames timed one at a time for each metric and resolution
+        stackSize: Number of frames scored together to time score_stack
+        colour: Time BGR frames (as captured from the main stream) if True, greyscale frames if False
+        clock: Provides perf_counter() (the time module)
+    Returns:
+        Dictionary of {"widthxheight": {metric: {"single": ms per frame, "stack": ms per frame}}}
+    """
+    rng = np.random.default_rng(0)
+    results = {}
+    for width, height in resolutions:
+        shape = (height, width, 3) if colour else (height, width)
+        frame = rng.integers(0, 256, shape, dtype=np.uint8)
+        stack = rng.integers(0, 256, (stackSize,) + shape, dtype=np.uint8)
+        scorer = FocusScorer()
+        stackBuffers = {}
+        timings = {}
+        for metric in METRICS:
+            scorer.score(frame, metric) # allocate the work arrays before timing
+            start = clock.perf_counter()
+            for i in range(repeats):
+                scorer.score(frame, metric)
+            single = (clock.perf_counter() - start)/repeats*1000
+            score_stack(stack, metric, buffers=stackBuffers)
+            start = clock.perf_counter()
+            score_stack(stack, metric, buffers=stackBuffers)
+            timings[metric] = {"single": round(single, 3), "stack": round((clock.perf_counter() - start)/stackSize*1000, 3)}
+        results[f"{width}x{height}"] = timings
+    return results
+
+if __name__ == "__main__":
+    for resolution, timings in benchmark().items():
+        print(resolution, timings)
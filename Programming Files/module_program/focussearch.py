@@ -0,0 +1,209 @@
+"""
+Autofocus search strategies. Each strategy is given a measure(z) function which moves to a z position (mm), captures an image
+and returns its focus score, and searches a z range for the highest score with as few captures as possible.
+Everything in this file is pure Python so strategies can be compared against a synthetic defocus model without hardware.
+"""
+import bisect
+import math
+import time
+
+COARSEFACTOR = 4 # coarse sweep step as a multiple of the requested step size
+GOLDENRATIO = (math.sqrt(5) - 1)/2
+HILLCLIMBDROP = 0.2 # fraction the score must fall below the best score for a hill climb to stop
+
+
+class FocusResult:
+    """
+    Result of one autofocus search.
+    Attributes:
+        strategy: Name of the strategy used
+        bestZ: z position (mm) of the highest focus, including the sub-step peak fit
+        bestScore: Highest measured focus score
+        captures: Number of images captured (calls to measure)
+        wallTime: Time (s) taken by the search
+        scores (list): (z, score) of every capture in the order they were made
+    """
+    def __init__(self, strategy, bestZ, bestScore, captures, wallTime, scores):
+        self.strategy = strategy
+        self.bestZ = bestZ
+        self.bestScore = bestScore
+        self.captures = captures
+        self.wallTime = wallTime
+        self.scores = scores
+
+    def to_dict(self):
+        """Returns the result as a dictionary that can be sent as JSON"""
+        return {"strategy": self.strategy, "best_z": round(self.bestZ, 4), "best_score": self.bestScore,
+                "captures": self.captures, "wall_time": round(self.wallTime, 3)}
+
+
+class _Measurements:
+    """Calls measure once per z position (rounded to the step size grid) and keeps every score"""
+    def __init__(self, measure, resolution, isStopped):
+        self.measure = measure
+        self.resolution = resolution
+        self.isStopped = isStopped
+        self.cache = {}
+        self.scores = []
+
+    def __call__(self, z):
+        key = round(z/self.resolution)
+        if key not in self.cache:
+            if self.isStopped is not None and self.isStopped():
+                raise _Stopped()
+            score = self.measure(key*self.resolution)
+            self.cache[key] = score
+            self.scores.append((key*self.resolution, score))
+        return self.cache[key]
+
+    def best(self):
+        """Returns (z, score) of the highest score measured"""
+        return max(self.scores, key=lambda item: item[1])
+
+
+class _Stopped(Exception):
+    """Raised inside a search when a stop is requested"""
+
+
+def fit_peak(scores, method="parabolic"):
+    """
+    Estimates the z position of the focus peak between measured positions by fitting the best score and its two neighbours.
+    Parameters:
+        scores: List of (z, score) measurements
+        method: "parabolic" fits a parabola to the scores, "gaussian" fits a parabola to their logarithm (a Gaussian peak),
+            None returns the best measured z
+    Returns:
+        z position (mm) of the fitted peak, kept between the two neighbours
+    """
+    points = sorted(scores)
+    best = max(range(len(points)), key=lambda i: points[i][1])
+    if method is None or best == 0 or best == len(points) - 1:
+        return points[best][0]
+
+    (z0, s0), (z1, s1), (z2, s2) = points[best - 1:best + 2]
+    if method == "gaussian":
+        if min(s0, s1, s2) <= 0:
+            return z1
+        s0, s1, s2 = math.log(s0), math.log(s1), math.log(s2)
+
+    # Vertex of the parabola through three (possibly unevenly spaced) points
+    denominator = (z0 - z1)*(z0 - z2)*(z1 - z2)
+    a = (z2*(s1 - s0) + z1*(s0 - s2) + z0*(s2 - s1))/denominator
+    b = (z2**2*(s0 - s1) + z1**2*(s2 - s0) + z0**2*(s1 - s2))/denominator
+    if a >= 0:
+        return z1
+    return min(max(-b/(2*a), z0), z2)
+
+def _sweep(measured, zMin, zMax, step):
+    """Measures every step from zMin to zMax (inclusive)"""
+    count = int(round((zMax - zMin)/step))
+    for i in range(count + 1):
+        measured(min(zMin + i*step, zMax))
+
+def coarse_fine(measured, zMin, zMax, stepSize):
+    """Coarse sweep of the whole range, then a fine sweep at stepSize around the best coarse position"""
+    coarseStep = stepSize*COARSEFACTOR
+    _sweep(measured, zMin, zMax, coarseStep)
+    bestZ = measured.best()[0]
+    _sweep(measured, max(bestZ - coarseStep, zMin), min(bestZ + coarseStep, zMax), stepSize)
+
+def golden_section(measured, zMin, zMax, stepSize):
+    """
+    Golden-section search, narrowing the range around the peak until it is smaller than stepSize. Assumes the score rises
+    steadily towards a single peak across the whole range, so it can miss a narrow peak on a flat background
+    """
+    low, high = zMin, zMax
+    lowerZ = high - GOLDENRATIO*(high - low)
+    upperZ = low + GOLDENRATIO*(high - low)
+    while high - low > stepSize:
+        if measured(lowerZ) >= measured(upperZ):
+            high, upperZ = upperZ, lowerZ
+            lowerZ = high - GOLDENRATIO*(high - low)
+        else:
+            low, lowerZ = lowerZ, upperZ
+            upperZ = low + GOLDENRATIO*(high - low)
+    # Measure both neighbours of the best position so the peak can be fitted
+    bestZ = measured.best()[0]
+    measured(max(bestZ - stepSize, zMin))
+    measured(min(bestZ + stepSize, zMax))
+
+def _climb(measured, z, direction, step, zMin, zMax):
+    """
+    Steps from z in one direction while the score keeps up with the best so far.
+    Returns:
+        True if the climb ended on a clear drop in score (a peak was passed), False if it reached the end of the range
+    """
+    best = measured(z)
+    while True:
+        z = z + direction*step
+        if z < zMin - 1e-9 or z > zMax + 1e-9:
+            return False
+        score = measured(z)
+        if score > best:
+            best = score
+        elif score < best*(1 - HILLCLIMBDROP):
+            return True
+
+def hill_climb(measured, zMin, zMax, stepSize):
+    """
+    Climbs from the middle of the range (the expected focus height) in coarse steps in the direction of increasing score
+    and stops early once the score clearly drops after a peak. If the range ends first (eg. the start was on the flat
+    background far from focus and the wrong way was picked) the other direction is climbed too.
+    The climb is then repeated at stepSize from the best position.
+    """
+    z = (zMin + zMax)/2
+    for step in (stepSize*COARSEFACTOR, stepSize):
+        z = measured.best()[0] if measured.scores else z
+        # Pick the direction in which the score increases
+        direction = 1 if measured(min(z + step, zMax)) >= measured(max(z - step, zMin)) else -1
+        if not _climb(measured, z, direction, step, zMin, zMax):
+            _climb(measured, z, -direction, step, zMin, zMax)
+
+STRATEGIES = {"coarse_fine": coarse_fine, "golden_section": golden_section, "hill_climb": hill_climb}
+
+def search_focus(measure, zMin, zMax, stepSize, strategy="coarse_fine", peakFit="parabolic", isStopped=None, clock=time):
+    """
+    Searches a z range for the best focus.
+    Parameters:
+        measure: Function which moves to a z position (mm), captures an image and returns its focus score
+        zMin: Lower bound of focus range (mm position)
+        zMax: Upper bound of focus range (mm position)
+        stepSize: Smallest distance (mm) between captures
+        strategy: "coarse_fine", "golden_section" or "hill_climb"
+        peakFit: "parabolic", "gaussian" or None, used to estimate the peak between captures
+        isStopped: Function returning True if the search should end early
+        clock: Provides perf_counter() for timing the search (the time module)
+    Returns:
+        FocusResult, or None if the search was stopped
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown autofocus strategy '{strategy}'")
+    start = clock.perf_counter()
+    measured = _Measurements(measure, stepSize, isStopped)
+    try:
+        STRATEGIES[strategy](measured, zMin, zMax, stepSize)
+    except _Stopped:
+        return None
+    bestScore = measured.best()[1]
+    bestZ = fit_peak(measured.scores, peakFit)
+    return FocusResult(strategy, bestZ, bestScore, len(measured.scores), clock.perf_counter() - start, measured.scores)
+
+def correlate_frames(stepLog, frames):
+    """
+    Maps each frame to the motor position at the time it was exposed, by linear interpolation between the logged steps.
+    Used for continuous sweeps where frames are captured while the motor is moving.
+    Parameters:
+        stepLog: List of (time in ns, steps moved) in time order, starting with the time the move started at 0 steps
+        frames: List of (time in ns of the middle of the exposure, score)
+    Returns:
+        List of (steps moved, score) for every frame exposed during the logged move
+    """
+    correlated = []
+    times = [entry[0] for entry in stepLog]
+    for frameTime, score in frames:
+        i = bisect.bisect_right(times, frameTime)
+        if i == 0 or i == len(times):
+            continue
+        (t0, s0), (t1, s1) = stepLog[i - 1], stepLog[i]
+        correlated.append((s0 + (s1 - s0)*(frameTime - t0)/(t1 - t0) if t1 > t0 else s1, score))
+    return correlated
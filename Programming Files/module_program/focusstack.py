@@ -0,0 +1,66 @@
+"""
+Extended depth of field by focus stacking. Frames captured at different z heights are fused one at a time: each pixel
+of the result is taken from the frame with the highest local Laplacian energy (detail) at that pixel.
+Only the fused image and the frame being added are kept at full resolution. The energy is compared on a reduced pyramid
+level, which also smooths out noise, and the choice is scaled back up to full resolution.
+"""
+import cv2
+import numpy as np
+
+ENERGYLEVEL = 2 # pyramid level the Laplacian energy is compared at (each level halves the size)
+ENERGYBLUR = 5 # size of the Gaussian window (pixels at the energy level) the energy is averaged over
+
+
+class FocusStacker:
+    """
+    Fuses a stream of frames of the same scene taken at different focus heights.
+    Attributes:
+        fused: Fused BGR image (None until the first frame is added)
+        depth: Index of the frame each pixel was taken from, at the energy pyramid level
+        bestEnergy: Highest Laplacian energy found so far at each pixel of the energy pyramid level
+        count (int): Number of frames added
+    """
+    def __init__(self):
+        self.fused = None
+        self.depth = None
+        self.bestEnergy = None
+        self.count = 0
+
+    def _energy(self, frame):
+        """Returns the smoothed Laplacian energy of a frame at the energy pyramid level"""
+        luma = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        for level in range(ENERGYLEVEL):
+            luma = cv2.pyrDown(luma)
+        laplacian = cv2.Laplacian(luma, cv2.CV_32F)
+        np.square(laplacian, out=laplacian)
+        return cv2.GaussianBlur(laplacian, (ENERGYBLUR, ENERGYBLUR), 0)
+
+    def add(self, frame):
+        """
+        Adds the next frame of the stack. The frame is not kept, so the caller can release or overwrite it afterwards.
+        Parameters:
+            frame: BGR or greyscale image array (all frames must be the same size)
+        """
+        energy = self._energy(frame)
+        if self.fused is None:
+            self.fused = frame.copy()
+            self.bestEnergy = energy
+            self.depth = np.zeros(energy.shape, np.uint8)
+        else:
+            sharper = energy > self.bestEnergy
+            np.copyto(self.bestEnergy, energy, where=sharper)
+            self.depth[sharper] = self.count
+            # Scale the choice of frame up to full resolution and copy the sharper pixels into the fused image
+            mask = cv2.resize(sharper.view(np.uint8), (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_NEAREST).view(bool)
+            np.copyto(self.fused, frame, where=mask[..., None] if frame.ndim == 3 else mask)
+        self.count = self.count + 1
+
+    def depth_map(self, fullSize=True):
+        """
+        Returns the index (0 for the first frame added) of the frame each pixel was taken from as a uint8 image.
+        Parameters:
+            fullSize: Scale the map up to the size of the fused image if True
+        """
+        if not fullSize:
+            return self.depth
+        return cv2.resize(self.depth, (self.fused.shape[1], self.fused.shape[0]), interpolation=cv2.INTER_NEAREST)
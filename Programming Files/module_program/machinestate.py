@@ -0,0 +1,97 @@
+import json
+import threading
+from atomicjson import atomic_write_json
+
+
+class MachineState:
+    """
+    Machine position and status kept in a small JSON file so they survive restarts of rpmain.py.
+    The file is replaced atomically (written to a temporary file, flushed to disk, then renamed over the old file)
+    so a crash or power cut leaves either the old or the new state, never a partly written file.
+    Attributes:
+        path: Location of the state file
+        currX (int): x position of the camera carriage in steps
+        currY (int): y position of the camera carriage in steps
+        currZ (int): z position of the stage in steps
+        isHomed (bool): True if the system was homed
+        motorsEnabled (bool): True if the motors have stayed enabled since homing
+        moving (bool): True while a move is in progress (the saved position is not reliable)
+        session (int): Counter increased every time the module starts
+        saveLock (threading.Lock): Thread lock for updating and writing the state
+    """
+    def __init__(self, path):
+        self.path = path
+        self.currX = 0
+        self.currY = 0
+        self.currZ = 0
+        self.isHomed = False
+        self.motorsEnabled = False
+        self.moving = False
+        self.session = 0
+        self.saveLock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the state file.
+        Returns:
+            True if a state file was read, False if there is no readable state file
+        """
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+            self.currX = int(data["x"])
+            self.currY = int(data["y"])
+            self.currZ = int(data["z"])
+            self.isHomed = bool(data["homed"])
+            self.motorsEnabled = bool(data["motors_enabled"])
+            self.moving = bool(data["moving"])
+            self.session = int(data["session"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Machine state not loaded: {e}")
+            return False
+        return True
+
+    def save(self):
+        """Writes the state file atomically"""
+        data = {
+            "x": self.currX,
+            "y": self.currY,
+            "z": self.currZ,
+            "homed": self.isHomed,
+            "motors_enabled": self.motorsEnabled,
+            "moving": self.moving,
+            "session": self.session
+        }
+        atomic_write_json(self.path, data, "Machine state")
+
+    def update(self, currX, currY, currZ, isHomed, motorsEnabled, moving=False):
+        """
+        Updates and saves the state.
+        Parameters:
+            currX: x position in steps
+            currY: y position in steps
+            currZ: z position in steps
+            isHomed: True if the system is homed
+            motorsEnabled: True if the motors are enabled
+            moving: True if a move is about to start
+        """
+        with self.saveLock:
+            self.currX, self.currY, self.currZ = currX, currY, currZ
+            self.isHomed = isHomed
+            self.motorsEnabled = motorsEnabled
+            self.moving = moving
+            self.save()
+
+    def start_session(self):
+        """
+        Loads the previous state and saves it again with the session counter increased.
+        Returns:
+            True if the saved position can be trusted: the system was homed, the motors were never disabled since
+            and no move was interrupted
+        """
+        with self.saveLock:
+            loaded = self.load()
+            trusted = loaded and self.isHomed and self.motorsEnabled and not self.moving
+            self.session = self.session + 1
+            self.save()
+        return trusted
@@ -0,0 +1,345 @@
+"""
+Motion planning for the optical module. Everything in this file is pure Python so that profiles can be generated and checked without hardware.
+Velocities are in steps/s, accelerations in steps/s^2 and jerk in steps/s^3 unless stated otherwise.
+"""
+import math
+
+
+class AxisLimits:
+    """
+    Motion limits for one axis, given in mm and converted to steps for planning.
+    Attributes:
+        stepDist: Linear distance moved each motor step (mm)
+        startVelocity: Velocity the motor can start or stop at without ramping (mm/s)
+        maxVelocity: Maximum cruise velocity (mm/s)
+        acceleration: Maximum acceleration (mm/s^2)
+        jerk: Maximum jerk (mm/s^3). If None a trapezoidal profile is used, otherwise an S-curve
+    """
+    def __init__(self, stepDist, startVelocity, maxVelocity, acceleration, jerk=None):
+        self.stepDist = stepDist
+        self.startVelocity = startVelocity
+        self.maxVelocity = maxVelocity
+        self.acceleration = acceleration
+        self.jerk = jerk
+
+    def start_rate(self):
+        """Returns the start velocity in steps/s"""
+        return self.startVelocity/self.stepDist
+
+    def max_rate(self):
+        """Returns the maximum velocity in steps/s"""
+        return self.maxVelocity/self.stepDist
+
+    def accel_rate(self):
+        """Returns the maximum acceleration in steps/s^2"""
+        return self.acceleration/self.stepDist
+
+    def jerk_rate(self):
+        """Returns the maximum jerk in steps/s^3 (None for trapezoidal profiles)"""
+        return None if self.jerk is None else self.jerk/self.stepDist
+
+
+class MotionProfile:
+    """
+    Per-step timing for one move.
+    Attributes:
+        steps: Number of steps in the move
+        delays (list): Time (s) from each step pulse to the next. The last entry is the time for the final step to complete
+        entryRate: Step rate at the start of the move (steps/s)
+        cruiseRate: Highest step rate reached during the move (steps/s)
+        exitRate: Step rate at the end of the move (steps/s)
+        acceleration: Acceleration used for the ramps (steps/s^2)
+        jerk: Jerk used for the ramps (steps/s^3, None for trapezoidal profiles)
+        startRate: Rate the motor can stop from without ramping (steps/s)
+        moveTime: Predicted time (s) to complete the move
+    """
+    def __init__(self, steps, delays, entryRate, cruiseRate, exitRate, acceleration, jerk, startRate=None):
+        self.steps = steps
+        self.delays = delays
+        self.entryRate = entryRate
+        self.cruiseRate = cruiseRate
+        self.exitRate = exitRate
+        self.acceleration = acceleration
+        self.jerk = jerk
+        self.startRate = entryRate if startRate is None else startRate
+        self.moveTime = sum(delays)
+
+    def scaled(self, ratio):
+        """
+        Returns the rates of this profile scaled for a motor making ratio times as many steps (used to coordinate motors
+        moving different distances so they all finish together).
+        Returns:
+            Tuple (cruiseRate, acceleration) in steps/s and steps/s^2
+        """
+        return self.cruiseRate*ratio, self.acceleration*ratio
+
+
+def _ramp_phases(vStart, vEnd, acceleration, jerk):
+    """
+    Builds the phases of a ramp between two velocities as a list of (duration, jerk, acceleration) segments. S-curve phases start
+    and end at zero acceleration and only use jerk. Trapezoidal ramps are a single constant acceleration phase (duration, None, acceleration).
+    """
+    dv = abs(vEnd - vStart)
+    if dv == 0:
+        return []
+    sign = 1 if vEnd > vStart else -1
+    if jerk is None:
+        return [(dv/acceleration, None, sign*acceleration)]
+
+    # S-curve ramp: jerk up to peak acceleration, hold, jerk back down to zero acceleration
+    if dv >= acceleration**2/jerk:
+        tJerk = acceleration/jerk
+        tConst = dv/acceleration - tJerk
+    else:
+        tJerk = math.sqrt(dv/jerk)
+        tConst = 0
+    phases = [(tJerk, sign*jerk, 0)]
+    if tConst > 0:
+        phases.append((tConst, 0, 0))
+    phases.append((tJerk, -sign*jerk, 0))
+    return phases
+
+def _ramp_distance(vStart, vEnd, acceleration, jerk):
+    """Distance (steps) covered while ramping between two velocities"""
+    dv = abs(vEnd - vStart)
+    if dv == 0:
+        return 0
+    if jerk is None:
+        return abs(vEnd**2 - vStart**2)/(2*acceleration)
+    # Symmetric S-curve ramps cover the distance travelled at the mean velocity
+    duration = sum(phase[0] for phase in _ramp_phases(vStart, vEnd, acceleration, jerk))
+    return (vStart + vEnd)/2*duration
+
+def _build_segments(vEntry, vCruise, vExit, cruiseSteps, acceleration, jerk):
+    """
+    Builds the full move as polynomial segments (duration, position, velocity, acceleration, jerk) so that the position
+    at time t into a segment is s + v*t + a*t^2/2 + j*t^3/6
+    """
+    segments = []
+    position, velocity, accel = 0.0, vEntry, 0.0
+
+    def add(duration, segJerk, segAccel):
+        nonlocal position, velocity, accel
+        if segJerk is None:
+            segJerk, accel = 0, segAccel
+        segments.append((duration, position, velocity, accel, segJerk))
+        position = position + velocity*duration + accel*duration**2/2 + segJerk*duration**3/6
+        velocity = velocity + accel*duration + segJerk*duration**2/2
+        accel = accel + segJerk*duration
+
+    for phase in _ramp_phases(vEntry, vCruise, acceleration, jerk):
+        add(*phase)
+    accel = 0.0
+    velocity = vCruise
+    if cruiseSteps > 0:
+        add(cruiseSteps/vCruise, 0, 0)
+    for phase in _ramp_phases(vCruise, vExit, acceleration, jerk):
+        add(*phase)
+    return segments
+
+def _step_times(segments, steps):
+    """
+    Finds the time at which the move reaches each whole step position by inverting the segment polynomials with Newton's method
+    """
+    times = []
+    segStart = 0.0
+    target = 1
+    for duration, s0, v0, a0, j in segments:
+        segEnd = s0 + v0*duration + a0*duration**2/2 + j*duration**3/6
+        t = 0.0
+        while target <= steps and target <= segEnd + 1e-9:
+            # Newton iterations from the previous solution, kept inside the segment
+            for _ in range(30):
+                position = s0 + v0*t + a0*t**2/2 + j*t**3/6 - target
+                velocity = v0 + a0*t + j*t**2/2
+                if abs(position) < 1e-9 or velocity <= 0:
+                    break
+                t = min(max(t - position/velocity, 0.0), duration)
+            times.append(segStart + t)
+            target = target + 1
+        segStart = segStart + duration
+
+    # Rounding can leave the last step just past the end of the final segment
+    while len(times) < steps:
+        times.append(segStart)
+    return times
+
+def plan_profile(steps, limits: AxisLimits, entryVelocity=0, exitVelocity=0):
+    """
+    Plans a trapezoidal (or S-curve if the axis has a jerk limit) velocity profile for a move and converts it to per-step delays.
+    Parameters:
+        steps: Number of steps to move (sign is ignored)
+        limits: AxisLimits of the motor with the most steps
+        entryVelocity: Velocity at the start of the move (mm/s). Raised to the start velocity if lower
+        exitVelocity: Velocity at the end of the move (mm/s). Raised to the start velocity if lower
+    Returns:
+        MotionProfile for the move
+    """
+    steps = abs(int(steps))
+    vStart = limits.start_rate()
+    vMax = max(limits.max_rate(), vStart)
+    acceleration = limits.accel_rate()
+    jerk = limits.jerk_rate()
+    vEntry = min(max(entryVelocity/limits.stepDist, vStart), vMax)
+    vExit = min(max(exitVelocity/limits.stepDist, vStart), vMax)
+    if steps == 0:
+        return MotionProfile(0, [], vEntry, vEntry, vExit, acceleration, jerk, vStart)
+
+    # Make sure the entry and exit velocities can be reached from each other within the move
+    if _ramp_distance(vEntry, vExit, acceleration, jerk) > steps:
+        low, high = vStart, max(vEntry, vExit)
+        for _ in range(50):
+            middle = (low + high)/2
+            if _ramp_distance(min(vEntry, middle), min(vExit, middle), acceleration, jerk) > steps:
+                high = middle
+            else:
+                low = middle
+        vEntry, vExit = min(vEntry, low), min(vExit, low)
+
+    # Find the highest cruise velocity whose ramps fit in the move
+    vCruise = vMax
+    if _ramp_distance(vEntry, vCruise, acceleration, jerk) + _ramp_distance(vCruise, vExit, acceleration, jerk) > steps:
+        low, high = max(vEntry, vExit), vMax
+        for _ in range(50):
+            middle = (low + high)/2
+            if _ramp_distance(vEntry, middle, acceleration, jerk) + _ramp_distance(middle, vExit, acceleration, jerk) > steps:
+                high = middle
+            else:
+                low = middle
+        vCruise = low
+    cruiseSteps = steps - _ramp_distance(vEntry, vCruise, acceleration, jerk) - _ramp_distance(vCruise, vExit, acceleration, jerk)
+
+    # Convert step positions to times and then to the delay between each step pulse
+    times = _step_times(_build_segments(vEntry, vCruise, vExit, max(cruiseSteps, 0), acceleration, jerk), steps)
+    # The first pulse is sent at the start of the move and each following pulse when the profile reaches the next whole step
+    delays = [times[0]] + [times[i] - times[i-1] for i in range(1, steps)]
+    return MotionProfile(steps, delays, vEntry, vCruise, vExit, acceleration, jerk, vStart)
+
+def plan_deceleration(profile: MotionProfile, step):
+    """
+    Plans a controlled stop part way through a move, slowing down from the rate at a given step with the profile's
+    acceleration (and jerk) until the motor can stop without losing steps. Used for soft stops.
+    Parameters:
+        profile: MotionProfile of the move being stopped
+        step: Index of the next step of the move
+    Returns:
+        List of delays for the steps needed to stop (never more than the steps left in the move)
+    """
+    remaining = profile.steps - step
+    if remaining <= 0:
+        return []
+    # Rate the motor is running at, taken from the previous step
+    rate = 1/profile.delays[max(step - 1, 0)] if profile.delays[max(step - 1, 0)] > 0 else profile.startRate
+    if rate <= profile.startRate:
+        return []
+
+    steps = min(math.ceil(_ramp_distance(rate, profile.startRate, profile.acceleration, profile.jerk)), remaining)
+    times = _step_times(_build_segments(rate, rate, profile.startRate, 0, profile.acceleration, profile.jerk), steps)
+    return [times[0]] + [times[i] - times[i-1] for i in range(1, steps)]
+
+def combine_limits(deltas, limits):
+    """
+    Combines the limits of several motors moving together into limits for the motor with the most steps, so that no motor
+    exceeds its own limits when the others step in proportion to it (Bresenham interpolation).
+    Parameters:
+        deltas: Steps moved by each motor
+        limits: AxisLimits of each motor
+    Returns:
+        AxisLimits in steps (stepDist = 1) for the motor with the most steps
+    """
+    longest = max([abs(delta) for delta in deltas], default=0)
+    scaled = [(longest/abs(delta), limit) for delta, limit in zip(deltas, limits) if delta != 0]
+    if not scaled:
+        return AxisLimits(1, limits[0].start_rate(), limits[0].max_rate(), limits[0].accel_rate(), limits[0].jerk_rate())
+
+    # A motor making fewer steps runs proportionally slower, so the longest motor may go faster by the same ratio
+    jerks = [ratio*limit.jerk_rate() for ratio, limit in scaled if limit.jerk is not None]
+    return AxisLimits(1,
+                      min(ratio*limit.start_rate() for ratio, limit in scaled),
+                      min(ratio*limit.max_rate() for ratio, limit in scaled),
+                      min(ratio*limit.accel_rate() for ratio, limit in scaled),
+                      min(jerks) if jerks else None)
+
+def interpolate_steps(deltas):
+    """
+    Bresenham interpolation of several motors. For every step of the motor with the most steps, yields a tuple of flags
+    saying which motors step, so that each motor makes exactly abs(delta) steps spread evenly over the move.
+    Parameters:
+        deltas: Steps moved by each motor (sign is ignored)
+    """
+    counts = [abs(delta) for delta in deltas]
+    longest = max(counts, default=0)
+    errors = [longest//2]*len(counts)
+    for i in range(longest):
+        flags = []
+        for j, count in enumerate(counts):
+            errors[j] = errors[j] + count
+            if errors[j] >= longest:
+                errors[j] = errors[j] - longest
+                flags.append(True)
+            else:
+                flags.append(False)
+        yield tuple(flags)
+
+def _max_reachable_rate(vStart, steps, limits: AxisLimits):
+    """Highest rate (steps/s) that can be reached from vStart (or slowed from down to vStart) within a number of steps"""
+    vMax = max(limits.max_rate(), limits.start_rate())
+    acceleration, jerk = limits.accel_rate(), limits.jerk_rate()
+    if vStart >= vMax or _ramp_distance(vStart, vMax, acceleration, jerk) <= steps:
+        return max(vStart, vMax)
+    low, high = vStart, vMax
+    for _ in range(50):
+        middle = (low + high)/2
+        if _ramp_distance(vStart, middle, acceleration, jerk) > steps:
+            high = middle
+        else:
+            low = middle
+    return low
+
+def plan_path(segments, limits, stops):
+    """
+    Lookahead planning for a path made of several moves. Instead of stopping at the end of every move, the path keeps moving
+    through points where stops is False and only slows down as much as the change in direction and the remaining distance need.
+    Speeds at each junction are limited so that no motor changes speed by more than its start velocity (the speed it can
+    start from standstill at), then passed backwards and forwards along the path so every deceleration fits in the moves before it.
+    Parameters:
+        segments: List of moves, each a list of steps for every motor
+        limits: AxisLimits of each motor
+        stops: For each move, True if the path has to stop at its end (eg. to take an image). The path always stops at the end
+    Returns:
+        List of MotionProfile, one per move, for the motor with the most steps in that move
+    """
+    # Path speed is measured along the straight line in motor step space, which for CoreXY is proportional to carriage speed
+    combined, lengths, factors, directions = [], [], [], []
+    for deltas in segments:
+        longest = max([abs(delta) for delta in deltas], default=0)
+        norm = math.sqrt(sum(delta**2 for delta in deltas))
+        combined.append(combine_limits(deltas, limits))
+        lengths.append(longest)
+        # Rate of the longest motor for each unit of path speed
+        factors.append(longest/norm if norm > 0 else 1)
+        directions.append([delta/norm if norm > 0 else 0 for delta in deltas])
+
+    # Highest path speed allowed at each junction. junction[0] is the start of the path and junction[k+1] the end of move k
+    count = len(segments)
+    junction = [0.0]*(count + 1)
+    for k in range(count - 1):
+        if stops[k] or lengths[k] == 0 or lengths[k+1] == 0:
+            continue
+        speed = min(combined[k].max_rate()/factors[k], combined[k+1].max_rate()/factors[k+1])
+        for limit, before, after in zip(limits, directions[k], directions[k+1]):
+            change = abs(after - before)
+            if change > 0:
+                speed = min(speed, limit.start_rate()/change)
+        junction[k+1] = speed
+
+    # Backward pass: each move must be able to slow down to the speed at its end
+    for k in range(count - 1, -1, -1):
+        reachable = _max_reachable_rate(junction[k+1]*factors[k], lengths[k], combined[k])/factors[k]
+        junction[k] = min(junction[k], reachable)
+    # Forward pass: each move can only reach the speed that its start allows
+    for k in range(count):
+        reachable = _max_reachable_rate(junction[k]*factors[k], lengths[k], combined[k])/factors[k]
+        junction[k+1] = min(junction[k+1], reachable)
+
+    return [plan_profile(lengths[k], combined[k], junction[k]*factors[k], junction[k+1]*factors[k]) for k in range(count)]
@@ -8,14 +8,80 @@ import threading
 import os
 import random
 import json
+import contextlib
+from steppers import PinStepBackend, FirmataStepperBackend, home_axis
+from motionplanner import AxisLimits, plan_profile, combine_limits, plan_path
+from machinestate import MachineState
+from atomicjson import atomic_write_json
+from camerastream import CameraStream
+from focusmap import FocusMap, FocusSurface
+from focusmetrics import FocusScorer
+from focuscache import FocusCache, DEFAULTWINDOW
+from focusstack import FocusStacker
+from settledetector import SettleDetector
+from scanplanner import plan_grid, plan_scan, plan_tour
+from samplemask import Overview, select_tiles, OUTLINEMARGIN
+from focussearch import search_focus, correlate_frames, fit_peak, FocusResult
 
 # Constants
 STEPDISTXY = 0.212058/16 # linear distance moved in x and y each motor step (using 1/16 microstepping)
 STEPDISTZ = 0.01/4 # linear distance moved in z each motor step (using 1/4 microstepping)
 PULSEWIDTH = 100 / 1000000.0 # microseconds
 BTWNSTEPS = 1000 / 1000000.0
+STEPRATE = 1/(PULSEWIDTH + BTWNSTEPS) # default step rate in steps per second
 STAGEFOCUSHEIGHT = 36860*STEPDISTZ # z height at which the stage is in focus (this may change with calibration)
 STAGECENTRE = (8281, 7005) # Stage centre location in steps
+STATEFILE = "/home/microscope/machine_state.json" # position and homed status saved between restarts of rpmain.py
+FOCUSMAPFILE = "/home/microscope/focus_map.json" # stage focus surface measured by calibrate_platform
+FOCUSCACHEFILE = "/home/microscope/focus_cache.json" # best focus of each sample layer, used to narrow autofocus
+MAINSIZE = (4056, 3040) # full resolution stream size (saved images)
+LORESSIZE = (1014, 760) # low resolution YUV stream size (focus scores and motion checks)
+SENSORSIZE = (4056, 3040) # pixel array of the camera sensor (HQ camera)
+MMPERPIXEL = 0.00154 # mm of the stage imaged by each sensor pixel (recalibrate with a stage micrometer if the optics change)
+SCANOVERLAP = 0.2 # fraction of the field of view neighbouring scan tiles overlap by for stitching
+DETECTSIZE = (40, 40) # mm, area around the stage centre searched by detect_sample when the sample has no bounding box
+MANIFESTFILE = "tile_manifest.json" # tile positions of a scan (and which were skipped), saved with the images for stitching
+SAMPLINGATTEMPTS = 100 # random points tried per image before random sampling gives up on the sample outline
+
+# Capture profiles selected per job: sensor mode (output size read from the sensor), saved image size, low resolution
+# stream size and ScalerCrop (x, y, width, height of the sensor area used, None for the whole sensor).
+# Low resolution YUV420 stream sizes must have even widths and heights
+CAPTUREPROFILES = {
+    "full": {"sensor": SENSORSIZE, "main": MAINSIZE, "lores": LORESSIZE, "crop": None},
+    "binned": {"sensor": (2028, 1520), "main": (2028, 1520), "lores": LORESSIZE, "crop": None},
+    "roi": {"sensor": SENSORSIZE, "main": (2028, 1520), "lores": LORESSIZE, "crop": (1014, 760, 2028, 1520)},
+    "preview": {"sensor": (2028, 1520), "main": (1014, 760), "lores": (508, 380), "crop": None}
+}
+DEFAULTPROFILE = "full"
+
+# Motion limits used to plan acceleration profiles. The start velocity is the original fixed step rate which the motors can start at without ramping
+MAXVELOCITYXY = 40 # mm/s
+ACCELERATIONXY = 200 # mm/s^2
+JERKXY = 4000 # mm/s^3 (None for trapezoidal profiles)
+MAXVELOCITYZ = 5 # mm/s
+ACCELERATIONZ = 20 # mm/s^2
+JERKZ = None # mm/s^3
+
+# Two-phase homing: fast accelerated approach, back off, then slow re-approach for a precise home position
+HOMINGVELOCITYXY = 30 # mm/s
+HOMINGVELOCITYZ = 3 # mm/s
+HOMINGTRAVELXY = 250 # mm, longest distance the fast approach is planned for
+HOMINGTRAVELZ = 100 # mm
+HOMINGSLOWRATE = STEPRATE/3 # steps per second for the slow re-approach
+BACKOFFXY = 1 # mm
+BACKOFFZ = 0.25 # mm
+HOMINGHISTORY = 20 # number of homings used to calculate repeatability
+LIMITDEBOUNCE = 0.005 # s a limit switch must stay pressed before a press is reported (contact bounce, electrical noise)
+
+# Autofocus search (see focussearch.py)
+AUTOFOCUSSTRATEGY = "coarse_fine" # "coarse_fine", "golden_section", "hill_climb" or "sweep"
+AUTOFOCUSPEAKFIT = "parabolic" # "parabolic", "gaussian" or None
+SWEEPVELOCITYZ = 0.25 # mm/s, z speed of continuous focus sweeps (slow enough for several frames per depth of field)
+FOCUSLOGDIR = "/home/microscope/focus_logs" # step and frame timing of focus sweeps saved for validation
+FOCUSMETRIC = "laplacian" # "laplacian", "tenengrad", "brenner" or "normalised_variance" (see focusmetrics.py)
+STACKFRAMES = 5 # number of z heights captured for a focus stacked image
+STACKRANGE = 0.2 # mm, z range (centred on the current focus) covered by a focus stack
+REFINEFOCUSRANGE = 0.25 # mm either side of the focus surface searched when refining it on the sample
 
 class OpticalModule:
     """
@@ -30,6 +96,18 @@ class OpticalModule:
             limitSwitchX (LimitSwitch): Limit switch for x-axis (back right corner)
             limitSwitchY (LimitSwitch): Limit switch for y-axis (back left corner)
             limitSwitchZ (LimitSwitch): Limit switch for z-axis (z motor bracket)
+            stepper: Step generation backend (FirmataStepperBackend if the Arduino firmware supports it, otherwise PinStepBackend)
+            limitsXY (AxisLimits): Velocity, acceleration and jerk limits for motors A and B
+            limitsZ (AxisLimits): Velocity, acceleration and jerk limits for the z motor
+            predictedMoveTime: Predicted time (s) of the most recent go_to move or waypoint path
+            homingProfileXY (MotionProfile): Acceleration profile for the fast homing approach in x and y
+            homingProfileZ (MotionProfile): Acceleration profile for the fast homing approach in z
+            homingReport (dict): Time, steps and repeatability of the most recent homing of each axis
+            lastFocusSearch (FocusResult): Captures, time and result of the most recent autofocus search (None before the first)
+            motionBatch (int): Number of nested _motion_batch blocks running (the state is saved at the end of the outermost one)
+            waypoints (list): Queued (x, y, capture) waypoints in steps waiting for flush_waypoints
+            waypointLock (threading.Lock): Thread lock for adding or removing waypoints
+            cancelWaypoints (threading.Event): Threading event used to end flush_waypoints early without clearing homed status
             cam (Camera): Camera object containing camera methods and attributes
             currX (int): Current x position of the camera carriage in steps
             currY (int): Current y position of the camera carriage in steps
@@ -38,14 +116,17 @@ class OpticalModule:
             totalImages (int): Total number of images to be captured in the current operation
             currImageMetadata: System parameters to be saved when an image is captured
             bufferDir (str): Directory where images are saved to be transferred to the PC
+            machineState (MachineState): Position and homed status saved to STATEFILE so they survive restarts
             alarmStatus (str): Alarm status to be displayed in the GUI
             positionLock (threading.Lock): Thread lock for updating or reading current position
             imageCountLock (threading.Lock): Thread lock for updating or reading image count information
             alarmLock (threading.Lock): Thread lock for updating or reading alarmStatus
-            stop (threading.Event): Threading event used to indicate stop requested
+            stop (threading.Event): Threading event used to indicate stop requested (motors stop immediately and homing is required)
+            softStop (threading.Event): Threading event used to indicate a soft stop requested (motors slow down and the system stays homed)
             resetIdle (threading.Event): Threading event used to indicate that the module status should be reset to "Idle"
             isHomed (threading.Event): Threading event set when the system is homed; cleared if system is stopped or motors disabled
             motorsEnabled (threading.Event): Threading event to indicate whether motors are enabled
+            homing (threading.Event): Threading event set while an axis is homing (limit switch presses are expected)
 
     """
     def __init__(self):
@@ -63,15 +144,45 @@ class OpticalModule:
         self.motorA = StepperMotor(2, 5, self.board)
         self.motorB = StepperMotor(3, 6, self.board)
         self.motorZ = StepperMotor(4, 7, self.board)
+
+        # Generate step pulses on the Arduino if the firmware supports AccelStepperFirmata, otherwise toggle the step pins from here
+        self.stepper = FirmataStepperBackend.connect(self.board, [self.motorA, self.motorB, self.motorZ], STEPRATE)
+        if self.stepper is None:
+            print("AccelStepperFirmata not found, using pin stepping")
+            self.stepper = PinStepBackend(PULSEWIDTH, BTWNSTEPS)
+
+        # Motion limits for acceleration planning
+        self.limitsXY = AxisLimits(STEPDISTXY, STEPRATE*STEPDISTXY, MAXVELOCITYXY, ACCELERATIONXY, JERKXY)
+        self.limitsZ = AxisLimits(STEPDISTZ, STEPRATE*STEPDISTZ, MAXVELOCITYZ, ACCELERATIONZ, JERKZ)
+        self.predictedMoveTime = 0
+
+        # Fast approach profiles and results for homing
+        self.homingProfileXY = plan_profile(round(HOMINGTRAVELXY/STEPDISTXY), AxisLimits(STEPDISTXY, STEPRATE*STEPDISTXY, HOMINGVELOCITYXY, ACCELERATIONXY, JERKXY))
+        self.homingProfileZ = plan_profile(round(HOMINGTRAVELZ/STEPDISTZ), AxisLimits(STEPDISTZ, STEPRATE*STEPDISTZ, HOMINGVELOCITYZ, ACCELERATIONZ, JERKZ))
+        self.homingReport = {}
+        self.lastFocusSearch = None
+        self.focusSurface = None
+        self.scanPlan = None
+        self.samplingTour = None
+        self.overview = None
+        self._homingHistory = {"x": [], "y": [], "z": []}
+
+        # Waypoint queue for blending moves along scan paths
+        self.waypoints = []
+        self.waypointLock = threading.Lock()
+        self.cancelWaypoints = threading.Event()
         
         # Instantiate limit switch objects
-        self.limitSwitchX = LimitSwitch(9, self.board)
-        self.limitSwitchY = LimitSwitch(10, self.board)
-        self.limitSwitchZ = LimitSwitch(11, self.board)
+        self.limitSwitchX = LimitSwitch(9, self.board, "x")
+        self.limitSwitchY = LimitSwitch(10, self.board, "y")
+        self.limitSwitchZ = LimitSwitch(11, self.board, "z")
 
         # Instantiate Camera
         self.cam = Camera()
 
+        # Waits for the image to stop moving after each move before capturing
+        self.settleDetector = SettleDetector(self.cam.get_luma_frame, self.cam.stream.now)
+
         # Create variables to hold current position in terms of steps
         self.currX = 0 
         self.currY = 0
@@ -104,9 +215,71 @@ class OpticalModule:
         self.imageCountLock = threading.Lock()
         self.alarmLock = threading.Lock()
         self.stop = threading.Event()
+        self.softStop = threading.Event()
         self.resetIdle = threading.Event()
         self.isHomed = threading.Event()
         self.motorsEnabled = threading.Event()
+        self.homing = threading.Event()
+
+        # Direction (-1 towards the limit switch, 0 or 1 away) and target position in steps of each axis in the move in progress
+        self.commandedMove = {}
+
+        # Any limit switch press outside of homing stops the system (set once the events above exist)
+        self.limitSwitches = {}
+        for limitSwitch in (self.limitSwitchX, self.limitSwitchY, self.limitSwitchZ):
+            limitSwitch.onPress = self._limit_pressed
+            self.limitSwitches.setdefault(limitSwitch.pinNum // 8, []).append(limitSwitch)
+        self.board.add_cmd_handler(pyfirmata.DIGITAL_MESSAGE, self._handle_digital_message)
+
+        # Trust the position from the last session if the motors were never disabled, otherwise homing is required
+        self.machineState = MachineState(STATEFILE)
+        self.motionBatch = 0
+        if self.machineState.start_session():
+            self.currX, self.currY, self.currZ = self.machineState.currX, self.machineState.currY, self.machineState.currZ
+            self.motorsEnabled.set()
+            self.isHomed.set()
+            print(f"Session {self.machineState.session}: restored position ({self.currX}, {self.currY}, {self.currZ})")
+        else:
+            print(f"Session {self.machineState.session}: saved position not trusted, homing required")
+
+        # Stage tilt measured by calibrate_platform, used to set the focus height of each scan tile
+        self.focusMap = FocusMap(FOCUSMAPFILE)
+        self.focusMap.load()
+
+        # Focus found on earlier layers of each sample, used to predict the focus of the next layer
+        self.focusCache = FocusCache(FOCUSCACHEFILE)
+        self.focusCache.load()
+
+    def save_state(self, moving=False):
+        """
+        Saves the current position and homed status to the state file.
+        Parameters:
+            moving: True if a move is about to start (the saved position will not be trusted until the move is complete)
+        """
+        with self.positionLock:
+            position = (self.currX, self.currY, self.currZ)
+        self.machineState.update(*position, self.isHomed.is_set(), self.motorsEnabled.is_set(), moving)
+
+    @contextlib.contextmanager
+    def _motion_batch(self):
+        """
+        Internal context for operations made of many short moves (blended waypoint paths, autofocus steps). Every save of
+        the state file waits for the SD card, so inside the block the state is marked moving once before the first move
+        and the final position is saved once when the block ends, instead of before and after every move.
+        """
+        self.motionBatch = self.motionBatch + 1
+        try:
+            yield
+        finally:
+            self.motionBatch = self.motionBatch - 1
+            if self.motionBatch == 0:
+                self.save_state()
+
+    def shutdown(self):
+        """
+        Saves the machine state before the program exits so the next session can start without homing
+        """
+        self.save_state()
 
     def add_sample(self, mountType, sampleID, initialHeight, mmPerLayer, width, height):
         """
@@ -128,6 +301,7 @@ class OpticalModule:
         self.enPin.write(1)
         self.motorsEnabled.clear() # motors not enabled
         self.isHomed.clear() # system not homed
+        self.save_state()
 
     def enable_motors(self):
         """
@@ -135,62 +309,190 @@ class OpticalModule:
         """
         self.enPin.write(0)
         self.motorsEnabled.set() # motors are enabled
+        self.save_state()
 
-    def _move_ab(self, deltaA: int, deltaB: int):
+    def _move_ab(self, deltaA: int, deltaB: int, deltaZ: int = 0, profile=None):
         """
-        Internal method for moving the carriage in x and y
+        Internal method for moving the carriage in x and y. Motors A and B are interpolated so diagonal moves (where they step
+        different distances) are made in a single motion. The z motor can be stepped in the same loop.
 
         Parameters:
             deltaA: How far and which direction to move motor A in steps
             deltaB: How far and which direction to move motor B in steps        
+            deltaZ: How far and which direction to move motor Z in steps
+            profile: Already planned MotionProfile of the move (planned here if None)
         """
-        # Total number of steps to move the motors
-        # Because we are only moving in cartesian directions the number of steps by each motor will always be the same
-        # This may need to be changed in the future if diagonal or circular motion is required
-        steps = abs(deltaA)
-
-        # Set the direction of motors A and B
-        if deltaA >= 0:
-            self.motorA.dir_pin.write(1)
+        if deltaZ == 0:
+            self._run_motors([self.motorA, self.motorB], [deltaA, deltaB], [self.limitsXY, self.limitsXY], profile=profile)
         else:
-            self.motorA.dir_pin.write(0)
+            self._run_motors([self.motorA, self.motorB, self.motorZ], [deltaA, deltaB, deltaZ], [self.limitsXY, self.limitsXY, self.limitsZ], profile=profile)
 
-        if deltaB >= 0:
-            self.motorB.dir_pin.write(1)
-        else:
-            self.motorB.dir_pin.write(0)
+    def _plan_move(self, deltas, limits):
+        """
+        Internal method for planning the acceleration profile of motors moving together
+        
+        Parameters:
+            deltas: How far and which direction each motor moves in steps
+            limits: AxisLimits of each motor
+        Returns:
+            MotionProfile for the motor with the most steps
+        """
+        return plan_profile(max([abs(delta) for delta in deltas]), combine_limits(deltas, limits))
 
-        # Move the motors the required number of steps
-        for i in range(steps):
-            # Stop system if stop is requested
-            if self.stop.is_set():
-                self.resetIdle.set()
-                self.isHomed.clear()
-                return
-            self.motorA.step_pin.write(1)
-            self.motorB.step_pin.write(1)
-            time.sleep(PULSEWIDTH)
-            self.motorA.step_pin.write(0)
-            self.motorB.step_pin.write(0)
-            time.sleep(BTWNSTEPS)
+    def _run_motors(self, motors, deltas, limits, profile=None, rate=None, onStep=None):
+        """
+        Internal method for moving motors with the step generation backend using an acceleration profile. Handles stop requests and firmware errors.
 
+        Parameters:
+            motors: List of StepperMotor objects to move
+            deltas: How far and which direction to move each motor in steps
+            limits: AxisLimits of each motor used to plan the acceleration profile
+            profile: Already planned MotionProfile (eg. from the waypoint queue). Planned from limits if None
+            rate: Constant step rate (steps per second) used instead of an acceleration profile (eg. for focus sweeps)
+            onStep: Function called with the signed steps executed so far by each motor whenever the position is updated
+        """
+        if profile is None and rate is None:
+            profile = self._plan_move(deltas, limits)
+        with self.positionLock:
+            start = (self.currX, self.currY, self.currZ)
+
+        def update_position(executed):
+            # Convert the steps executed so far by each motor back into axis positions (based on CoreXY)
+            moved = dict(zip(motors, executed))
+            deltaA, deltaB = moved.get(self.motorA, 0), moved.get(self.motorB, 0)
+            with self.positionLock:
+                self.currX = start[0] + round(-(deltaA + deltaB)/2)
+                self.currY = start[1] + round((deltaB - deltaA)/2)
+                self.currZ = start[2] + moved.get(self.motorZ, 0)
+            if onStep is not None:
+                onStep(executed)
+
+        # Axis moves (based on CoreXY) so limit switch presses can be checked against the direction and target of the move.
+        # The switches are at the homed position (0) of each axis
+        moved = dict(zip(motors, deltas))
+        deltaA, deltaB = moved.get(self.motorA, 0), moved.get(self.motorB, 0)
+        axisDeltas = {"x": -(deltaA + deltaB)/2, "y": (deltaB - deltaA)/2, "z": moved.get(self.motorZ, 0)}
+        with self.positionLock:
+            self.commandedMove = {axis: (-1 if delta < 0 else (1 if delta > 0 else 0), start[i] + round(delta))
+                                  for i, (axis, delta) in enumerate(axisDeltas.items())}
 
-    def move_x(self, deltaX=0):
+        # The state file only needs marking once until the final position is saved
+        if not self.machineState.moving:
+            self.save_state(moving=True)
+        try:
+            self.stepper.move(motors, deltas, rate=rate, stopEvent=self.stop, profile=profile, softStopEvent=self.softStop, onStep=update_position)
+        except TimeoutError as e:
+            print(e)
+            with self.alarmLock:
+                self.alarmStatus = "Stepper Firmware Not Responding"
+            self.stop.set()
+        finally:
+            with self.positionLock:
+                self.commandedMove = {}
+
+        # Stop system if stop is requested. Motors may have lost steps so homing is required
+        if self.stop.is_set():
+            self.resetIdle.set()
+            self.isHomed.clear()
+        # Soft stops slow down first so the position is still known
+        elif self.softStop.is_set():
+            self.resetIdle.set()
+
+        # Moves inside a _motion_batch save the final position when the batch ends (or at a capture stop)
+        if self.motionBatch == 0 or self.stop.is_set():
+            self.save_state()
+
+    def _handle_digital_message(self, portNr, lsb, msb):
         """
-        Move system in the x-direction
+        Handles Firmata digital port reports on the pyfirmata iterator thread: updates the board's pins as pyfirmata does,
+        then passes the report to the limit switches on that port. (The handler must be a method as pyfirmata counts the
+        data bytes from its arguments.)
+        """
+        self.board._handle_digital_message(portNr, lsb, msb)
+        for limitSwitch in self.limitSwitches.get(portNr, []):
+            limitSwitch.update(lsb | msb << 7)
+
+    def _limit_pressed(self, limitSwitch):
+        """
+        Called from the LimitSwitch debounce timer when a limit switch has stayed pressed for LIMITDEBOUNCE. If the axis is
+        being driven towards its switch to anywhere other than the homed position (where the switch trips), the carriage
+        has hit the end of its travel, so the move in progress is aborted and the system must be homed again. Presses during
+        homing, while the axis is still or moving away from the switch, or on a move to the homed position are ignored.
+        The stop is not instant: on the pin stepping backend the move ends at the next step, on the firmware backend the stop
+        request is polled every 10 ms and the firmware STOP command then decelerates the motors at the acceleration of the move,
+        so the carriage travels on past the switch by the debounce and polling time plus the deceleration distance.
+        Parameters:
+            limitSwitch: LimitSwitch that was pressed
+        """
+        if self.homing.is_set():
+            return
+        with self.positionLock:
+            direction, target = self.commandedMove.get(limitSwitch.axis, (0, 0))
+        if direction >= 0 or target == 0:
+            return
+        print(f"Limit switch on pin {limitSwitch.pinNum} pressed")
+        with self.alarmLock:
+            self.alarmStatus = "Limit Switch Pressed"
+        self.stop.set()
+
+    def soft_stop(self):
+        """
+        Slows the motors to a stop and ends the current operation without losing the homed position, so the next operation
+        can start without homing. Queued waypoints are cleared.
+        """
+        self.softStop.set()
+        self.cancel_waypoints()
+
+    def _interrupted(self):
+        """
+        Returns:
+            True if a stop or soft stop has been requested
+        """
+        return self.stop.is_set() or self.softStop.is_set()
+
+    def _start_operation(self):
+        """
+        Internal method called at the start of operations which need the system homed. Homes only if the position is not known
+        (a soft stop keeps the system homed so the operation starts immediately).
+        """
+        self.softStop.clear()
+        if not self.isHomed.is_set() or self.stop.is_set():
+            self.home_all()
+
+    def _corexy_deltas(self, deltaX, deltaY):
+        """
+        Internal method converting a carriage move into motor moves (based on CoreXY)
+
+        Parameters:
+            deltaX: Distance to move in x-direction (in steps)
+            deltaY: Distance to move in y-direction (in steps)
+        Returns:
+            Tuple of steps for motors A and B
+        """
+        return -deltaX - deltaY, -deltaX + deltaY
+
+    def move_xy(self, deltaX=0, deltaY=0, deltaZ=0, profile=None):
+        """
+        Move system in x and y at the same time (diagonal moves take as long as the longest motor move instead of x then y)
         Parameters:
             deltaX: Distance to move in x-direction (in steps)
+            deltaY: Distance to move in y-direction (in steps)
+            deltaZ: Distance to move in z-direction in the same motion (in steps)
+            profile: Already planned MotionProfile of the move (planned here if None)
         """
         # Determine distance and direction to move each motor (based on CoreXY)
-        deltaA = -deltaX
-        deltaB = -deltaX
+        deltaA, deltaB = self._corexy_deltas(deltaX, deltaY)
 
-        # Update current position
-        with self.positionLock:
-            self.currX = self.currX + deltaX 
-        
-        # Move motors
-        self._move_ab(deltaA, deltaB)
+        # Move motors (current position is updated as each step is made)
+        self._move_ab(deltaA, deltaB, deltaZ, profile)
+
+    def move_x(self, deltaX=0):
+        """
+        Move system in the x-direction
+        Parameters:
+            deltaX: Distance to move in x-direction (in steps)
+        """
+        self.move_xy(deltaX=deltaX)
 
     # Moves carriage in y by a given linear distance (mm)
     def move_y(self,deltaY=0):
@@ -199,73 +501,161 @@ class OpticalModule:
         Parameters:
             deltaY: Distance to move in y-direction (in steps)
         """
-        # Determine distance and direction to move each motor (based on CoreXY)
-        deltaA = -deltaY
-        deltaB = deltaY
+        self.move_xy(deltaY=deltaY)
 
-        # Update current position
-        with self.positionLock:
-            self.currY = self.currY + deltaY
-        
-        # Move motors
-        self._move_ab(deltaA, deltaB)
-
-    def move_z(self, deltaZ=0):
+    def move_z(self, deltaZ=0, profile=None):
         """
         Move platform in z-direction
         Parameters:
             deltaZ: distance to move in the z-direction (in steps)
+            profile: Already planned MotionProfile of the move (planned here if None)
         """
-        # Find number of steps to move
-        steps = abs(deltaZ)
-
-        # Update current z-position
-        with self.positionLock:
-            self.currZ = self.currZ + deltaZ
-        
-        # Establish motion direction of motors
-        if deltaZ >= 0:
-            self.motorZ.dir_pin.write(1)
-        else:
-            self.motorZ.dir_pin.write(0)
-
-        # Move z motor by specified number of steps
-        for i in range(steps):
-            # Stop motion if stop is requested
-            if self.stop.is_set():
-                self.resetIdle.set()
-                self.isHomed.clear()
-                return
-            self.motorZ.step_pin.write(1)
-            time.sleep(PULSEWIDTH)
-            self.motorZ.step_pin.write(0)
-            time.sleep(BTWNSTEPS)
+        # Move z motor by specified number of steps (current position is updated as each step is made)
+        self._run_motors([self.motorZ], [deltaZ], [self.limitsZ], profile=profile)
     
-    def go_to(self, x=None, y=None, z=None):
+    def go_to(self, x=None, y=None, z=None, moveZWithXY=False):
         """
-        Moves system to specified (x, y, z) position (in mm)
+        Moves system to specified (x, y, z) position (in mm). x and y are moved together in a single (possibly diagonal) motion.
         Parameters:
             x: x position relative to homed position (mm)
             y: y position relative to homed position (mm)
             z: z position relative to homed position (mm)
+            moveZWithXY: If True z is stepped in the same motion as x and y, otherwise z moves after x and y
         """
         # If mm values are passed system calculates steps. If not remains at current position
         x = round(x/STEPDISTXY) if x is not None else self.currX
         y = round(y/STEPDISTXY) if y is not None else self.currY
         z = round(z/STEPDISTZ) if z is not None else self.currZ
+
+        # Plan the acceleration profiles once, for the predicted move time (published in the status) and the moves themselves
+        xyProfile, zProfile = self._plan_go_to(x - self.currX, y - self.currY, z - self.currZ, moveZWithXY)
+        self.predictedMoveTime = sum(profile.moveTime for profile in (xyProfile, zProfile) if profile is not None)
         
         # If new values are passed move to specified position
-        if not x == self.currX:
-            self.move_x(x-self.currX)
-
-        if not y == self.currY:
-            self.move_y(y-self.currY)
+        if not (x == self.currX and y == self.currY):
+            self.move_xy(x-self.currX, y-self.currY, z-self.currZ if moveZWithXY else 0, xyProfile)
 
         if not z == self.currZ:
-            self.move_z(z-self.currZ)
+            self.move_z(z-self.currZ, zProfile)
+
+    def predict_move_time(self, x=None, y=None, z=None, moveZWithXY=False):
+        """
+        Predicts how long go_to will take to reach a position using the planned acceleration profiles (no motion is made)
+        Parameters:
+            x: x position relative to homed position (mm)
+            y: y position relative to homed position (mm)
+            z: z position relative to homed position (mm)
+            moveZWithXY: If True z is stepped in the same motion as x and y
+        Returns:
+            Predicted move time in seconds
+        """
+        deltaX = round(x/STEPDISTXY) - self.currX if x is not None else 0
+        deltaY = round(y/STEPDISTXY) - self.currY if y is not None else 0
+        deltaZ = round(z/STEPDISTZ) - self.currZ if z is not None else 0
+        return sum(profile.moveTime for profile in self._plan_go_to(deltaX, deltaY, deltaZ, moveZWithXY) if profile is not None)
+
+    def _plan_go_to(self, deltaX, deltaY, deltaZ, moveZWithXY=False):
+        """
+        Internal method planning the acceleration profiles of the moves made by go_to
+        Parameters:
+            deltaX: Distance to move in x-direction (in steps)
+            deltaY: Distance to move in y-direction (in steps)
+            deltaZ: Distance to move in z-direction (in steps)
+            moveZWithXY: If True z is stepped in the same motion as x and y
+        Returns:
+            Tuple of MotionProfile for the x-y move and for the separate z move (None for moves that are not made)
+        """
+        deltaA, deltaB = self._corexy_deltas(deltaX, deltaY)
+        if deltaA == 0 and deltaB == 0:
+            return None, self._plan_move([deltaZ], [self.limitsZ]) if deltaZ != 0 else None
+        if moveZWithXY:
+            return self._plan_move([deltaA, deltaB, deltaZ], [self.limitsXY, self.limitsXY, self.limitsZ]), None
+        return (self._plan_move([deltaA, deltaB], [self.limitsXY, self.limitsXY]),
+                self._plan_move([deltaZ], [self.limitsZ]) if deltaZ != 0 else None)
 
 
 
+    def enqueue_waypoint(self, x, y, capture=True, z=None):
+        """
+        Adds an (x, y) position to the waypoint queue. Nothing moves until flush_waypoints is called.
+        Parameters:
+            x: x position relative to homed position (mm)
+            y: y position relative to homed position (mm)
+            capture: If True the carriage stops at this waypoint (eg. to take an image). If False the carriage keeps moving through it
+            z: Focus height (mm) to move to after arriving at a capture waypoint (z is not moved if None)
+        """
+        with self.waypointLock:
+            self.waypoints.append((round(x/STEPDISTXY), round(y/STEPDISTXY), capture, None if z is None else round(z/STEPDISTZ)))
+
+    def cancel_waypoints(self):
+        """
+        Clears the waypoint queue and ends a running flush_waypoints after its current move. Unlike stop, the system stays homed.
+        """
+        with self.waypointLock:
+            self.waypoints = []
+        self.cancelWaypoints.set()
+
+    def flush_waypoints(self, onCapture=None):
+        """
+        Moves through every queued waypoint. Moves between capture waypoints are planned together (lookahead) so the carriage
+        only slows down where the path turns sharply or where it has to stop at a capture waypoint.
+        Parameters:
+            onCapture: Function called with the waypoint index after arriving at each capture waypoint (eg. to take an image).
+                Moves after it are not started until it returns
+        Returns:
+            True if every waypoint was reached, False if the path was stopped or cancelled
+        """
+        with self.waypointLock:
+            waypoints = self.waypoints
+            self.waypoints = []
+        self.cancelWaypoints.clear()
+
+        # The state is saved at each capture stop and when the path ends, not at every junction of a blended path
+        with self._motion_batch():
+            return self._follow_waypoints(waypoints, onCapture)
+
+    def _follow_waypoints(self, waypoints, onCapture):
+        """
+        Internal method for flush_waypoints which moves through a list of (x, y, capture, z) waypoints in steps.
+        Returns:
+            True if every waypoint was reached, False if the path was stopped or cancelled
+        """
+        # The last waypoint is always a stop
+        if waypoints:
+            waypoints[-1] = (waypoints[-1][0], waypoints[-1][1], True, waypoints[-1][3])
+
+        index = 0
+        while index < len(waypoints):
+            # Collect moves up to and including the next capture waypoint
+            segments = []
+            with self.positionLock:
+                prevX, prevY = self.currX, self.currY
+            while index < len(waypoints):
+                x, y, capture, z = waypoints[index]
+                if not (x == prevX and y == prevY):
+                    segments.append(self._corexy_deltas(x - prevX, y - prevY))
+                prevX, prevY = x, y
+                index = index + 1
+                if capture:
+                    break
+
+            profiles = plan_path(segments, [self.limitsXY, self.limitsXY], [False]*(len(segments) - 1) + [True])
+            self.predictedMoveTime = sum(profile.moveTime for profile in profiles)
+            for (deltaA, deltaB), profile in zip(segments, profiles):
+                if self._interrupted() or self.cancelWaypoints.is_set():
+                    return False
+                self._run_motors([self.motorA, self.motorB], [deltaA, deltaB], [self.limitsXY, self.limitsXY], profile)
+
+            # Adjust the focus height for this waypoint (usually only a few steps between neighbouring tiles)
+            if z is not None and z != self.currZ and not self._interrupted():
+                self._run_motors([self.motorZ], [z - self.currZ], [self.limitsZ])
+
+            if self._interrupted() or self.cancelWaypoints.is_set():
+                return False
+            self.save_state()
+            if onCapture is not None:
+                onCapture(index - 1)
+        return True
 
     def move_to_preset_and_measure(self, num_measurements=2):
     # Move to a fixed preset position and take 1-2 measurements.
@@ -282,8 +672,7 @@ class OpticalModule:
         num_measurements = max(1, min(num_measurements, 2))
 
         # Home if needed
-        if (not self.isHomed.is_set()) or self.stop.is_set():
-            self.home_all()
+        self._start_operation()
 
         # Move to preset position
         self.go_to(x=preset_x, y=preset_y, z=preset_z)
@@ -294,11 +683,11 @@ class OpticalModule:
         results = []
 
         for i in range(num_measurements):
-            if self.stop.is_set():
+            if self._interrupted():
                 self.resetIdle.set()
                 break
 
-            img = self.cam.get_image_array(updateImage=False)
+            img = self.cam.get_luma_array()
             focus_score = self.cam.calculate_focus_score(imageArray=img)
 
             results.append({
@@ -330,152 +719,251 @@ class OpticalModule:
             return self.currZ*STEPDISTZ
         else: return 0
 
-    def home_xy(self):
+    def _home_axis(self, axis, motors, directions, limitSwitch, fastProfile, backoffSteps):
         """
-        Moves the camera carriage to the homed position in the x-y plane.
+        Internal method for homing one axis with a fast approach, back-off and slow re-approach. Records the homing time and
+        the repeatability (standard deviation of the slow re-approach steps over recent homings) in homingReport.
+        Parameters:
+            axis: Axis name ("x", "y" or "z")
+            motors: List of StepperMotor objects moving the axis
+            directions: Direction pin value (1 or 0) of each motor towards the limit switch
+            limitSwitch: LimitSwitch of the axis
+            fastProfile: MotionProfile for the fast approach
+            backoffSteps: Steps to back off the switch before the slow re-approach
+        Returns:
+            True if the axis was homed, False if homing was stopped or failed
         """
-        # This code was added to avoid a bug where the limit switch was not reset before homing
-        # This caused the system to attempt to home x without homing y first resulting in a crash
-        # By reading the limit switches several times it forces them to reset before homing
-        # There is probably a better solution for this but this method works.
-        for i in range(10):
-            if not self.limitSwitchY.is_pressed() and not self.limitSwitchX.is_pressed():
-                break
-            if i == 9:
-                print('limit reset failed')
+        # Limit switches are expected to press while homing so they must not stop the system
+        self.save_state(moving=True)
+        self.homing.set()
+        try:
+            result = home_axis(self.stepper, motors, directions, limitSwitch.is_pressed, fastProfile, HOMINGSLOWRATE, backoffSteps, self.stop)
+        finally:
+            self.homing.clear()
+        if result is None:
+            if not self.stop.is_set():
+                print(f"{axis} limit switch did not release after backing off")
                 with self.alarmLock:
                     self.alarmStatus = "Limit Switch Failed"
-        
+            return False
+
+        # Repeatability from the slow re-approach distance of recent homings
+        history = self._homingHistory[axis]
+        history.append(result.slowSteps)
+        del history[:-HOMINGHISTORY]
+        mean = sum(history)/len(history)
+        self.homingReport[axis] = result.to_dict()
+        self.homingReport[axis]["repeatability_steps"] = round((sum((steps - mean)**2 for steps in history)/len(history))**0.5, 2)
+        print(f"{axis} homed in {result.homingTime:.2f} s: {self.homingReport[axis]}")
+        return True
+
+    def home_xy(self):
+        """
+        Moves the camera carriage to the homed position in the x-y plane.
+        """
+        # Limit switch states come from Firmata reports so they no longer need to be reset before homing.
+        # A switch that is already pressed is backed off before the slow re-approach
         # Home Y axis
         print("Y")
-        self.motorA.dir_pin.write(1)
-        self.motorB.dir_pin.write(0)
-        while not self.limitSwitchY.is_pressed():
+        if not self._home_axis("y", [self.motorA, self.motorB], [1, 0], self.limitSwitchY, self.homingProfileXY, round(BACKOFFXY/STEPDISTXY)):
             # Allows system to stop if stop requested  
-            if self.stop.is_set():
-                self.resetIdle.set()
-                self.isHomed.clear()
-                return
-            self.motorA.step_pin.write(1)
-            self.motorB.step_pin.write(1)
-            time.sleep(PULSEWIDTH)
-            self.motorA.step_pin.write(0)
-            self.motorB.step_pin.write(0)
-            time.sleep(BTWNSTEPS)
+            self.resetIdle.set()
+            self.isHomed.clear()
+            return
         # Set current position to 0
         with self.positionLock:
             self.currY = 0
 
         # Home X axis
         print("X")
-        self.motorA.dir_pin.write(1)
-        self.motorB.dir_pin.write(1)
-        while not self.limitSwitchX.is_pressed():
-            if self.stop.is_set():
-                self.resetIdle.set()
-                self.isHomed.clear()
-                return      
-            self.motorA.step_pin.write(1)
-            self.motorB.step_pin.write(1)
-            time.sleep(PULSEWIDTH)
-            self.motorA.step_pin.write(0)
-            self.motorB.step_pin.write(0)
-            time.sleep(BTWNSTEPS)
+        if not self._home_axis("x", [self.motorA, self.motorB], [1, 1], self.limitSwitchX, self.homingProfileXY, round(BACKOFFXY/STEPDISTXY)):
+            self.resetIdle.set()
+            self.isHomed.clear()
+            return
         with self.positionLock:
             self.currX = 0
+        self.save_state()
     
     def home_all(self):
         """
         Moves system to home position in all axes. Also clears stop condition and resets homed status.
         """
         self.stop.clear() # clears stop condition
+        self.softStop.clear()
         self.enable_motors() # enable stepper motors
 
-        # Reset z limit switch (see HomeXY for details)
-        for i in range(10):
-            if not self.limitSwitchZ.is_pressed():
-                break
-            if i == 9:
-                print('limit reset failed')
-                with self.alarmLock:
-                    self.alarmStatus = "Limit Switch Failed"
-        
         # Home Z axis
         print("Z")
-        self.motorZ.dir_pin.write(0)
-        while not self.limitSwitchZ.is_pressed():
-            if self.stop.is_set():
-                self.resetIdle.set()
-                return      
-            self.motorZ.step_pin.write(1)
-            time.sleep(PULSEWIDTH)
-            self.motorZ.step_pin.write(0)
-            time.sleep(BTWNSTEPS)
+        if not self._home_axis("z", [self.motorZ], [0], self.limitSwitchZ, self.homingProfileZ, round(BACKOFFZ/STEPDISTZ)):
+            self.resetIdle.set()
+            return
         
         self.home_xy() # home x and y axes
         # Set Z position to 0
         with self.positionLock:
             self.currZ = 0
             self.isHomed.set() # system is homed
+        self.save_state()
 
     
-    def auto_focus(self, zMin=None, zMax=None, stepSize=None):
+    def auto_focus(self, zMin=None, zMax=None, stepSize=None, strategy=None, peakFit=None):
         """
-        Finds the best focus position in a given range of heights by calculating the focus score (laplacian variance) every step of a given mm size.
-        If no parameters are passed, the best focus position will be determined within +/- 1 mm of the current theoretical sample height with a step
-        size of 0.05 mm
+        Finds the best focus position in a given range of heights using the focus score (laplacian variance) of images captured at different heights.
+        If no parameters are passed, the best focus position will be determined with a step size of 0.05 mm within +/- 1 mm of the current
+        theoretical sample height, or around the focus predicted from earlier layers of the sample (see focuscache.py) with a window that
+        shrinks as the predictions get more accurate. If the best focus is at the edge of a narrowed window, the full window is searched
         Parameters:
             zMin: Lower bound of focus range (mm position)
             zMax: Upper bound of focus range (mm position)
-            stepSize: distance to move between each focus score calculation
+            stepSize: smallest distance to move between focus score calculations
+            strategy: Search strategy ("coarse_fine", "golden_section", "hill_climb" or "sweep" for a continuous sweep
+                using sweep_focus, AUTOFOCUSSTRATEGY if None)
+            peakFit: Fit used to find the peak between steps ("parabolic", "gaussian" or None, AUTOFOCUSPEAKFIT if None)
         Returns:
             Focus score of best position in range
         """
-        # Calculate the range based on current sample height if parameters are not passed
-        if zMin is None or zMax is None or stepSize is None:
-            zMin = STAGEFOCUSHEIGHT - self.currSample.get_curr_height() - 1 
-            zMax = STAGEFOCUSHEIGHT - self.currSample.get_curr_height() + 1 
+        # Calculate the range based on the focus of earlier layers or the current sample height if parameters are not passed
+        predicted = None
+        useCache = zMin is None or zMax is None or stepSize is None
+        if useCache:
+            sample = self.currSample
+            predicted = self.focusCache.predict(sample.sampleID, sample.currLayer, sample.mmPerLayer)
+            if predicted is None:
+                centre, halfWidth = STAGEFOCUSHEIGHT - sample.get_curr_height(), DEFAULTWINDOW
+            else:
+                centre, halfWidth = predicted, self.focusCache.window(sample.sampleID)
+            zMin, zMax = centre - halfWidth, centre + halfWidth
             stepSize = 0.05
-        bestFocusValue = -1
-        bestZPosition = zMin
 
-        # Convert all mm values to microns to allow for direct use of for loops
-        zMinMicron = int(zMin*1000)
-        zMaxMicron = int(zMax*1000)
-        stepSizeMicron = int(stepSize*1000)
+        if (strategy or AUTOFOCUSSTRATEGY) == "sweep":
+            bestScore = self.sweep_focus(zMin, zMax, peakFit=peakFit)
+        else:
+            def measure(z):
+                # Move to the z position using go_to and get the focus score
+                self.go_to(z=z)
+                return self.cam.calculate_focus_score()
+
+            # The state is saved once after the search instead of around every z step
+            with self._motion_batch():
+                result = search_focus(measure, zMin, zMax, stepSize, strategy or AUTOFOCUSSTRATEGY, 
+                                      peakFit if peakFit is not None else AUTOFOCUSPEAKFIT, self._interrupted)
+                if result is None:
+                    self.resetIdle.set()
+                    return
+                self.lastFocusSearch = result
+                print(f"Autofocus ({result.strategy}): {result.captures} captures in {result.wallTime:.2f} s, best z {result.bestZ:.4f} mm")
+
+                # Move to the z position with the best focus using go_to
+                self.go_to(z=result.bestZ)
+                bestScore = result.bestScore
+
+        if useCache and bestScore is not None:
+            bestZ = self.lastFocusSearch.bestZ
+            # The focus may be outside a narrowed window: search the full window and let the recorded error widen the next one
+            if predicted is not None and (zMax - zMin)/2 < DEFAULTWINDOW and min(bestZ - zMin, zMax - bestZ) < stepSize:
+                print("Autofocus: best focus at the edge of the predicted window, searching the full window")
+                bestScore = self.auto_focus(predicted - DEFAULTWINDOW, predicted + DEFAULTWINDOW, stepSize, strategy, peakFit)
+                if bestScore is None:
+                    return
+                bestZ = self.lastFocusSearch.bestZ
+            self.focusCache.record(self.currSample.sampleID, self.currSample.currLayer, bestZ, predicted)
 
-        # Move from zMin to zMax in steps of stepSize
-        for z in range(zMinMicron, zMaxMicron + stepSizeMicron, stepSizeMicron):
-            if self.stop.is_set():
-                self.resetIdle.set()
-                return
-            # Move to the current z position using go_to
-            self.go_to(z=z/1000)
+        return bestScore
+
+    def sweep_focus(self, zMin=None, zMax=None, velocity=SWEEPVELOCITYZ, peakFit=None):
+        """
+        Finds the best focus position by moving z at a constant speed through the range while the camera keeps streaming,
+        instead of stopping for every capture. The time of every step is logged on the frame timestamp clock and each
+        frame is matched to the z position at the middle of its exposure. The step and frame log is saved to FOCUSLOGDIR.
+        If no range is passed, the best focus position will be determined within +/- 1 mm of the current theoretical sample height
+        Parameters:
+            zMin: Lower bound of focus range (mm position)
+            zMax: Upper bound of focus range (mm position)
+            velocity: z speed (mm/s) of the sweep
+            peakFit: Fit used to find the peak between frames ("parabolic", "gaussian" or None, AUTOFOCUSPEAKFIT if None)
+        Returns:
+            Focus score of best position in range
+        """
+        if zMin is None or zMax is None:
+            zMin = STAGEFOCUSHEIGHT - self.currSample.get_curr_height() - 1 
+            zMax = STAGEFOCUSHEIGHT - self.currSample.get_curr_height() + 1 
+
+        self.go_to(z=zMin)
+        if self._interrupted():
+            return
+        start = time.perf_counter()
+        startZ = self.currZ
+        deltaZ = round(zMax/STEPDISTZ) - startZ
+
+        # Log the time of every step (the firmware backend only reports the end of the move, the sweep speed is constant in between)
+        stepLog = []
+        def log_step(executed):
+            stepLog.append((self.cam.stream.now(), executed[0]))
+
+        sweep = threading.Thread(target=self._run_motors, args=([self.motorZ], [deltaZ], [self.limitsZ]),
+                                 kwargs={"rate": velocity/STEPDISTZ, "onStep": log_step})
+        stepLog.append((self.cam.stream.now(), 0))
+        sweep.start()
+
+        # Score every frame exposed while z is moving
+        frames = []
+        after = stepLog[0][0]
+        while sweep.is_alive():
+            luma, metadata = self.cam.get_luma_frame(after)
+            exposureMiddle = metadata["SensorTimestamp"] + metadata.get("ExposureTime", 0)*500
+            frames.append((exposureMiddle, self.cam.calculate_focus_score(luma)))
+            after = metadata["SensorTimestamp"] + 1
+        sweep.join()
+        if self._interrupted():
+            return
 
-            # Get the focus score
-            focusScore = self.cam.calculate_focus_score()
-            # print(focusScore)
-            # Check if this focus value is the best so far
-            if focusScore > bestFocusValue:
-                bestFocusValue = focusScore
-                bestZPosition = z/1000
+        scores = [((startZ + steps)*STEPDISTZ, score) for steps, score in correlate_frames(stepLog, frames)]
+        self._save_sweep_log(stepLog, frames, scores, startZ, velocity)
+        if len(scores) < 3:
+            print(f"Focus sweep: only {len(scores)} frames during the sweep, slow the sweep down or increase the range")
+            self.go_to(z=(zMin + zMax)/2)
+            return
+        bestScore = max(score for z, score in scores)
+        result = FocusResult("sweep", fit_peak(scores, peakFit if peakFit is not None else AUTOFOCUSPEAKFIT), bestScore,
+                             len(scores), time.perf_counter() - start, scores)
+        self.lastFocusSearch = result
+        print(f"Focus sweep: {result.captures} frames in {result.wallTime:.2f} s "
+              f"({abs(zMax - zMin)/result.captures:.4f} mm per frame), best z {result.bestZ:.4f} mm")
 
-        # Move to the z position with the best focus using go_to
-        self.go_to(z=bestZPosition)
+        self.go_to(z=result.bestZ)
+        return bestScore
 
-        return bestFocusValue
+    def _save_sweep_log(self, stepLog, frames, scores, startZ, velocity):
+        """
+        Internal method for saving the step timing, frame timing and score against z of a focus sweep as JSON so the
+        correlation between steps and frames can be checked
+        """
+        data = {
+            "start_z": startZ*STEPDISTZ,
+            "velocity": velocity,
+            "steps": stepLog,
+            "frames": frames,
+            "scores": scores
+        }
+        try:
+            os.makedirs(FOCUSLOGDIR, exist_ok=True)
+            with open(os.path.join(FOCUSLOGDIR, f"sweep_{time.strftime('%Y%m%d_%H%M%S')}.json"), "w") as file:
+                json.dump(data, file)
+        except OSError as e:
+            print(f"Focus sweep log not saved: {e}")
     
-    def update_image_metadata(self, save=False):
+    def update_image_metadata(self, save=False, imageIndex=None):
         """
         Update image metadata based on current status
         Parameters:
             save: Will the metadata be saved to a .txt file in the buffer directory (boolean)
+            imageIndex: Image number (the camera image count if None)
         """
         self.currImageMetadata["image_name"] = self.cam.currImageName
         self.currImageMetadata["sample_id"] = self.currSample.sampleID
         self.currImageMetadata["timestamp"] = time.strftime("%Y%m%d_%H%M%S")  # Format: YYYYMMDD_HHMMSS
         self.currImageMetadata["sample_layer"] = self.currSample.currLayer
-        self.currImageMetadata["image_number"] = self.cam.imageCount
+        self.currImageMetadata["image_number"] = self.cam.imageCount if imageIndex is None else imageIndex
         self.currImageMetadata["image_x_pos"] = self.get_curr_pos_mm('x')
         self.currImageMetadata["image_y_pos"] = self.get_curr_pos_mm('y')
         self.currImageMetadata["image_z_pos"] = self.get_curr_pos_mm('z')
@@ -488,12 +976,25 @@ class OpticalModule:
             with open(filepath, "w") as file:
                 json.dump(self.currImageMetadata, file, indent=4)
 
-    def update_image(self):
+    def update_image(self, focusStack=False, imageIndex=None):
         """
         Captures image and saves image and metadata file to buffer directory
+        Parameters:
+            focusStack: If True, capture a focus stack around the current height (see capture_stack) and save the fused
+                image, with the depth index map saved as "<image name>_depth.png"
+            imageIndex: Image number used in the file name and metadata (the camera image count if None)
         """
         # Capture image
-        image = self.cam.update_curr_image(self.currSample)
+        depth = None
+        if focusStack:
+            image, depth = self.capture_stack()
+            if image is None:
+                return
+            self.cam.update_image_name(self.currSample, imageIndex)
+            with self.cam.imageLock:
+                self.cam.currImage = image
+        else:
+            image = self.cam.update_curr_image(self.currSample, imageIndex)
         filename = f"{self.cam.currImageName}.jpg"
         file_path = os.path.join(self.bufferDir, filename)
 
@@ -502,9 +1003,35 @@ class OpticalModule:
 
         # Save image and updated metadata
         cv2.imwrite(file_path, image_rgb)
-        self.update_image_metadata(True)
+        if depth is not None:
+            cv2.imwrite(os.path.join(self.bufferDir, f"{self.cam.currImageName}_depth.png"), depth)
+        self.update_image_metadata(True, imageIndex)
 
         return image
+
+    def capture_stack(self, numFrames=STACKFRAMES, zRange=STACKRANGE):
+        """
+        Captures frames at evenly spaced heights centred on the current z position and fuses them into one image with
+        everything in the range in focus. Frames are fused as they are captured, so only the fused image and the newest
+        frame are held at full resolution. The stage returns to the starting height afterwards.
+        Parameters:
+            numFrames: Number of heights captured
+            zRange: Distance (mm) between the lowest and highest capture
+        Returns:
+            Tuple of (fused image, depth map giving the index of the height each pixel was taken from, lowest first),
+            or (None, None) if stopped
+        """
+        startZ = self.get_curr_pos_mm('z')
+        stacker = FocusStacker()
+        for i in range(numFrames):
+            self.go_to(z=startZ - zRange/2 + i*zRange/max(numFrames - 1, 1))
+            if self._interrupted():
+                return None, None
+            frame = self.cam.get_image_array()
+            stacker.add(frame)
+            del frame
+        self.go_to(z=startZ)
+        return stacker.fused, stacker.depth_map()
     
 
     def random_sampling(self, numImages, saveImages: bool):
@@ -526,16 +1053,16 @@ class OpticalModule:
             return
         
         # Home system if stopped or not homed
-        if not self.isHomed.is_set() or self.stop.is_set():
-            self.home_all()
+        self._start_operation()
         
         # Move carriage to stage center and complete autofocus operation on sample
         self.go_to(x=STAGECENTRE[0]*STEPDISTXY, y=STAGECENTRE[1]*STEPDISTXY)
         self.auto_focus()
 
         # If the sample is not in position it will have a low focus score
-        # (this may need to be changed in the future as clean samples also have a low focus score)
-        if self.cam.calculate_focus_score() < 1:
+        # (this may need to be changed in the future as clean samples also have a low focus score).
+        # The median blur keeps sensor noise below the threshold the check was set with
+        if self.cam.calculate_focus_score(blur=5) < 1:
             print("Sample not detected or not in focus")
             with self.alarmLock:
                     self.alarmStatus = "Sample not detected or not in focus"
@@ -556,23 +1083,36 @@ class OpticalModule:
         min_x, max_x = min(x_coords), max(x_coords)
         min_y, max_y = min(y_coords), max(y_coords)
         
-        # Generate n random points within the bounding box
-        random_points = [(random.uniform(min_x, max_x), random.uniform(min_y, max_y)) for _ in range(numImages)]
+        # Generate n random points within the bounding box (and inside the sample outline if it was detected).
+        # A degenerate outline may hold almost none of the box, so the whole box is used once too many points are rejected
+        random_points = []
+        attempts = 0
+        while len(random_points) < numImages:
+            point = (random.uniform(min_x, max_x), random.uniform(min_y, max_y))
+            attempts = attempts + 1
+            if attempts > SAMPLINGATTEMPTS*numImages:
+                print(f"Only {len(random_points)} of {attempts} random points inside the sample outline, sampling the whole bounding box")
+                random_points = random_points + [(random.uniform(min_x, max_x), random.uniform(min_y, max_y)) for i in range(numImages - len(random_points))]
+                break
+            if self.currSample.contains(*point):
+                random_points.append(point)
         
         with self.imageCountLock:
             self.cam.imageCount = 0
+        self.settleDetector.reset()
 
-        for point in random_points:
-            # Stop program if stop requested
-            if self.stop.is_set():
-                self.resetIdle.set()
-                return
-            
-            # Go to the random position
-            self.go_to(x=point[0], y=point[1])
+        # Visit the random positions in a short tour from the current position ending near home (same points, different order)
+        tour = plan_tour(random_points, (self.get_curr_pos_mm('x'), self.get_curr_pos_mm('y')), (0, 0))
+        self.samplingTour = tour
+        print(f"Sampling tour: {tour.travel:.1f} mm ({tour.originalTravel - tour.travel:.1f} mm saved)")
 
-            # Allow system to stabilize 
-            time.sleep(0.5)
+        # Queue the random positions as capture waypoints
+        for point in tour.points:
+            self.enqueue_waypoint(point[0], point[1])
+
+        def capture(index):
+            # Wait until the image stops moving
+            self.settleDetector.wait(index)
 
             # Save images without or with metadata file (this should be changed in the future)
             if saveImages: 
@@ -585,6 +1125,11 @@ class OpticalModule:
                 self.cam.imageCount = self.cam.imageCount + 1
             capturedImages.append(cv2.cvtColor(imageArr, cv2.COLOR_BGR2RGB))
 
+        # Move through the waypoints taking an image at each one. Stop program if stop requested
+        if not self.flush_waypoints(capture):
+            self.resetIdle.set()
+            return
+
         # Reset image counters and increment current sample layer
         with self.imageCountLock:
             self.totalImages = 0
@@ -596,17 +1141,31 @@ class OpticalModule:
         self.home_xy()
         return capturedImages
     
-    def scanning_images(self, step_size_x, step_size_y, saveImages: bool):
+    def scanning_images(self, step_size_x, step_size_y, saveImages: bool, refineFocus: bool = False, focusStack: bool = False,
+                        serpentine: bool = True, scanOrder="auto", overlap=SCANOVERLAP, adaptive: bool = False, sampleBright: bool = True):
         """
         Takes a series of overlapping images to cover the entire area of the bounding box for image stitching.
+        The fewest tiles covering the bounding box are planned from the camera field of view (see scanplanner.plan_grid),
+        and the overlap they end up with is published in the scan plan for the stitching macro.
         Parameters:
-            step_size_x: How far (in mm) the camera carriage should move in the x-direction between images. 
-                X distance between the centre points of neighboring images
-            step_size_y: How far (in mm) the camera carriage should move in the y-direction between images. 
-                Y distance between the centre points of neighboring images
+            step_size_x: Largest distance (in mm) the camera carriage should move in the x-direction between images
+                (None to use the overlap instead). The step is shortened so the tiles fit the bounding box evenly
+            step_size_y: Largest distance (in mm) the camera carriage should move in the y-direction between images
+                (None to use the overlap instead)
             saveImages: should the images be saved? This was added to make defect detection possible in the future without saving all images; 
-                however, in its current state the program will save images regardless. Setting this parameter to True will save the images 
-                without metadata, False will save the images with metadata. This should be changed in the future.
+                however, in its current state the program will save images regardless, with metadata (see update_image). This should be
+                changed in the future.
+            refineFocus: If True, autofocus at the corners of the bounding box as well and fit the focus surface to the sample.
+                Otherwise the stage surface from calibrate_platform (if calibrated) is shifted to the focus height found at the centre
+            focusStack: If True, each tile is a focus stack around the tile focus height (see capture_stack)
+            serpentine: If True, every other line of tiles is visited in reverse instead of returning to the start of the line
+            scanOrder: "column" (x outer), "row" (y outer) or "auto" (whichever has fewer lines). Images are numbered by their
+                grid position (column by column, up and right, as the Fiji stitching macro expects) whatever order they are taken in
+            overlap: Smallest fraction of the field of view neighbouring images overlap by, for axes without a step size
+            adaptive: If True, an overview pass of low resolution frames finds the sample first and only tiles with sample in
+                them (plus a margin, see samplemask.py) are captured. Skipped tiles are listed in the tile manifest.
+                If the overview has too little contrast to find the sample, every tile is captured
+            sampleBright: True if the sample is brighter than the mounting resin and stage in the overview, False if darker
         """
         # Cancel the operation if no sample bounding box set
         if self.currSample is None or not self.currSample.boundingIsSet:
@@ -616,24 +1175,21 @@ class OpticalModule:
             return
 
         # Home system if stopped or not homed
-        if not self.isHomed.is_set() or self.stop.is_set():
-            self.home_all()
+        self._start_operation()
 
         # Move carriage to stage center and complete autofocus operation on sample
         self.go_to(x=STAGECENTRE[0]*STEPDISTXY, y=STAGECENTRE[1]*STEPDISTXY)
         self.auto_focus()
 
         # If the sample is not in position it will have a low focus score
-        # (this may need to be changed in the future as clean samples also have a low focus score)        
-        if self.cam.calculate_focus_score() < 1:
+        # (this may need to be changed in the future as clean samples also have a low focus score).
+        # The median blur keeps sensor noise below the threshold the check was set with
+        if self.cam.calculate_focus_score(blur=5) < 1:
             print("Sample not detected or not in focus")
             with self.alarmLock:
                     self.alarmStatus = "Sample not detected or not in focus"
             return
         
-        # Create list of captured images
-        capturedImages = []
-
         # Create list of X and Y positions to capture overlapping images covering the bounding box area
         x_coords = [point[0] for point in self.currSample.boundingBox]
         y_coords = [point[1] for point in self.currSample.boundingBox]
@@ -641,38 +1197,94 @@ class OpticalModule:
         min_x, max_x = min(x_coords), max(x_coords)
         min_y, max_y = min(y_coords), max(y_coords)
 
-        x_positions = list(range(int(min_x), int(max_x) + int(step_size_x), int(step_size_x)))
-        y_positions = list(range(int(min_y), int(max_y) + int(step_size_y), int(step_size_y)))
+        # Focus height of each tile from the stage tilt, passing through the focus found at the centre
+        centre = (self.get_curr_pos_mm('x'), self.get_curr_pos_mm('y'), self.get_curr_pos_mm('z'))
+        surface = self.focusMap.surface_through(*centre)
+        if refineFocus:
+            points = [centre]
+            for x, y in ((min_x, min_y), (min_x, max_y), (max_x, max_y), (max_x, min_y)):
+                self.go_to(x=x, y=y)
+                zFit = surface.z_at(x, y)
+                self.auto_focus(zFit - REFINEFOCUSRANGE, zFit + REFINEFOCUSRANGE, 0.05)
+                if self._interrupted():
+                    return
+                points.append((x, y, self.get_curr_pos_mm('z')))
+            surface = FocusSurface(points, "bilinear")
+        self.focusSurface = surface
+        print(f"Focus surface ({surface.model}): {surface.to_dict()['coefficients']}")
+
+        # Tiles covering the bounding box. A step size is the overlap it gives with the current field of view
+        fov = self.cam.field_of_view()
+        targets = [overlap if step is None else max(0.0, 1 - step/size) for step, size in zip((step_size_x, step_size_y), fov)]
+        try:
+            x_positions, y_positions, actualOverlap = plan_grid((min_x, max_x, min_y, max_y), fov, tuple(targets))
+        except ValueError as e:
+            print(e)
+            with self.alarmLock:
+                self.alarmStatus = "Invalid Scan Overlap"
+            return
+
+        # Overview pass: skip the tiles without sample in them
+        skip = set()
+        if adaptive:
+            overview = self.overview_scan((min_x, max_x, min_y, max_y), fov, surface, sampleBright)
+            if overview is None:
+                self.resetIdle.set()
+                return
+            grid = plan_scan(x_positions, y_positions).tiles
+            keep = select_tiles(grid, overview.tile_fractions(grid, fov))
+            if keep:
+                skip = {tile.index for tile in grid if tile.index not in keep}
+            else:
+                print(f"No sample found in the overview (contrast {overview.contrast:.0f}), capturing every tile")
+        elif self.currSample.boundingPolygon is not None:
+            # Skip the tiles outside the detected sample outline
+            skip = {tile.index for tile in plan_scan(x_positions, y_positions).tiles
+                    if not self.currSample.overlaps(tile.x, tile.y, fov[0], fov[1])}
+
+        # Plan the order the grid positions are visited in and queue them
+        plan = plan_scan(x_positions, y_positions, (self.get_curr_pos_mm('x'), self.get_curr_pos_mm('y')), serpentine, scanOrder,
+                         actualOverlap, skip)
+        self.scanPlan = plan
+        self.save_tile_manifest(plan, fov)
 
         # Set image counters to correct values
         with self.imageCountLock:
-            self.totalImages = len(x_positions) * len(y_positions)
+            self.totalImages = len(plan.tiles)
             self.cam.imageCount = 0
-        
-        # Loop through grid positions in up & right pattern
-        for x in x_positions:
-            for y in y_positions:
-                # Stop system if stop requested
-                if self.stop.is_set():
-                    self.resetIdle.set()
-                    return
-                
-                # Go to grid position
-                self.go_to(x=x, y=y)
+        self.settleDetector.reset()
 
-                # Allow system to stabilize
-                time.sleep(0.5)  
-                
-                # Save images without or with metadata file (this should be changed in the future)
-                if saveImages:
-                    imageArr = self.cam.save_image(self.saveDir, self.currSample)
-                else:    
-                    imageArr = self.update_image()
-
-                # Update image count and captured image list
-                with self.imageCountLock:
-                    self.cam.imageCount = self.cam.imageCount + 1
-                capturedImages.append(cv2.cvtColor(imageArr, cv2.COLOR_BGR2RGB))  
+        print(f"Scan plan: {plan.columns}x{plan.rows} tiles of {fov[0]:.2f}x{fov[1]:.2f} mm ({len(plan.skipped)} skipped), "
+              f"tile overlap {plan.tile_overlap()}%, "
+              f"{plan.major} order{' (serpentine)' if serpentine else ''}, "
+              f"travel {plan.travel:.1f} mm (column by column: {plan.rasterTravel:.1f} mm)")
+        for tile in plan.tiles:
+            self.enqueue_waypoint(tile.x, tile.y, z=surface.z_at(tile.x, tile.y))
+
+        # Create list of captured images (in grid order, None for skipped tiles)
+        capturedImages = [None]*(plan.columns*plan.rows)
+
+        def capture(index):
+            # Wait until the image stops moving
+            self.settleDetector.wait(index)
+
+            # Images are named by grid position so the stitching layout does not depend on the visiting order
+            tile = plan.tiles[index]
+            
+            # Save the image and metadata file (and the depth map of a focus stack) to the buffer directory
+            imageArr = self.update_image(focusStack, tile.index)
+            if imageArr is None:
+                return
+
+            # Update image count and captured image list
+            with self.imageCountLock:
+                self.cam.imageCount = self.cam.imageCount + 1
+            capturedImages[tile.index] = cv2.cvtColor(imageArr, cv2.COLOR_BGR2RGB)
+
+        # Move through the grid taking an image at each position. Stop system if stop requested
+        if not self.flush_waypoints(capture):
+            self.resetIdle.set()
+            return
         
         # Reset image counters and increment current sample layer
         with self.imageCountLock:
@@ -685,9 +1297,115 @@ class OpticalModule:
         self.home_xy()
         return capturedImages
         
+    def overview_scan(self, bounds, fov, surface=None, sampleBright=True):
+        """
+        Covers an area with low resolution frames, side by side without overlap, and pastes them into an overview mosaic.
+        Nothing is saved, each position only waits for the image to settle and takes one frame of the low resolution stream.
+        Parameters:
+            bounds: (min x, max x, min y, max y) of the area (mm)
+            fov: (width, height) of the field of view (mm)
+            surface: FocusSurface giving the focus height of each position (z is not moved if None)
+            sampleBright: True if the sample is brighter than its surroundings, False if darker
+        Returns:
+            Overview (also kept as self.overview), or None if stopped
+        """
+        x_positions, y_positions, unused = plan_grid(bounds, fov, 0)
+        plan = plan_scan(x_positions, y_positions, (self.get_curr_pos_mm('x'), self.get_curr_pos_mm('y')))
+        overview = Overview(bounds, bright=sampleBright)
+        for tile in plan.tiles:
+            self.enqueue_waypoint(tile.x, tile.y, z=surface.z_at(tile.x, tile.y) if surface is not None else None)
+
+        def capture(index):
+            self.settleDetector.wait()
+            luma, metadata = self.cam.get_luma_frame()
+            overview.add(luma, plan.tiles[index].x, plan.tiles[index].y, fov)
+
+        start = time.time()
+        if not self.flush_waypoints(capture):
+            return None
+        print(f"Overview: {len(plan.tiles)} frames in {time.time() - start:.1f} s")
+        self.overview = overview
+        return overview
+
+    def detect_sample(self, bounds=None, margin=OUTLINEMARGIN, sampleBright=True):
+        """
+        Finds the sample from a coarse overview and sets a tight bounding box and outline polygon for the current sample,
+        so scans and random sampling cover only the sample. The overview is thresholded into a sample mask and the outline
+        is the convex hull of the mask (see samplemask.py).
+        Parameters:
+            bounds: (min x, max x, min y, max y) of the area searched (mm). Defaults to the current bounding box of the sample,
+                or DETECTSIZE around the stage centre if no bounding box is set
+            margin: Distance (mm) added around the detected outline
+            sampleBright: True if the sample is brighter than the mounting resin and stage in the overview, False if darker
+        Returns:
+            Bounding box corners of the sample (see Sample.set_bounding_polygon), or None if no sample was found
+        """
+        if self.currSample is None:
+            print("No sample created. Cannot detect sample.")
+            with self.alarmLock:
+                    self.alarmStatus = "No Sample Created"
+            return
+
+        if bounds is None:
+            if self.currSample.boundingIsSet:
+                x_coords = [point[0] for point in self.currSample.boundingBox]
+                y_coords = [point[1] for point in self.currSample.boundingBox]
+                bounds = (min(x_coords), max(x_coords), min(y_coords), max(y_coords))
+            else:
+                centre = (STAGECENTRE[0]*STEPDISTXY, STAGECENTRE[1]*STEPDISTXY)
+                bounds = (centre[0] - DETECTSIZE[0]/2, centre[0] + DETECTSIZE[0]/2, centre[1] - DETECTSIZE[1]/2, centre[1] + DETECTSIZE[1]/2)
+
+        # Home system if stopped or not homed
+        self._start_operation()
+
+        # Focus at the stage centre, the rest of the overview follows the stage focus surface through it
+        self.go_to(x=STAGECENTRE[0]*STEPDISTXY, y=STAGECENTRE[1]*STEPDISTXY)
+        self.auto_focus()
+        if self._interrupted():
+            return
+        surface = self.focusMap.surface_through(self.get_curr_pos_mm('x'), self.get_curr_pos_mm('y'), self.get_curr_pos_mm('z'))
+
+        overview = self.overview_scan(bounds, self.cam.field_of_view(), surface, sampleBright)
+        if overview is None:
+            self.resetIdle.set()
+            return
+        outline = overview.sample_outline(margin)
+        if outline is None:
+            print(f"Sample not detected in the overview (contrast {overview.contrast:.0f})")
+            with self.alarmLock:
+                    self.alarmStatus = "Sample not detected"
+            return
+
+        box, polygon = outline
+        if box[0] <= bounds[0] or box[1] >= bounds[1] or box[2] <= bounds[2] or box[3] >= bounds[3]:
+            print("Sample reaches the edge of the searched area, it may be larger than the detected outline")
+        corners = self.currSample.set_bounding_polygon(polygon)
+        print(f"Sample detected: {box[1] - box[0]:.1f} x {box[3] - box[2]:.1f} mm (searched {bounds[1] - bounds[0]:.1f} x "
+              f"{bounds[3] - bounds[2]:.1f} mm), outline with {len(polygon)} corners")
+        return corners
+
+    def save_tile_manifest(self, plan, fov):
+        """
+        Writes the tile manifest of a scan plan (tile positions, and which tiles are skipped) to the image buffer folder
+        so it is transferred to the PC with the images.
+        Parameters:
+            plan: ScanPlan
+            fov: (width, height) of the field of view (mm)
+        """
+        pixelSize = fov[0]/CAPTUREPROFILES[self.cam.profile]["main"][0]
+        try:
+            os.makedirs(self.bufferDir, exist_ok=True)
+        except OSError as e:
+            print(f"Tile manifest not saved: {e}")
+            return
+        # Written atomically so an interrupted write cannot leave a truncated manifest for the stitcher
+        atomic_write_json(os.path.join(self.bufferDir, MANIFESTFILE), plan.manifest(fov, pixelSize), "Tile manifest")
+
     def calibrate_platform(self):
         """
-        Performs autofocus operation at four corners of the stage and returns focus height. This can be used in the future to assist with platform leveling
+        Performs autofocus operation at four corners of the stage and returns focus height. The heights are fitted with a
+        bilinear surface which is saved to the focus map and used by scanning_images to set the focus height of each tile.
+        This can also be used to assist with platform leveling
         Returns:
             List of in-focus heights (in steps) of the four corners of the platform
         """
@@ -717,6 +1435,11 @@ class OpticalModule:
         Z4 = self.currZ
         print(Z4)
 
+        # Save the stage focus surface
+        corners = [(49, 28), (46, 155), (173, 155.5), (172.5, 30)]
+        surface = self.focusMap.update([(x, y, z*STEPDISTZ) for (x, y), z in zip(corners, (Z1, Z2, Z3, Z4))], "bilinear")
+        print(f"Stage focus surface: {surface.to_dict()}")
+
         # Create and return list of heights
         zdistlist = [Z1,Z2,Z3,Z4]
         return zdistlist
@@ -819,19 +1542,40 @@ class OpticalModule:
         return T
         
 
-    def execute(self, targetMethod, **kwargs):
+    def execute(self, targetMethod, profile=None, **kwargs):
         """
         Calls specified method on a thread and resets module status to "Idle" when complete. 
         This method is meant to be used with methods that cause motion and its main purpose is to reset the module status.
         There is almost certainly a more lightweight way to do this with threading events and this method should be eliminated in the future.
         Parameters:
             targetMethod: Method in OpticalModule class to be called
+            profile: Capture profile (see CAPTUREPROFILES) used by the job. The current profile is kept if None
             kwargs: list of keyword arguments in the format {"keyword": "argument", "keyword2": "argument2"}
         """
         # Get the target method
         target = getattr(self, targetMethod, None)
 
         if callable(target):
+            # A soft stop only ends the operation that was running when it was requested
+            self.softStop.clear()
+
+            if profile is not None:
+                try:
+                    self.cam.set_profile(profile)
+                except ValueError as e:
+                    print(e)
+                    with self.alarmLock:
+                        self.alarmStatus = "Unknown Capture Profile"
+                    self.resetIdle.set()
+                    return
+                except Exception as e:
+                    # The camera rejected the configuration and was put back in the previous profile
+                    print(f"Capture profile '{profile}' not applied: {e}")
+                    with self.alarmLock:
+                        self.alarmStatus = "Capture Profile Rejected"
+                    self.resetIdle.set()
+                    return
+
             # Create thread for target method
             targetThread = threading.Thread(target=target, kwargs=kwargs, daemon=True)
             targetThread.start()
@@ -887,9 +1631,13 @@ class StepperMotor:
         board: pyfirmata Arduino board
         step_pin: pin used for motor step pulses
         dir_pin: pin used to set motor rotation direction
+        stepPinNum: Arduino pin number of step_pin (used to configure firmware stepping)
+        dirPinNum: Arduino pin number of dir_pin (used to configure firmware stepping)
     """
     def __init__(self, step_pin, dir_pin, board=pyfirmata.Arduino("/dev/ttyUSB0")):
         self.board = board
+        self.stepPinNum = step_pin
+        self.dirPinNum = dir_pin
         self.step_pin = board.get_pin(f'd:{step_pin}:o')
         self.dir_pin = board.get_pin(f'd:{dir_pin}:o')
 
@@ -898,11 +1646,15 @@ class Camera:
     Class for system camera. Contains camera settings information and related methods.
     Attributes:
         picam (Picamera2): Picamera object for system camera
+        stream (CameraStream): Keeps the camera streaming and returns frames exposed after a given time
         currExposureTime: Exposure time used when capturing images
         currAnalogGain: Analog gain applied to camera sensor data (1.0 = no gain)
         currContrast: Contrast adjustment applied to images (1.0 = no adjustment)
         currColourTemp: Lighting colour temperature (currently not implemented)
-        camera_config: Picamera camera configuration
+        camera_config: Picamera camera configuration of the current capture profile
+        profile: Name of the current capture profile (see CAPTUREPROFILES)
+        loresSize: Size of the low resolution stream of the current profile
+        configs (dict): Camera configuration of each profile used so far, so switching back does not rebuild it
         currImage: Most recently captured image
         currImageName: File name of most recently captured image
         imageCount: Number of images captured in current operation
@@ -919,32 +1671,46 @@ class Camera:
         self.currContrast = 1.0             # Default contrast (1.0 is neutral)
         self.currColourTemp = 6000          # Default colour temperature in Kelvin (ring light colour temp is 6000)
 
-        # Create camera configuration
+        # Create camera configuration with a full resolution stream for saved images and a small YUV stream
+        # whose luminance plane is used for focus scores
         # https://www.raspberrypi.com/documentation/accessories/camera.html
-        self.camera_config = self.picam.create_still_configuration({"size":(4056,3040)}) 
+        self.configs = {}
+        self.profile = DEFAULTPROFILE
+        self.camera_config = self._profile_config(DEFAULTPROFILE)
+        self.loresSize = CAPTUREPROFILES[DEFAULTPROFILE]["lores"]
         self.picam.configure(self.camera_config)
+
+        # Thread locking
+        self.settingsLock = threading.Lock()
+        self.imageLock = threading.Lock()
+
+        # Start the camera once and keep it streaming so captures do not pay the start up time
+        self.stream = CameraStream(self.picam, config=self.camera_config)
         self._apply_settings()
+        self.stream.start()
+
+        # Focus scoring with work arrays kept between frames
+        self.focusScorer = FocusScorer()
 
         # Misc Variables
         self.currImage = np.array([])
         self.currImageName = "None"
         self.imageCount = 0
 
-        # Thread locking
-        self.settingsLock = threading.Lock()
-        self.imageLock = threading.Lock()
-
 
     def update_settings(self, exposureTime=None, analogGain=None, contrast=None, colourTemperature=None):
         """
         Update the camera settings. For any parameter that is None, the existing setting is maintained. 
-        In testing, this method was not working and likely needs improvement.
+        Only controls that changed are sent to the camera. The next capture waits until the frame metadata shows
+        the new exposure time and gain are active (see CameraStream.set_controls).
         
         Parameters:
             exposureTime: New exposure time in microseconds.
             analogGain: New analogue gain (float).
             contrast: New contrast setting.
             colorTemperature: New color temperature in Kelvin.
+        Returns:
+            Token that can be passed to stream.wait_for_controls to wait for the settings to be active
         """
         with self.settingsLock:
             if exposureTime is not None:
@@ -957,75 +1723,119 @@ class Camera:
                 self.currColourTemp = colourTemperature
 
         # Re-apply all settings after updates.
-        self._apply_settings()
+        return self._apply_settings()
 
     def _apply_settings(self):
         """
         Convert the current color temperature to ColourGains using the RGB conversion algorithm
-        and apply all controls to the camera.
+        and apply all controls to the camera. Controls that have not changed are skipped.
         *Note: because the conversion from colour temp to gains was not working it is left out of the controls directory
+        Returns:
+            Control token from stream.set_controls
         """
         # Get red and blue gains calculated from the color temperature.
         redGain, blueGain = self._convert_temperature_to_gains(self.currColourTemp)
         
         # Build the controls dictionary.
-        controls = {
-            "ExposureTime": self.currExposureTime,
-            "AnalogueGain": self.currAnalogGain,
-            "Contrast": self.currContrast,
-        }
+        with self.settingsLock:
+            controls = {
+                "ExposureTime": self.currExposureTime,
+                "AnalogueGain": self.currAnalogGain,
+                "Contrast": self.currContrast,
+                "ScalerCrop": CAPTUREPROFILES[self.profile]["crop"] or (0, 0) + SENSORSIZE,
+            }
         #            "ColourGains": (redGain, blueGain)
-        # Apply the controls to the camera.
-        self.picam.set_controls(controls)
+        # Apply the changed controls to the camera.
+        return self.stream.set_controls(controls)
     
-    def update_curr_image(self, sample):
+    def _profile_config(self, name):
+        """Returns the camera configuration of a capture profile, creating it the first time the profile is used"""
+        if name not in self.configs:
+            profile = CAPTUREPROFILES[name]
+            self.configs[name] = self.picam.create_still_configuration(main={"size": profile["main"]},
+                                                                       lores={"size": profile["lores"], "format": "YUV420"},
+                                                                       sensor={"output_size": profile["sensor"]})
+        return self.configs[name]
+
+    def set_profile(self, name):
+        """
+        Switches to a capture profile (sensor mode, image size and crop). Nothing is done if the profile is already in use.
+        Parameters:
+            name: Name of a profile in CAPTUREPROFILES
+        Returns:
+            Control token from stream.set_controls (captures wait for the controls to be active again)
+        """
+        if name not in CAPTUREPROFILES:
+            raise ValueError(f"Unknown capture profile '{name}'")
+        if name == self.profile:
+            return self.stream.controlToken
+        config = self._profile_config(name)
+        try:
+            self.stream.reconfigure(config)
+        except Exception:
+            # The stream is back in the current profile, resend its controls before passing the error on
+            self._apply_settings()
+            raise
+        self.camera_config = config
+        self.profile = name
+        self.loresSize = CAPTUREPROFILES[name]["lores"]
+        print(f"Capture profile: {name}")
+        return self._apply_settings()
+
+    def field_of_view(self):
+        """Returns the (width, height) in mm of the stage area in the saved images of the current capture profile"""
+        crop = CAPTUREPROFILES[self.profile]["crop"] or (0, 0) + SENSORSIZE
+        return (crop[2]*MMPERPIXEL, crop[3]*MMPERPIXEL)
+
+    def update_curr_image(self, sample, imageCount=None):
         """
         Updates the currImageName and currImage fields of the Camera object
+        Parameters:
+            sample: Sample object - used to update image name
+            imageCount: Image number used in the name (imageCount field if not provided)
         """
-        self.update_image_name(sample)
+        self.update_image_name(sample, imageCount)
         return self.get_image_array(True)
 
-    def calculate_focus_score(self, imageArray=None, blur=5):
+    def calculate_focus_score(self, imageArray=None, blur=None, metric=None):
         """
-        Calculates the focus of an image using the Laplacian variance.
+        Calculates the focus of an image on a downsampled luminance view (see focusmetrics.py). Full resolution colour
+        images are reduced to the size of the low resolution stream before scoring, so no full size float arrays are created.
 
         Parameters:
-            imageArray: Image used to calculate focus score (image will be captured if not provided).
-            blur: level of blur applied (to reduce impact of noise)
+            imageArray: Image used to calculate focus score (the low resolution luminance image will be captured if not provided).
+            blur: level of median blur applied to greyscale images before scoring (to reduce impact of noise), none if None
+            metric: "laplacian", "tenengrad", "brenner" or "normalised_variance" (FOCUSMETRIC if None)
 
         Returns:
-            Focus score (Laplacian variance) 
+            Focus score (Laplacian variance by default)
         
         """
 
         if imageArray is None:
-            imageArray = self.get_image_array()
+            imageArray = self.get_luma_array()
 
         # Apply filter to image to reduce impact of noise
-        imageFiltered = cv2.medianBlur(imageArray, blur)
+        if blur and imageArray.ndim == 2:
+            imageArray = cv2.medianBlur(imageArray, blur)
 
-        # Apply the Laplacian filter to detect edges
-        laplacian = cv2.Laplacian(imageFiltered, cv2.CV_64F)
-
-        # Calculate the variance of the Laplacian (a measure of sharpness)
-        #print(laplacian.var())
-        return laplacian.var()
+        return self.focusScorer.score(imageArray, metric or FOCUSMETRIC)
     
-    def get_image_array(self, updateImage=False) -> any:
+    def get_image_array(self, updateImage=False, after=None) -> any:
         """
         Captures image from Raspberry Pi camera.
 
         Parameters:
             updateImage: Updates captured image to Camera object currImage field if True
+            after: Only return a frame whose exposure started after this time (ns, from stream.now()). 
+                Defaults to the time of the call so frames exposed during a previous move are not used
 
         Returns:
             Captured image as an array
 
         """
         try:
-            self.picam.start()
-            array = self.picam.capture_array("main")
-            self.picam.stop()
+            array, metadata = self.stream.request_frame(after)
 
             if updateImage:
                 with self.imageLock:
@@ -1037,7 +1847,53 @@ class Camera:
             print(f"Error capturing image: {e}")
             return ""
     
-    def save_image(self, dir: str, sample, image=None):
+    def get_luma_array(self, after=None):
+        """
+        Captures the luminance (Y) plane of the low resolution YUV stream. This is much smaller than a full resolution
+        colour image so it is used wherever the image is only analysed (eg. focus scores).
+
+        Parameters:
+            after: Only return a frame whose exposure started after this time (ns, from stream.now()). Defaults to the time of the call
+
+        Returns:
+            Greyscale image as a 2D array
+        """
+        return self.get_luma_frame(after)[0]
+
+    def get_luma_frame(self, after=None):
+        """
+        Captures the luminance (Y) plane of the low resolution YUV stream together with the frame metadata.
+
+        Parameters:
+            after: Only return a frame whose exposure started after this time (ns, from stream.now()). Defaults to the time of the call
+
+        Returns:
+            Tuple of (greyscale image as a 2D array, frame metadata dictionary)
+        """
+        array, metadata = self.stream.request_frame(after, "lores")
+        # YUV420 arrays hold the full size Y plane followed by the U and V planes
+        return array[:self.loresSize[1], :self.loresSize[0]], metadata
+
+    def benchmark_focus_score(self, repeats=10):
+        """
+        Times one focus step (capture and focus score) using the full resolution colour stream and the low resolution luminance stream.
+
+        Parameters:
+            repeats: Number of focus steps timed for each stream
+
+        Returns:
+            Dictionary with the mean time (s) per focus step for each stream
+        """
+        results = {}
+        for name, capture in (("main", self.get_image_array), ("lores", self.get_luma_array)):
+            start = time.perf_counter()
+            for i in range(repeats):
+                self.calculate_focus_score(imageArray=capture())
+            results[name] = (time.perf_counter() - start)/repeats
+        print(f"Focus step time: full resolution {results['main']:.3f} s, low resolution {results['lores']:.3f} s")
+        return results
+
+    def save_image(self, dir: str, sample, image=None, imageCount=None):
         """
         Captures an image using Picamera2 and saves it to the specified directory.
 
@@ -1045,6 +1901,7 @@ class Camera:
             dir: Directory to save image as a string
             sample: Sample object - used to update image name
             image: Optionally pass image array to be saved
+            imageCount: Image number used in the name (imageCount field if not provided)
 
         Returns:
             image as an array
@@ -1055,7 +1912,7 @@ class Camera:
 
         # Generate a unique filename using timestamp
         timestamp = time.strftime("%Y%m%d_%H%M%S")  # Format: YYYYMMDD_HHMMSS
-        imageName = self.update_image_name(sample)
+        imageName = self.update_image_name(sample, imageCount)
         filename = f"{imageName}_{timestamp}.jpg"
         file_path = os.path.join(dir, filename)
 
@@ -1155,26 +2012,60 @@ class Camera:
 class LimitSwitch:
     """
     Class for limit switches. Includes pin information and method to read switch status.
+    The switch state is updated from Firmata digital port reports (OpticalModule passes each report for the port of the switch
+    to update on the pyfirmata iterator thread) and latched into threading events, so reading it does not need any serial communication. A press is only reported to onPress once the switch has
+    stayed pressed for LIMITDEBOUNCE, so contact bounce and noise do not stop the system (or report one press several times).
     Attributes:
         board: Pyfirmata Arduino board
         pin: Arduino digital pin connected to limit switch
+        pinNum: Arduino digital pin number
+        axis: Axis ("x", "y" or "z") the switch is the end stop of
+        pressed (threading.Event): Set while the switch is pressed (not debounced)
+        onPress: Function called with this LimitSwitch when the switch is pressed (None to ignore presses)
     """
-    def __init__(self, pin, board=pyfirmata.Arduino("/dev/ttyUSB0")):
+    def __init__(self, pin, board=pyfirmata.Arduino("/dev/ttyUSB0"), axis=None):
         self.board = board
+        self.pinNum = pin
+        self.axis = axis
         self.board.digital[pin].write(1)
         self.pin = self.board.get_pin(f'd:{pin}:i')
+        self.pressed = threading.Event()
+        self.onPress = None
+        self._debounce = None
 
-    def is_pressed(self):
-        """Returns True if the switch is triggered."""
+        # The switch pulls the pin low when pressed. Use the last known state until the first report arrives
+        if self.pin.read() == 0:
+            self.pressed.set()
 
-        state = self.pin.read() == 0
+        self.pin.enable_reporting()
 
-        # Manually reset pin state due to a quirk with pyfirmata where pin status never resets once pressed
-        if self.pin.read() == 0:
-            self.pin.mode = 1
-            self.pin.write(1)
-            self.pin.mode = 0
-        return state 
+    def update(self, portValue):
+        """
+        Latches presses and releases of this switch from a Firmata digital port report.
+        Parameters:
+            portValue: Pin states of the port the switch is on (bit n is pin n of the port)
+        """
+        isPressed = (portValue >> (self.pinNum % 8)) & 1 == 0
+        if isPressed and not self.pressed.is_set():
+            self.pressed.set()
+            # Report the press from a timer so the iterator thread keeps reading while the switch settles
+            self._debounce = threading.Timer(LIMITDEBOUNCE, self._confirm_press)
+            self._debounce.daemon = True
+            self._debounce.start()
+        elif not isPressed:
+            self.pressed.clear()
+            if self._debounce is not None:
+                self._debounce.cancel()
+                self._debounce = None
+
+    def _confirm_press(self):
+        """Reports a press to onPress if the switch is still pressed once the debounce time has passed"""
+        if self.pressed.is_set() and self.onPress is not None:
+            self.onPress(self)
+
+    def is_pressed(self):
+        """Returns True if the switch is triggered."""
+        return self.pressed.is_set()
 
 class Sample:
     """
@@ -1185,6 +2076,7 @@ class Sample:
         mmPerLayer (float): Millimeters of material removed at each polishing step
         sampleHeight (float): The initial z height of the sample in mm - how far above the stage is the surface of the sample
         boundingBox: List of tuples representing the (x, y) coordinates of the bounding box corners.
+        boundingPolygon: List of (x, y) corners (mm) of the sample outline inside the bounding box, None if the whole box is used
         boundingIsSet: True if bounding box is set for the sample
         currLayer (int): The current layer of the sample (how many polishing steps have been completed)
     """
@@ -1194,6 +2086,7 @@ class Sample:
         self.mmPerLayer = mmPerLayer
         self.sampleHeight = initialHeight
         self.boundingBox = [(0,0), (0,0), (0,0), (0,0)]
+        self.boundingPolygon = None
         self.boundingIsSet = False
         self.set_bounding_box(width, height)
         self.currLayer = 0
@@ -1223,9 +2116,58 @@ class Sample:
         top_left     = (center_x_mm - half_width, center_y_mm + half_height)
         
         self.boundingBox = [bottom_left, bottom_right, top_right, top_left]
+        self.boundingPolygon = None
         self.boundingIsSet = True
         return self.boundingBox
 
+    def set_bounding_polygon(self, polygon):
+        """
+        Sets the bounding box to the smallest box around a sample outline and keeps the outline, so positions outside it
+        can be skipped.
+
+        Parameters:
+            polygon: List of (x, y) corners (mm) of the sample outline (at least three)
+        Returns:
+            List of tuples representing the (x, y) coordinates of the bounding box corners.
+            Order: [bottom left, bottom right, top right, top left]
+        """
+        if len(polygon) < 3:
+            raise ValueError("A bounding polygon needs at least three corners")
+        x_coords = [point[0] for point in polygon]
+        y_coords = [point[1] for point in polygon]
+        min_x, max_x = min(x_coords), max(x_coords)
+        min_y, max_y = min(y_coords), max(y_coords)
+
+        self.boundingBox = [(min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y)]
+        self.boundingPolygon = [(float(x), float(y)) for x, y in polygon]
+        self.boundingIsSet = True
+        return self.boundingBox
+
+    def contains(self, x, y):
+        """Returns True if a position (mm) is inside the bounding polygon (always True without a polygon)"""
+        if self.boundingPolygon is None:
+            return True
+        inside = False
+        corners = self.boundingPolygon
+        for (x0, y0), (x1, y1) in zip(corners, corners[1:] + corners[:1]):
+            # Count the edges a ray from the point towards +x crosses
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0)*(x1 - x0)/(y1 - y0):
+                inside = not inside
+        return inside
+
+    def overlaps(self, x, y, width, height):
+        """
+        Returns True if a rectangle centred on a position (eg. the field of view of a tile) overlaps the bounding polygon
+        (always True without a polygon). The rectangle is checked at its corners, edge midpoints and centre, and for
+        polygon corners inside it.
+        """
+        if self.boundingPolygon is None:
+            return True
+        points = [(x + dx*width/2, y + dy*height/2) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+        if any(self.contains(px, py) for px, py in points):
+            return True
+        return any(abs(px - x) <= width/2 and abs(py - y) <= height/2 for px, py in self.boundingPolygon)
+
     def get_curr_height(self):
         """Returns the current height of the sample based on the number of layers removed"""
         return self.sampleHeight - (self.mmPerLayer * self.currLayer)
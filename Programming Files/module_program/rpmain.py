@@ -5,7 +5,8 @@ import time
 import json
 import threading
 
-from opticalmodule import OpticalModule
+from opticalmodule import OpticalModule, SCANOVERLAP
+from samplemask import OUTLINEMARGIN
 
 #----------------------Zero MQ setup and communication -----------------------------#
 
@@ -38,7 +39,18 @@ status_data = {
     "curr_sample_id": "None",
     "total_image": 0,
     "image_count": 0,
-    "motors_enabled" : shabam.motorsEnabled.is_set()
+    "motors_enabled" : shabam.motorsEnabled.is_set(),
+    "predicted_move_time" : 0,
+    "step_timing" : None,
+    "homing_report" : {},
+    "focus_search" : None,
+    "focus_surface" : None,
+    "settle" : None,
+    "capture_profile" : shabam.cam.profile,
+    "scan_plan" : None,
+    "sampling_tour" : None,
+    "bounding_box" : None,
+    "bounding_polygon" : None
 }
 
 
@@ -69,6 +81,21 @@ def update_status_data():
         status_data["x_pos"] = shabam.get_curr_pos_mm('x')
         status_data["y_pos"] = shabam.get_curr_pos_mm('y')
         status_data["z_pos"] = shabam.get_curr_pos_mm('z')
+        status_data["predicted_move_time"] = shabam.predictedMoveTime
+
+    # Update measured step timing of the last move (None when the Arduino generates the steps)
+    timing = shabam.stepper.lastTiming
+    status_data["step_timing"] = timing.to_dict() if timing is not None else None
+    status_data["homing_report"] = shabam.homingReport
+    status_data["focus_search"] = shabam.lastFocusSearch.to_dict() if shabam.lastFocusSearch is not None else None
+    status_data["focus_surface"] = shabam.focusSurface.to_dict() if shabam.focusSurface is not None else None
+    status_data["settle"] = shabam.settleDetector.summary()
+    status_data["capture_profile"] = shabam.cam.profile
+    status_data["scan_plan"] = shabam.scanPlan.to_dict() if shabam.scanPlan is not None else None
+    status_data["sampling_tour"] = shabam.samplingTour.to_dict() if shabam.samplingTour is not None else None
+    if shabam.currSample is not None and shabam.currSample.boundingIsSet:
+        status_data["bounding_box"] = shabam.currSample.boundingBox
+        status_data["bounding_polygon"] = shabam.currSample.boundingPolygon
     
     # Update camera settings data
     with shabam.cam.settingsLock:
@@ -151,6 +178,7 @@ def handle_request():
                 status_data["total_image"] = message["total_image"]
                 status_data["image_count"] = 0
                 thread = threading.Thread(target=shabam.execute, kwargs={"targetMethod": "random_sampling", 
+                                                                         "profile": message.get("profile"),
                                                                          "numImages": message["total_image"], 
                                                                          "saveImages": False})
                 thread.start()
@@ -163,9 +191,33 @@ def handle_request():
                 status_data["image_count"] = 0
                 
                 thread = threading.Thread(target=shabam.execute, kwargs={"targetMethod": "scanning_images", 
-                                                                         "step_size_x": message["step_x"], 
-                                                                         "step_size_y": message["step_y"], 
-                                                                         "saveImages": False})
+                                                                         "profile": message.get("profile"),
+                                                                         "step_size_x": message.get("step_x"), 
+                                                                         "step_size_y": message.get("step_y"), 
+                                                                         "overlap": message.get("overlap", SCANOVERLAP),
+                                                                         "adaptive": message.get("adaptive", False),
+                                                                         "sampleBright": message.get("sample_bright", True),
+                                                                         "saveImages": False,
+                                                                         "refineFocus": message.get("refine_focus", False),
+                                                                         "focusStack": message.get("focus_stack", False),
+                                                                         "serpentine": message.get("serpentine", True),
+                                                                         "scanOrder": message.get("scan_order", "auto")})
+                thread.start()
+
+            # Find the sample from an overview and set a tight bounding box around it
+            if message["command"] == "exe_detect_sample" and not thread.is_alive():
+                status_data["module_status"] = "Detecting Sample"
+                thread = threading.Thread(target=shabam.execute, kwargs={"targetMethod": "detect_sample",
+                                                                         "profile": message.get("profile"),
+                                                                         "bounds": message.get("bounds"),
+                                                                         "margin": message.get("margin", OUTLINEMARGIN),
+                                                                         "sampleBright": message.get("sample_bright", True)})
+                thread.start()
+
+            # Measure the stage focus surface at the four corners of the stage
+            if message["command"] == "exe_calibrate_platform" and not thread.is_alive():
+                status_data["module_status"] = "Calibrating Platform"
+                thread = threading.Thread(target=shabam.execute, kwargs={"targetMethod": "calibrate_platform"})
                 thread.start()
 
             # Home XY position
@@ -208,7 +260,9 @@ def handle_request():
 
             # Capture and save a single image to the buffer directory
             if message["command"] == "exe_update_image" and not thread.is_alive():
-                thread = threading.Thread(target=shabam.update_image)
+                thread = threading.Thread(target=shabam.execute, kwargs={"targetMethod": "update_image",
+                                                                         "profile": message.get("profile"),
+                                                                         "focusStack": message.get("focus_stack", False)})
                 thread.start()
             
             # Reset module alarm status
@@ -222,6 +276,11 @@ def handle_request():
                 shabam.stop.set()
                 status_data["module_status"] = "Idle"
 
+            # Slow motors to a stop and end the current operation while keeping the system homed
+            if message["command"] == "exe_soft_stop":
+                status_data["module_status"] = "Stopping..."
+                shabam.soft_stop()
+
             rep_socket.send_json(response)  # Acknowledge request
 
         # This was created when this function used a non-blocking receive can probably be removed
@@ -245,4 +304,5 @@ try:
         time.sleep(1)  # Keep the main thread alive
 except KeyboardInterrupt:
     print("Server interrupted and shutting down.")
+    shabam.shutdown()
 
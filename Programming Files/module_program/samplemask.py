@@ -0,0 +1,171 @@
+"""
+Finds where the sample is inside the scan area from a coarse overview, so tiles that only show mounting resin or empty
+stage can be skipped. Low resolution frames taken across the bounding box are pasted into a mosaic in stage mm, which is
+thresholded (Otsu) into a sample mask. If the two Otsu classes are too close in brightness to tell sample from background,
+the mask is left empty so every tile is captured. The top of a frame is towards +y, the layout the stitching macro assumes.
+The mask is also used to find a tight outline of the sample (sample_outline) for the sample bounding box.
+"""
+import cv2
+import numpy as np
+
+OVERVIEWRESOLUTION = 0.05 # mm per pixel of the overview mosaic
+MINCONTRAST = 20 # grey levels between the mean of the two Otsu classes needed to tell the sample from the background
+MASKCLOSE = 0.5 # mm, gaps in the sample mask closed (scratches, pores, dark phases)
+MINSAMPLEAREA = 1.0 # mm^2, smaller regions of the mask are ignored (dust, reflections)
+OCCUPIEDFRACTION = 0.01 # fraction of a tile that must be sample for the tile to be captured
+TILEMARGIN = 1 # tiles kept around every occupied tile
+OUTLINEMARGIN = 0.5 # mm added around a detected sample outline
+OUTLINETOLERANCE = 0.25 # mm, largest distance between the detected outline and the simplified polygon
+
+
+class Overview:
+    """
+    Mosaic of low resolution frames covering a bounding box.
+    Attributes:
+        bounds: (min x, max x, min y, max y) of the mosaic (mm)
+        resolution: mm per mosaic pixel
+        image: uint8 greyscale mosaic, row 0 at the highest y
+        filled: True where the mosaic has been covered by a frame
+        bright (bool): True if the sample is brighter than its surroundings (a polished sample in reflected light is brighter
+            than the mounting resin and stage)
+        mask: Sample mask (bool array the size of the mosaic), None until sample_mask is called
+        contrast: Difference (grey levels) between the mean of the two Otsu classes, None until sample_mask is called
+    """
+    def __init__(self, bounds, resolution=OVERVIEWRESOLUTION, bright=True):
+        self.bounds = bounds
+        self.resolution = resolution
+        self.bright = bright
+        minX, maxX, minY, maxY = bounds
+        size = (max(1, round((maxY - minY)/resolution)), max(1, round((maxX - minX)/resolution)))
+        self.image = np.zeros(size, np.uint8)
+        self.filled = np.zeros(size, bool)
+        self.mask = None
+        self.contrast = None
+
+    def to_pixel(self, x, y):
+        """Returns the (column, row) mosaic pixel of a stage position (mm)"""
+        return (x - self.bounds[0])/self.resolution, (self.bounds[3] - y)/self.resolution
+
+    def to_stage(self, column, row):
+        """Returns the stage position (mm) of a mosaic pixel"""
+        return self.bounds[0] + column*self.resolution, self.bounds[3] - row*self.resolution
+
+    def _window(self, x, y, width, height):
+        """Returns the (row, column) slices of the mosaic covered by a rectangle centred on a stage position (mm)"""
+        left, top = self.to_pixel(x - width/2, y + height/2)
+        right, bottom = self.to_pixel(x + width/2, y - height/2)
+        rows, columns = self.image.shape
+        return (slice(max(0, round(top)), min(rows, round(bottom))), slice(max(0, round(left)), min(columns, round(right))))
+
+    def add(self, frame, x, y, fov):
+        """
+        Pastes a frame into the mosaic.
+        Parameters:
+            frame: Greyscale frame (eg. the luminance plane of the low resolution stream)
+            x, y: Stage position (mm) of the centre of the frame
+            fov: (width, height) of the field of view (mm)
+        """
+        width, height = round(fov[0]/self.resolution), round(fov[1]/self.resolution)
+        if width < 1 or height < 1:
+            return
+        scaled = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        left, top = self.to_pixel(x - fov[0]/2, y + fov[1]/2)
+        left, top = round(left), round(top)
+        rows, columns = self.image.shape
+        window = (slice(max(0, top), min(rows, top + height)), slice(max(0, left), min(columns, left + width)))
+        if window[0].start >= window[0].stop or window[1].start >= window[1].stop:
+            return
+        part = scaled[window[0].start - top:window[0].stop - top, window[1].start - left:window[1].stop - left]
+        self.image[window] = part
+        self.filled[window] = True
+
+    def sample_mask(self, minContrast=MINCONTRAST):
+        """
+        Thresholds the mosaic into a sample mask (Otsu threshold over the covered pixels), closes small gaps and removes
+        regions smaller than MINSAMPLEAREA. Otsu always splits the pixels in two, so if the means of the two classes differ by
+        less than minContrast (eg. an empty stage, or a sample that looks like its mount) no sample is found.
+        Parameters:
+            minContrast: Smallest difference (grey levels) between the mean of the sample and background classes
+        Returns:
+            Bool array the size of the mosaic, True on the sample
+        """
+        covered = self.image[self.filled]
+        self.contrast = 0
+        if covered.size == 0:
+            self.mask = np.zeros(self.image.shape, bool)
+            return self.mask
+        threshold, unused = cv2.threshold(covered.reshape(1, -1), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        above, below = covered[covered > threshold], covered[covered <= threshold]
+        if above.size and below.size:
+            self.contrast = float(above.mean() - below.mean())
+        if self.contrast < minContrast:
+            self.mask = np.zeros(self.image.shape, bool)
+            return self.mask
+        mask = ((self.image > threshold) if self.bright else (self.image <= threshold)) & self.filled
+        mask = mask.view(np.uint8)
+        size = max(1, round(MASKCLOSE/self.resolution)) | 1
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))
+
+        count, labels, stats, unused = cv2.connectedComponentsWithStats(mask)
+        minPixels = MINSAMPLEAREA/self.resolution**2
+        keep = np.zeros(count, bool)
+        keep[1:] = stats[1:, cv2.CC_STAT_AREA] >= minPixels
+        self.mask = keep[labels]
+        return self.mask
+
+    def sample_outline(self, margin=OUTLINEMARGIN):
+        """
+        Returns the outline of the sample in stage mm: the convex hull of every region of the sample mask, grown by a margin
+        and simplified to a polygon with few corners.
+        Parameters:
+            margin: Distance (mm) the outline is grown by
+        Returns:
+            Tuple of (bounding box (min x, max x, min y, max y), polygon as a list of (x, y) corners), or None if no sample was found
+        """
+        mask = self.mask if self.mask is not None else self.sample_mask()
+        if not mask.any():
+            return None
+        mask = mask.view(np.uint8)
+        if margin > 0:
+            size = 2*round(margin/self.resolution) + 1
+            mask = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))
+        contours, unused = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        hull = cv2.convexHull(np.vstack(contours))
+        polygon = cv2.approxPolyDP(hull, OUTLINETOLERANCE/self.resolution, True)[:, 0]
+
+        # Contour points are pixel centres, the box includes the whole of each edge pixel
+        minX, maxY = self.to_stage(hull[:, 0, 0].min(), hull[:, 0, 1].min())
+        maxX, minY = self.to_stage(hull[:, 0, 0].max() + 1, hull[:, 0, 1].max() + 1)
+        return (float(minX), float(maxX), float(minY), float(maxY)), [self.to_stage(column + 0.5, row + 0.5) for column, row in polygon.tolist()]
+
+    def tile_fractions(self, tiles, fov):
+        """
+        Returns the fraction of each tile covered by the sample mask.
+        Parameters:
+            tiles: Tile objects (scanplanner.py)
+            fov: (width, height) of the field of view (mm)
+        Returns:
+            Dictionary of {tile index: fraction of the tile that is sample}
+        """
+        mask = self.mask if self.mask is not None else self.sample_mask()
+        fractions = {}
+        for tile in tiles:
+            window = mask[self._window(tile.x, tile.y, fov[0], fov[1])]
+            fractions[tile.index] = float(window.mean()) if window.size else 0.0
+        return fractions
+
+def select_tiles(tiles, fractions, minFraction=OCCUPIEDFRACTION, margin=TILEMARGIN):
+    """
+    Chooses the tiles to capture: every tile with enough sample in it plus the tiles within a margin of them, so the edge of
+    the sample is not cut off where the overview underestimates it.
+    Parameters:
+        tiles: Tile objects of the full grid
+        fractions: Dictionary of {tile index: fraction of the tile that is sample} (Overview.tile_fractions)
+        minFraction: Smallest fraction of sample in an occupied tile
+        margin: Number of tiles kept around each occupied tile (in columns and rows)
+    Returns:
+        Set of the grid indices of the tiles to capture
+    """
+    occupied = {(tile.column, tile.row) for tile in tiles if fractions.get(tile.index, 0) >= minFraction}
+    return {tile.index for tile in tiles
+            if any(abs(tile.column - column) <= margin and abs(tile.row - row) <= margin for column, row in occupied)}
@@ -0,0 +1,250 @@
+"""
+Plans the order tiles of a scan are visited in. Tiles keep their grid index (the image number used in the file name)
+whatever order they are captured in, numbered column by column from the lowest x, going up in y within each column.
+This is the layout the Fiji stitching macro expects with type=[Grid: column-by-column] order=[Up & Right].
+Random sampling points are ordered as a short tour instead (plan_tour).
+Tiles can be left out of a plan (eg. empty tiles found by an overview pass), the rest keep their grid index.
+plan_grid places the fewest tiles that cover a bounding box from the camera field of view and the overlap needed for stitching.
+Everything in this file is pure Python so plans can be checked without hardware.
+"""
+import math
+
+DEFAULTOVERLAP = 0.2 # fraction of the field of view neighbouring tiles overlap by (the overlap the Fiji macro used to assume)
+
+
+class Tile:
+    """
+    One scan position.
+    Attributes:
+        index (int): Grid index (image number) in Fiji column-by-column, Up & Right order
+        column (int): Column number (x), 0 at the lowest x
+        row (int): Row number (y), 0 at the lowest y
+        x: x position (mm)
+        y: y position (mm)
+    """
+    def __init__(self, index, column, row, x, y):
+        self.index = index
+        self.column = column
+        self.row = row
+        self.x = x
+        self.y = y
+
+
+class ScanPlan:
+    """
+    Tiles of a scan in the order they are visited.
+    Attributes:
+        tiles (list): Tile objects in visiting order
+        columns (int): Number of columns (grid size x)
+        rows (int): Number of rows (grid size y)
+        major: "column" if each column is finished before moving to the next, "row" if each row is
+        serpentine (bool): True if every other line is visited in reverse
+        travel: Distance (mm) travelled from the start position through every tile
+        rasterTravel: Distance (mm) the original order (column by column, always starting at the lowest y) would travel
+        overlap: (x, y) fraction of the field of view neighbouring tiles overlap by (from plan_grid), None if not known
+        skipped (list): Tile objects of the grid that are not captured, in grid order
+    """
+    def __init__(self, tiles, columns, rows, major, serpentine, travel, rasterTravel, overlap=None, skipped=None):
+        self.tiles = tiles
+        self.columns = columns
+        self.rows = rows
+        self.major = major
+        self.serpentine = serpentine
+        self.travel = travel
+        self.rasterTravel = rasterTravel
+        self.overlap = overlap
+        self.skipped = skipped or []
+
+    def tile_overlap(self):
+        """
+        Returns the tile overlap (%) for the Fiji stitching macro, which takes one value for both axes: the smaller overlap,
+        rounded down (Fiji refines it when computing the overlap). None if the overlap is not known
+        """
+        overlaps = [overlap for overlap in (self.overlap or ()) if overlap is not None]
+        return int(min(overlaps)*100) if overlaps else None
+
+    def to_dict(self):
+        """Returns the plan as a dictionary that can be sent as JSON"""
+        return {"tiles": len(self.tiles), "grid_x": self.columns, "grid_y": self.rows, "major": self.major,
+                "serpentine": self.serpentine, "travel": round(self.travel, 1), "raster_travel": round(self.rasterTravel, 1),
+                "tile_overlap": self.tile_overlap(), "skipped": [tile.index for tile in self.skipped]}
+
+    def manifest(self, fov=None, pixelSize=None):
+        """
+        Returns the tile manifest saved with the images: the position of every tile of the grid and whether it is captured,
+        so the stitcher can place the captured tiles when some are skipped.
+        Parameters:
+            fov: (width, height) of the field of view (mm)
+            pixelSize: mm per pixel of the saved images
+        """
+        tiles = sorted([(tile, True) for tile in self.tiles] + [(tile, False) for tile in self.skipped], key=lambda item: item[0].index)
+        return {"grid_x": self.columns, "grid_y": self.rows, "tile_overlap": self.tile_overlap(),
+                "fov": list(fov) if fov is not None else None, "pixel_size": pixelSize,
+                "skipped": [tile.index for tile in self.skipped],
+                "tiles": [{"index": tile.index, "column": tile.column, "row": tile.row, "x": tile.x, "y": tile.y,
+                           "captured": captured} for tile, captured in tiles]}
+
+
+def path_length(points, start=None):
+    """
+    Returns the straight line distance (mm) along a list of (x, y) points.
+    Parameters:
+        points: (x, y) positions in visiting order
+        start: (x, y) position the path starts from (the first point if None)
+    """
+    if start is not None:
+        points = [start] + list(points)
+    return sum(math.hypot(x1 - x0, y1 - y0) for (x0, y0), (x1, y1) in zip(points, points[1:]))
+
+def order_tiles(xPositions, yPositions, serpentine=True, major="auto", skip=()):
+    """
+    Orders the tiles of a grid.
+    Parameters:
+        xPositions: x position (mm) of each column, lowest first
+        yPositions: y position (mm) of each row, lowest first
+        serpentine: Reverse every other line so the carriage never returns across the whole grid
+        major: "column", "row" or "auto" (whichever has fewer lines, so there are fewer line changes)
+        skip: Grid indices of tiles left out
+    Returns:
+        Tuple of (list of Tile objects in visiting order, major used)
+    """
+    if major == "auto":
+        major = "column" if len(xPositions) <= len(yPositions) else "row"
+    if major not in ("column", "row"):
+        raise ValueError(f"Unknown scan order '{major}'")
+
+    def tile(column, row):
+        return Tile(column*len(yPositions) + row, column, row, xPositions[column], yPositions[row])
+
+    outer, inner = (len(xPositions), len(yPositions)) if major == "column" else (len(yPositions), len(xPositions))
+    tiles = []
+    for line in range(outer):
+        steps = range(inner)
+        if serpentine and line % 2 == 1:
+            steps = reversed(steps)
+        for step in steps:
+            tiles.append(tile(line, step) if major == "column" else tile(step, line))
+    return [tile for tile in tiles if tile.index not in skip], major
+
+def _axis_positions(low, high, fov, overlap):
+    """
+    Returns the fewest evenly spaced tile centres whose fields of view cover low to high with at least the given overlap,
+    and the overlap they actually have (None for a single tile)
+    """
+    span = high - low
+    if span <= fov:
+        return [(low + high)/2], None
+    count = math.ceil((span - fov)/(fov*(1 - overlap)) - 1e-9) + 1
+    step = (span - fov)/(count - 1)
+    return [low + fov/2 + i*step for i in range(count)], 1 - step/fov
+
+def plan_grid(bounds, fov, overlap=DEFAULTOVERLAP):
+    """
+    Plans the tile centres covering a bounding box. The tiles are spread evenly so the overlap is at least the target,
+    with the first and last tiles lined up with the edges of the box instead of overshooting them.
+    Parameters:
+        bounds: (min x, max x, min y, max y) of the area to cover (mm)
+        fov: (width, height) of the camera field of view (mm)
+        overlap: Smallest fraction of the field of view neighbouring tiles overlap by, or (x, y) fractions
+    Returns:
+        Tuple of (x positions, y positions, (x overlap, y overlap)), an overlap is None if that axis has a single tile
+    """
+    overlapX, overlapY = overlap if isinstance(overlap, (tuple, list)) else (overlap, overlap)
+    if not (0 <= overlapX < 1 and 0 <= overlapY < 1):
+        raise ValueError(f"Tile overlap must be between 0 and 1, got {overlap}")
+    minX, maxX, minY, maxY = bounds
+    xPositions, actualX = _axis_positions(minX, maxX, fov[0], overlapX)
+    yPositions, actualY = _axis_positions(minY, maxY, fov[1], overlapY)
+    return xPositions, yPositions, (actualX, actualY)
+
+def plan_scan(xPositions, yPositions, start=None, serpentine=True, major="auto", overlap=None, skip=()):
+    """
+    Plans the visiting order of a grid scan and its travel distance.
+    Parameters:
+        xPositions: x position (mm) of each column, lowest first
+        yPositions: y position (mm) of each row, lowest first
+        start: (x, y) carriage position (mm) before the scan
+        serpentine: Reverse every other line
+        major: "column", "row" or "auto"
+        overlap: (x, y) overlap of neighbouring tiles from plan_grid, if known
+        skip: Grid indices of tiles that are not captured
+    Returns:
+        ScanPlan
+    """
+    skip = set(skip)
+    tiles, major = order_tiles(xPositions, yPositions, serpentine, major, skip)
+    raster, unused = order_tiles(xPositions, yPositions, False, "column", skip)
+    allTiles, unused = order_tiles(xPositions, yPositions, False, "column")
+    travel = path_length([(tile.x, tile.y) for tile in tiles], start)
+    rasterTravel = path_length([(tile.x, tile.y) for tile in raster], start)
+    return ScanPlan(tiles, len(xPositions), len(yPositions), major, serpentine, travel, rasterTravel, overlap,
+                    [tile for tile in allTiles if tile.index in skip])
+
+
+class TourPlan:
+    """
+    Visiting order of a set of points.
+    Attributes:
+        points (list): (x, y) positions in visiting order
+        order (list): Index of each visited point in the original list
+        travel: Distance (mm) from the start through every point to the end
+        originalTravel: Distance (mm) visiting the points in their original order
+    """
+    def __init__(self, points, order, travel, originalTravel):
+        self.points = points
+        self.order = order
+        self.travel = travel
+        self.originalTravel = originalTravel
+
+    def to_dict(self):
+        """Returns the plan as a dictionary that can be sent as JSON"""
+        return {"points": len(self.points), "travel": round(self.travel, 1), "original_travel": round(self.originalTravel, 1),
+                "saved": round(self.originalTravel - self.travel, 1)}
+
+
+def _distance(a, b):
+    return math.hypot(b[0] - a[0], b[1] - a[1])
+
+def plan_tour(points, start, end=None):
+    """
+    Orders points to shorten the path from a start position through every point to an end position: a nearest neighbour
+    tour improved by 2-opt (reversing any part of the path that makes it shorter) until no reversal helps.
+    Only the order changes, the points themselves are not moved.
+    Parameters:
+        points: (x, y) positions (mm)
+        start: (x, y) position the path starts from (the current carriage position)
+        end: (x, y) position the path should finish near (eg. home for robot pickup), or None for an open end
+    Returns:
+        TourPlan
+    """
+    remaining = list(range(len(points)))
+    order = []
+    current = start
+    while remaining:
+        nearest = min(remaining, key=lambda i: _distance(current, points[i]))
+        remaining.remove(nearest)
+        order.append(nearest)
+        current = points[nearest]
+
+    # 2-opt with the start (and end) fixed: path[0] is the start, path[-1] the end
+    path = [start] + [points[i] for i in order] + ([end] if end is not None else [])
+    last = len(path) - 1 if end is not None else len(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, last - 1):
+            for k in range(i + 1, last):
+                before = _distance(path[i - 1], path[i])
+                after = _distance(path[i - 1], path[k])
+                if k + 1 < len(path):
+                    before = before + _distance(path[k], path[k + 1])
+                    after = after + _distance(path[i], path[k + 1])
+                if after < before - 1e-9:
+                    path[i:k + 1] = reversed(path[i:k + 1])
+                    order[i - 1:k] = reversed(order[i - 1:k])
+                    improved = True
+
+    ends = [end] if end is not None else []
+    travel = path_length([points[i] for i in order] + ends, start)
+    originalTravel = path_length(list(points) + ends, start)
+    return TourPlan([points[i] for i in order], order, travel, originalTravel)
@@ -0,0 +1,116 @@
+"""
+Detects when the camera carriage has stopped vibrating after a move by comparing successive low resolution frames,
+instead of waiting a fixed time before every capture.
+"""
+import time
+import cv2
+import numpy as np
+
+SETTLESHIFT = 0.25 # pixels (at the reduced size) successive frames may move by once settled
+SETTLETIMEOUT = 0.5 # s, longest wait before capturing anyway (the fixed delay used before)
+SETTLELEVELS = 1 # number of times frames are halved in size before comparing
+
+
+class SettleResult:
+    """
+    Result of waiting for one position to settle.
+    Attributes:
+        index: Waypoint or tile index the result belongs to
+        settleTime: Time (s) from the start of the wait to the start of the exposure of the first settled frame
+        shift: Shift (pixels) between the last two frames compared
+        frames (int): Number of frames compared
+        timedOut (bool): True if the timeout was reached before the frames stopped moving
+    """
+    def __init__(self, index, settleTime, shift, frames, timedOut):
+        self.index = index
+        self.settleTime = settleTime
+        self.shift = shift
+        self.frames = frames
+        self.timedOut = timedOut
+
+    def to_dict(self):
+        """Returns the result as a dictionary that can be sent as JSON"""
+        return {"index": self.index, "settle_time": round(self.settleTime, 3), "shift": round(self.shift, 3),
+                "frames": self.frames, "timed_out": self.timedOut}
+
+
+class SettleDetector:
+    """
+    Waits until two successive frames exposed after a move are shifted by less than a threshold (phase correlation).
+    A frame is only requested if it can be ready before the timeout. Otherwise the rest of the timeout is slept through (so
+    the carriage gets at least the fixed delay used before) and the wait ends at the deadline instead of a frame later.
+    Attributes:
+        getFrame: Function returning (greyscale image, metadata) of the first frame exposed after a given time (ns)
+        now: Function returning the current time (ns) on the frame timestamp clock
+        sleep: Function sleeping for a time in seconds
+        threshold: Largest shift (pixels at the reduced size) of a settled frame
+        timeout: Longest wait (s)
+        history (list): SettleResult of every wait since the last reset
+        exposureTime: Exposure time (ns) of the last frame
+        frameDuration: Time (ns) between the starts of the last frames
+    """
+    def __init__(self, getFrame, now, threshold=SETTLESHIFT, timeout=SETTLETIMEOUT, sleep=time.sleep):
+        self.getFrame = getFrame
+        self.now = now
+        self.sleep = sleep
+        self.threshold = threshold
+        self.timeout = timeout
+        self.history = []
+        self.exposureTime = 0
+        self.frameDuration = 0
+        self._window = None
+
+    def reset(self):
+        """Clears the recorded settle times (eg. at the start of a scan)"""
+        self.history = []
+
+    def _prepare(self, luma):
+        """Reduces a frame and converts it to float32 for phase correlation"""
+        for level in range(SETTLELEVELS):
+            luma = cv2.pyrDown(luma)
+        reduced = luma.astype(np.float32)
+        if self._window is None or self._window.shape != reduced.shape:
+            self._window = cv2.createHanningWindow((reduced.shape[1], reduced.shape[0]), cv2.CV_32F)
+        return reduced
+
+    def wait(self, index=None):
+        """
+        Blocks until the image stops moving or the timeout is reached.
+        Parameters:
+            index: Waypoint or tile index recorded with the result
+        Returns:
+            SettleResult
+        """
+        start = self.now()
+        deadline = start + int(self.timeout*1e9)
+        previous, previousStart = None, start - 1
+        frames, shift = 0, float("inf")
+        while True:
+            # The next frame starts within a frame duration and is ready once it has been exposed. Stop waiting instead of
+            # requesting a frame that would arrive after the deadline
+            if max(previousStart + 1, self.now()) + self.frameDuration + self.exposureTime > deadline:
+                self.sleep(max(deadline - self.now(), 0)/1e9)
+                result = SettleResult(index, (self.now() - start)/1e9, shift, frames, True)
+                break
+            luma, metadata = self.getFrame(previousStart + 1)
+            self.exposureTime = metadata.get("ExposureTime", 0)*1000
+            self.frameDuration = metadata.get("FrameDuration", 0)*1000
+            current = self._prepare(luma)
+            frames = frames + 1
+            if previous is not None:
+                (dx, dy), response = cv2.phaseCorrelate(previous, current, self._window)
+                shift = (dx**2 + dy**2)**0.5
+                if shift < self.threshold:
+                    result = SettleResult(index, (previousStart - start)/1e9, shift, frames, False)
+                    break
+            previous, previousStart = current, metadata.get("SensorTimestamp", self.now())
+        self.history.append(result)
+        return result
+
+    def summary(self):
+        """Returns the mean and longest settle time (s) and number of timeouts since the last reset"""
+        times = [result.settleTime for result in self.history]
+        return {"count": len(times), "mean": round(sum(times)/len(times), 3) if times else 0,
+                "max": round(max(times), 3) if times else 0,
+                "timeouts": sum(result.timedOut for result in self.history),
+                "settle_times": [round(settleTime, 3) for settleTime in times]}
@@ -0,0 +1,615 @@
+"""
+Simulated hardware used to exercise the motion and camera code without the Arduino or Raspberry Pi camera attached.
+"""
+import math
+import random
+from steppers import (ACCELSTEPPER_DATA, ACCELSTEPPER_CONFIG, ACCELSTEPPER_ZERO, ACCELSTEPPER_STEP, ACCELSTEPPER_STOP,
+                      ACCELSTEPPER_REPORT_POSITION, ACCELSTEPPER_SET_ACCELERATION, ACCELSTEPPER_SET_SPEED,
+                      ACCELSTEPPER_MOVE_COMPLETE, MULTISTEPPER_CONFIG, MULTISTEPPER_TO, MULTISTEPPER_STOP,
+                      MULTISTEPPER_MOVE_COMPLETE, encode_int32, decode_int32, decode_float, PinStepBackend, home_axis)
+from motionplanner import AxisLimits, combine_limits, plan_profile, plan_path
+from camerastream import CameraStream
+from focussearch import search_focus, STRATEGIES
+
+
+class FakePin:
+    """
+    Stands in for a pyfirmata pin and records every value written to it.
+    Attributes:
+        number: Arduino pin number
+        writes (list): Values written to the pin in order
+        value: Last value written or read
+    """
+    def __init__(self, number, value=0):
+        self.number = number
+        self.writes = []
+        self.value = value
+        self.mode = 0
+        self.reporting = False
+
+    def write(self, value):
+        self.writes.append(value)
+        self.value = value
+
+    def read(self):
+        return self.value
+
+    def enable_reporting(self):
+        self.reporting = True
+
+DIGITAL_MESSAGE = 0x90 # Firmata digital port report (same value as pyfirmata.DIGITAL_MESSAGE)
+
+
+class SimulatedClock:
+    """
+    Clock which advances instantly instead of waiting, so step timing can be measured without hardware.
+    Can imitate a loaded Raspberry Pi where every sleep oversleeps by a random amount.
+    Attributes:
+        now: Simulated time (s) since the clock was created
+        oversleep: Largest extra time (s) added to each sleep
+        readTime: Time (s) that passes each time the clock is read (so spinning on the clock advances it)
+    """
+    def __init__(self, oversleep=0.0, readTime=1e-6, seed=0):
+        self.now = 0.0
+        self.oversleep = oversleep
+        self.readTime = readTime
+        self._random = random.Random(seed)
+
+    def sleep(self, seconds):
+        self.now = self.now + max(seconds, 0) + self._random.uniform(0, self.oversleep)
+
+    def perf_counter_ns(self):
+        self.now = self.now + self.readTime
+        return int(self.now*1e9)
+
+    def monotonic_ns(self):
+        return self.perf_counter_ns()
+
+    def perf_counter(self):
+        self.now = self.now + self.readTime
+        return self.now
+
+
+class FakeStepperMotor:
+    """
+    Stands in for opticalmodule.StepperMotor using pins on a fake board.
+    Attributes:
+        position: Steps counted from the pulses on the step pin (+1 when the direction pin is 1, -1 when it is 0)
+    """
+    def __init__(self, step_pin, dir_pin, board):
+        self.stepPinNum = step_pin
+        self.dirPinNum = dir_pin
+        self.position = 0
+        self.step_pin = FakeStepPin(step_pin, self)
+        board.digital[step_pin] = self.step_pin
+        self.dir_pin = board.get_pin(f'd:{dir_pin}:o')
+
+
+class FakeStepPin(FakePin):
+    """FakePin for a step pin which counts the position of its FakeStepperMotor on each rising edge"""
+    def __init__(self, number, motor):
+        super().__init__(number)
+        self.motor = motor
+
+    def write(self, value):
+        if value and not self.value:
+            self.motor.position = self.motor.position + (1 if self.motor.dir_pin.value else -1)
+        super().write(value)
+
+
+class SimulatedLimitSwitch:
+    """
+    Limit switch which presses when an axis passes a trigger position. The trigger point moves randomly by a small amount
+    on each approach (mechanical repeatability) and the switch is only seen as pressed after a random delay of up to latency
+    (eg. the Firmata sampling interval), so fast approaches overshoot further and less repeatably than slow ones.
+    Attributes:
+        position: Function returning the axis position in steps, increasing towards the switch
+        triggerPosition: Nominal position (steps) at which the switch presses
+        latency: Longest time (s) between the switch pressing and is_pressed returning True
+        noise: Standard deviation (steps) of the trigger position
+        clock: SimulatedClock used to time the latency
+    """
+    def __init__(self, position, triggerPosition, clock, latency=0.0, noise=0.0, seed=0):
+        self.position = position
+        self.triggerPosition = triggerPosition
+        self.clock = clock
+        self.latency = latency
+        self.noise = noise
+        self._random = random.Random(seed)
+        self._trigger = triggerPosition
+        self._delay = self._random.uniform(0, latency)
+        self._pressedAt = None
+
+    def is_pressed(self):
+        if self.position() < self._trigger:
+            # Released: the next approach presses at a slightly different point
+            self._pressedAt = None
+            self._trigger = self.triggerPosition + self._random.gauss(0, self.noise)
+            self._delay = self._random.uniform(0, self.latency)
+            return False
+        if self._pressedAt is None:
+            self._pressedAt = self.clock.now
+        return self.clock.now - self._pressedAt >= self._delay
+
+
+class FakePinBank(dict):
+    """Dictionary of FakePin objects which creates pins on first access (like pyfirmata board.digital)"""
+    def __missing__(self, number):
+        self[number] = FakePin(number)
+        return self[number]
+
+
+class FakeFirmataBoard:
+    """
+    Fake serial board which parses AccelStepperFirmata sysex messages, records the command stream and answers
+    with the same replies as the firmware. Moves complete immediately and the time they would have taken is added to elapsed.
+    Step commands for different devices sent one after another run at the same time. A new move starts when a device that
+    has already moved is sent another command (eg. when speeds are restored after a move) or a multistepper command is sent.
+    Attributes:
+        commands (list): Decoded commands in the order they were received, eg. ("step", device, steps)
+        sysex (list): Raw (command, data) sysex messages
+        steppers (dict): Simulated firmware stepper state per device number
+        groups (dict): Device numbers in each multistepper group
+        digital (dict): FakePin objects by pin number
+        elapsed: Simulated time (s) spent moving
+        supportsSteppers: If False the board ignores stepper messages like StandardFirmata
+    """
+    def __init__(self, supportsSteppers=True):
+        self.commands = []
+        self.sysex = []
+        self.steppers = {}
+        self.groups = {}
+        self.digital = FakePinBank()
+        self.elapsed = 0.0
+        self.supportsSteppers = supportsSteppers
+        self._command_handlers = {}
+        self._moveStart = 0.0
+        self._moveDevices = set()
+
+    def get_pin(self, pinDef):
+        """Returns a FakePin for a pyfirmata pin definition such as 'd:2:o'"""
+        return self.digital[int(pinDef.split(":")[1])]
+
+    def set_digital_input(self, pin, value):
+        """
+        Sets a digital input pin and sends the Firmata digital port report for its port to the registered handler
+        (like the Arduino does when an input with reporting enabled changes)
+        """
+        self.digital[pin].value = value
+        port = pin // 8
+        mask = sum(1 << bit for bit in range(8) if self.digital[port*8 + bit].value)
+        if DIGITAL_MESSAGE in self._command_handlers:
+            self._command_handlers[DIGITAL_MESSAGE](port, mask & 0x7F, mask >> 7)
+
+    def add_cmd_handler(self, cmd, func):
+        self._command_handlers[cmd] = func
+
+    def send_sysex(self, sysexCmd, data=[]):
+        for byte in data:
+            if not 0 <= byte <= 0x7F:
+                raise ValueError(f"Sysex data byte out of range: {byte}")
+        self.sysex.append((sysexCmd, list(data)))
+        if sysexCmd == ACCELSTEPPER_DATA and self.supportsSteppers:
+            self._parse_stepper(list(data))
+
+    def _reply(self, *data):
+        if ACCELSTEPPER_DATA in self._command_handlers:
+            self._command_handlers[ACCELSTEPPER_DATA](*data)
+
+    def _step_time(self, stepper, steps):
+        """Time (s) for a firmware stepper to move a number of steps at its speed, ramping from standstill if acceleration is set"""
+        speed, acceleration = stepper["speed"], stepper["acceleration"]
+        if acceleration <= 0:
+            return steps/speed
+        if steps >= speed**2/acceleration:
+            return steps/speed + speed/acceleration
+        return 2*(steps/acceleration)**0.5
+
+    def _parse_stepper(self, data):
+        """Decodes one AccelStepperFirmata message, updates the simulated steppers and sends any reply"""
+        command, deviceNum = data[0], data[1]
+
+        # Any further command to a device that already moved means the host waited for the move to finish
+        if command < MULTISTEPPER_CONFIG and deviceNum in self._moveDevices:
+            self._moveStart = self.elapsed
+            self._moveDevices = set()
+
+        if command == ACCELSTEPPER_CONFIG:
+            self.steppers[deviceNum] = {"interface": data[2], "step_pin": data[3], "dir_pin": data[4],
+                                        "position": 0, "speed": 1.0, "acceleration": 0.0}
+            self.commands.append(("config", deviceNum, data[2], data[3], data[4]))
+        elif command == ACCELSTEPPER_ZERO:
+            self.steppers[deviceNum]["position"] = 0
+            self.commands.append(("zero", deviceNum))
+        elif command == ACCELSTEPPER_SET_SPEED:
+            self.steppers[deviceNum]["speed"] = decode_float(data[2:6])
+            self.commands.append(("speed", deviceNum, self.steppers[deviceNum]["speed"]))
+        elif command == ACCELSTEPPER_SET_ACCELERATION:
+            self.steppers[deviceNum]["acceleration"] = decode_float(data[2:6])
+            self.commands.append(("acceleration", deviceNum, self.steppers[deviceNum]["acceleration"]))
+        elif command == ACCELSTEPPER_STEP:
+            steps = decode_int32(data[2:7])
+            stepper = self.steppers[deviceNum]
+            stepper["position"] = stepper["position"] + steps
+            self._moveDevices.add(deviceNum)
+            self.elapsed = max(self.elapsed, self._moveStart + self._step_time(stepper, abs(steps)))
+            self.commands.append(("step", deviceNum, steps))
+            self._reply(ACCELSTEPPER_MOVE_COMPLETE, deviceNum, *encode_int32(stepper["position"]))
+        elif command == ACCELSTEPPER_STOP:
+            self.commands.append(("stop", deviceNum))
+            self._reply(ACCELSTEPPER_MOVE_COMPLETE, deviceNum, *encode_int32(self.steppers[deviceNum]["position"]))
+        elif command == ACCELSTEPPER_REPORT_POSITION:
+            self.commands.append(("report", deviceNum))
+            if deviceNum in self.steppers:
+                self._reply(ACCELSTEPPER_REPORT_POSITION, deviceNum, *encode_int32(self.steppers[deviceNum]["position"]))
+        elif command == MULTISTEPPER_CONFIG:
+            self.groups[deviceNum] = data[2:]
+            self.commands.append(("multi_config", deviceNum, tuple(data[2:])))
+        elif command == MULTISTEPPER_TO:
+            # Positions are absolute and every member arrives together, limited by the slowest member
+            targets = [decode_int32(data[i:i+5]) for i in range(2, len(data), 5)]
+            duration = 0
+            for member, target in zip(self.groups[deviceNum], targets):
+                stepper = self.steppers[member]
+                duration = max(duration, abs(target - stepper["position"])/stepper["speed"])
+                stepper["position"] = target
+            self.elapsed = self.elapsed + duration
+            self._moveStart = self.elapsed
+            self._moveDevices = set()
+            self.commands.append(("multi_to", deviceNum, tuple(targets)))
+            self._reply(MULTISTEPPER_MOVE_COMPLETE, deviceNum)
+        elif command == MULTISTEPPER_STOP:
+            self.commands.append(("multi_stop", deviceNum))
+            self._reply(MULTISTEPPER_MOVE_COMPLETE, deviceNum)
+        else:
+            self.commands.append(("unknown", command, data[1:]))
+
+
+def measure_path_time(segments, limits, stops, pulseWidth=0.0, lookahead=True):
+    """
+    Runs a path through PinStepBackend on a fake board with a simulated clock and measures how long it takes.
+    Parameters:
+        segments: List of moves, each a list of steps for every motor
+        limits: AxisLimits of each motor
+        stops: For each move, True if the path stops at its end (eg. to take an image)
+        pulseWidth: Step pulse width (s)
+        lookahead: If True moves are blended with plan_path, otherwise every move starts and ends at standstill
+    Returns:
+        Tuple of (total path time in s, final signed step count of each motor)
+    """
+    board = FakeFirmataBoard(supportsSteppers=False)
+    motors = [FakeStepperMotor(2*i + 2, 2*i + 3, board) for i in range(len(limits))]
+    clock = SimulatedClock()
+    backend = PinStepBackend(pulseWidth, 0, clock)
+
+    if lookahead:
+        profiles = plan_path(segments, limits, stops)
+    else:
+        profiles = [plan_profile(max([abs(delta) for delta in deltas]), combine_limits(deltas, limits)) for deltas in segments]
+
+    positions = [0]*len(limits)
+    for deltas, profile in zip(segments, profiles):
+        executed = backend.move(motors, deltas, profile=profile)
+        positions = [position + step for position, step in zip(positions, executed)]
+    return clock.now, positions
+
+def measure_step_timing(steps=2000, rate=900, oversleep=300e-6, pulseWidth=100e-6):
+    """
+    Runs a constant rate move through PinStepBackend with a clock that oversleeps like a loaded Raspberry Pi.
+    Parameters:
+        steps: Number of steps to move
+        rate: Step rate (steps/s)
+        oversleep: Largest extra time (s) added to each sleep
+        pulseWidth: Step pulse width (s)
+    Returns:
+        StepTimingStats of the move
+    """
+    board = FakeFirmataBoard(supportsSteppers=False)
+    backend = PinStepBackend(pulseWidth, 1/rate - pulseWidth, SimulatedClock(oversleep))
+    backend.move([FakeStepperMotor(2, 3, board)], [steps])
+    return backend.lastTiming
+
+def measure_homing(cycles=10, travel=16000, fastVelocity=20, slowRate=300, backoff=1.0, latency=0.02, noise=0.5,
+                   stepDist=0.212058/16, startRate=909, acceleration=200, seed=0):
+    """
+    Homes a simulated axis several times from random positions, once with the two-phase home_axis routine and once with
+    the original single approach at the start rate, and reports the time and repeatability of each.
+    Parameters:
+        cycles: Number of homings of each kind
+        travel: Axis length (steps). Each homing starts from a random position along the axis
+        fastVelocity: Fast approach velocity (mm/s)
+        slowRate: Slow re-approach step rate (steps/s)
+        backoff: Back-off distance (mm)
+        latency: Longest delay (s) before the switch is seen as pressed
+        noise: Standard deviation (steps) of the switch trigger position
+        stepDist: Distance moved per step (mm)
+        startRate: Step rate (steps/s) the motor can start at, used for the single approach
+        acceleration: Acceleration (mm/s^2) of the fast approach
+    Returns:
+        Dictionary with the mean homing time (s) and the spread (standard deviation, steps) of the home position for each routine
+    """
+    rand = random.Random(seed)
+    limits = AxisLimits(stepDist, startRate*stepDist, fastVelocity, acceleration)
+    fastProfile = plan_profile(travel, limits)
+    results = {}
+    for routine in ("two_phase", "single"):
+        times, homes = [], []
+        for cycle in range(cycles):
+            board = FakeFirmataBoard(supportsSteppers=False)
+            motor = FakeStepperMotor(2, 3, board)
+            clock = SimulatedClock()
+            backend = PinStepBackend(100e-6, 1/startRate - 100e-6, clock)
+            motor.position = -rand.randint(0, travel)
+            switch = SimulatedLimitSwitch(lambda: motor.position, 0, clock, latency, noise, seed=cycle)
+            if routine == "two_phase":
+                home_axis(backend, [motor], [1], switch.is_pressed, fastProfile, slowRate, round(backoff/stepDist))
+            else:
+                backend.move_until([motor], [1], switch.is_pressed)
+            times.append(clock.now)
+            homes.append(motor.position)
+        mean = sum(homes)/cycles
+        results[routine] = {"mean_time": sum(times)/cycles,
+                            "repeatability_steps": (sum((home - mean)**2 for home in homes)/cycles)**0.5}
+    return results
+
+
+class FakeCompletedRequest:
+    """Stands in for a Picamera2 CompletedRequest holding one frame"""
+    def __init__(self, picam, metadata):
+        self.picam = picam
+        self.metadata = metadata
+
+    def make_array(self, name):
+        return self.picam.frameSource(name, self.metadata)
+
+    def get_metadata(self):
+        return dict(self.metadata)
+
+    def release(self):
+        self.picam.released = self.picam.released + 1
+
+
+class FakePicamera2:
+    """
+    Stands in for Picamera2 with simulated timing. Starting the camera takes startLatency, and once started the sensor
+    free-runs, exposing a new frame every frame duration (at least the exposure time). Picamera2 keeps a few completed
+    frames queued, so capture_request can return a frame that was exposed before it was called. Controls set while
+    streaming only take effect controlDelay frames later, as reported in the frame metadata.
+    Attributes:
+        clock: SimulatedClock advanced while waiting for the camera
+        startLatency: Time (s) taken by start()
+        stopLatency: Time (s) taken by stop()
+        minFrameDuration: Shortest time (s) between frames
+        buffers: Number of completed frames Picamera2 keeps queued
+        frameSource: Function called with (stream name, metadata) returning the image array for a frame (None by default)
+        controlDelay: Number of frames before controls set while streaming are active
+        controls (dict): Controls set with set_controls
+        active (dict): Controls used by the frame being exposed
+        setCount (int): Number of set_controls calls
+        config (dict): Configuration set with configure
+        startCount (int): Number of times start() was called
+        released (int): Number of requests released
+    """
+    def __init__(self, clock=None, startLatency=0.5, stopLatency=0.05, minFrameDuration=1/30, buffers=4, frameSource=None, controlDelay=3):
+        self.clock = SimulatedClock() if clock is None else clock
+        self.startLatency = startLatency
+        self.stopLatency = stopLatency
+        self.minFrameDuration = minFrameDuration
+        self.buffers = buffers
+        self.frameSource = frameSource if frameSource is not None else (lambda name, metadata: None)
+        self.controlDelay = controlDelay
+        self.controls = {"ExposureTime": 100000, "AnalogueGain": 1.0}
+        self.active = dict(self.controls)
+        self.setCount = 0
+        self._pending = []
+        self.config = None
+        self.started = False
+        self.startCount = 0
+        self.released = 0
+        self._firstFrame = 0.0
+        self._lastFrame = -1
+
+    def create_still_configuration(self, main={}, lores=None, **kwargs):
+        return {"main": main, "lores": lores, **kwargs}
+
+    def create_preview_configuration(self, main={}, lores=None, **kwargs):
+        return {"main": main, "lores": lores, **kwargs}
+
+    def configure(self, config):
+        self.config = config
+
+    def set_controls(self, controls):
+        self.setCount = self.setCount + 1
+        self.controls.update(controls)
+        if not self.started:
+            self.active.update(controls)
+            return
+        frame = int((self.clock.now - self._firstFrame)//self._frame_duration()) + self.controlDelay
+        self._pending.append((frame, dict(controls)))
+
+    def start(self):
+        self.active.update(self.controls)
+        self._pending = []
+        self.clock.sleep(self.startLatency)
+        self.started = True
+        self.startCount = self.startCount + 1
+        self._firstFrame = self.clock.now
+        self._lastFrame = -1
+
+    def stop(self):
+        self.clock.sleep(self.stopLatency)
+        self.started = False
+
+    def _frame_duration(self):
+        return max(self.controls["ExposureTime"]/1e6, self.minFrameDuration)
+
+    def capture_request(self):
+        """Returns the oldest queued frame, waiting for the next frame to complete if none are queued"""
+        if not self.started:
+            raise RuntimeError("Camera not started")
+        duration = self._frame_duration()
+        exposure = self.controls["ExposureTime"]/1e6
+        # Frame k exposes from firstFrame + k*duration and completes exposure later
+        completed = int((self.clock.now - self._firstFrame - exposure)//duration)
+        frame = max(self._lastFrame + 1, completed - self.buffers + 1)
+        completeTime = self._firstFrame + frame*duration + exposure
+        if completeTime > self.clock.now:
+            self.clock.sleep(completeTime - self.clock.now)
+        self._lastFrame = frame
+        for applyFrame, controls in [pending for pending in self._pending if pending[0] <= frame]:
+            self.active.update(controls)
+        self._pending = [pending for pending in self._pending if pending[0] > frame]
+        metadata = {"SensorTimestamp": int((self._firstFrame + frame*duration)*1e9),
+                    "ExposureTime": self.active["ExposureTime"],
+                    "AnalogueGain": self.active["AnalogueGain"],
+                    "FrameDuration": int(duration*1e6)}
+        return FakeCompletedRequest(self, metadata)
+
+    def capture_array(self, name="main"):
+        request = self.capture_request()
+        array = request.make_array(name)
+        request.release()
+        return array
+
+    def capture_metadata(self):
+        request = self.capture_request()
+        metadata = request.get_metadata()
+        request.release()
+        return metadata
+
+
+def measure_capture_cost(captures=20, startLatency=0.5, exposureTime=100000, idleTime=0.5):
+    """
+    Compares the time per capture of starting and stopping the camera for every frame (the original get_image_array)
+    with keeping it streaming and using CameraStream.request_frame.
+    Parameters:
+        captures: Number of frames captured with each method
+        startLatency: Time (s) for the simulated camera to start
+        exposureTime: Exposure time (us)
+        idleTime: Time (s) between captures (eg. stage moves)
+    Returns:
+        Dictionary with the mean time (s) per capture for each method and the time saved per capture
+    """
+    clock = SimulatedClock()
+    picam = FakePicamera2(clock, startLatency)
+    picam.set_controls({"ExposureTime": exposureTime})
+    start = clock.now
+    for i in range(captures):
+        clock.sleep(idleTime)
+        picam.start()
+        picam.capture_array("main")
+        picam.stop()
+    startStop = (clock.now - start - captures*idleTime)/captures
+
+    clock = SimulatedClock()
+    stream = CameraStream(FakePicamera2(clock, startLatency), clock)
+    stream.picam.set_controls({"ExposureTime": exposureTime})
+    stream.start()
+    start = clock.now
+    for i in range(captures):
+        clock.sleep(idleTime)
+        stream.request_frame()
+    streaming = (clock.now - start - captures*idleTime)/captures
+    return {"start_stop_per_capture": startStop, "streaming_per_capture": streaming, "saved_per_capture": startStop - streaming}
+
+def measure_settings_cost(changes=10, controlDelay=3, minFrameDuration=1/30):
+    """
+    Compares capturing straight after sending new camera settings (the original update_settings) with waiting for the
+    frame metadata to confirm them. Every other update repeats the previous settings.
+    Parameters:
+        changes: Number of settings updates, each followed by one capture
+        controlDelay: Frames before the simulated camera applies new controls
+        minFrameDuration: Shortest time (s) between frames
+    Returns:
+        Dictionary with the captures that used old settings and the controls sent for each method, and the mean frames waited
+    """
+    results = {}
+    for method in ("blind", "confirmed"):
+        clock = SimulatedClock()
+        stream = CameraStream(FakePicamera2(clock, minFrameDuration=minFrameDuration, controlDelay=controlDelay), clock)
+        stream.start()
+        stale, framesWaited = 0, 0
+        for i in range(changes):
+            controls = {"ExposureTime": 20000 + 1000*(i//2), "AnalogueGain": 1.0 + 0.5*(i//2)}
+            if method == "blind":
+                stream.picam.set_controls(controls)
+            else:
+                before = stream.confirmedToken
+                stream.set_controls(controls)
+            array, metadata = stream.request_frame()
+            if method == "confirmed" and stream.confirmedToken != before:
+                framesWaited = framesWaited + stream.controlFrames
+            if metadata["ExposureTime"] != controls["ExposureTime"] or metadata["AnalogueGain"] != controls["AnalogueGain"]:
+                stale = stale + 1
+        results[method] = {"stale_captures": stale, "controls_sent": stream.picam.setCount, "frames_waited": framesWaited}
+    return results
+
+
+class SyntheticDefocus:
+    """
+    Synthetic focus score against z: a Gaussian peak at the focus height on a constant background, with random noise.
+    Attributes:
+        focusZ: z position (mm) of best focus
+        width: Standard deviation (mm) of the focus peak (roughly the depth of field)
+        peak: Score at best focus above the background
+        background: Score far from focus
+        noise: Standard deviation of the noise added to each score, as a fraction of the score
+    """
+    def __init__(self, focusZ, width=0.1, peak=100.0, background=5.0, noise=0.02, seed=0):
+        self.focusZ = focusZ
+        self.width = width
+        self.peak = peak
+        self.background = background
+        self.noise = noise
+        self._random = random.Random(seed)
+
+    def score(self, z):
+        score = self.background + self.peak*math.exp(-((z - self.focusZ)/self.width)**2/2)
+        return score*(1 + self._random.gauss(0, self.noise))
+
+
+def measure_autofocus(trials=20, rangeMm=1.0, stepSize=0.05, width=0.1, noise=0.02, captureTime=0.25, zVelocity=5.0,
+                      peakFit="parabolic", seed=0):
+    """
+    Runs every autofocus strategy and the original linear sweep against a synthetic defocus model with the focus height
+    placed randomly in the search range. The time per capture is simulated as the z move plus a fixed capture time.
+    Parameters:
+        trials: Number of searches per strategy
+        rangeMm: Search range is +/- rangeMm around the expected focus height
+        stepSize: Step size (mm) of the search
+        width: Width (mm) of the synthetic focus peak
+        noise: Relative noise of the synthetic focus scores
+        captureTime: Time (s) to settle and capture an image
+        zVelocity: z velocity (mm/s) used to time the moves
+        peakFit: Peak fit used by the strategies
+    Returns:
+        Dictionary per strategy with the mean captures, mean simulated time (s) and mean and worst focus error (mm)
+    """
+    rand = random.Random(seed)
+    focusHeights = [rand.uniform(-0.8*rangeMm, 0.8*rangeMm) for i in range(trials)]
+    results = {}
+    for strategy in ["linear"] + list(STRATEGIES):
+        captures, times, errors = 0, 0.0, []
+        for trial, focusZ in enumerate(focusHeights):
+            model = SyntheticDefocus(focusZ, width, noise=noise, seed=trial)
+            clock = SimulatedClock(readTime=0)
+            position = [0.0]
+
+            def measure(z):
+                clock.sleep(abs(z - position[0])/zVelocity + captureTime)
+                position[0] = z
+                return model.score(z)
+
+            if strategy == "linear":
+                # Original auto_focus: every step across the range, keep the best
+                scores = [(z, measure(z)) for z in [-rangeMm + i*stepSize for i in range(int(round(2*rangeMm/stepSize)) + 1)]]
+                bestZ, count = max(scores, key=lambda item: item[1])[0], len(scores)
+            else:
+                result = search_focus(measure, -rangeMm, rangeMm, stepSize, strategy, peakFit, clock=clock)
+                bestZ, count = result.bestZ, result.captures
+            captures = captures + count
+            times = times + clock.now
+            errors.append(abs(bestZ - focusZ))
+        results[strategy] = {"captures": captures/trials, "time": times/trials,
+                             "mean_error": sum(errors)/trials, "max_error": max(errors)}
+    return results
@@ -0,0 +1,582 @@
+import threading
+import time
+from motionplanner import interpolate_steps, plan_deceleration
+
+# Firmata AccelStepper sysex protocol constants
+# https://github.com/firmata/protocol/blob/master/accelStepperFirmata.md
+ACCELSTEPPER_DATA = 0x62
+ACCELSTEPPER_CONFIG = 0x00
+ACCELSTEPPER_ZERO = 0x01
+ACCELSTEPPER_STEP = 0x02
+ACCELSTEPPER_TO = 0x03
+ACCELSTEPPER_ENABLE = 0x04
+ACCELSTEPPER_STOP = 0x05
+ACCELSTEPPER_REPORT_POSITION = 0x06
+ACCELSTEPPER_SET_ACCELERATION = 0x08
+ACCELSTEPPER_SET_SPEED = 0x09
+ACCELSTEPPER_MOVE_COMPLETE = 0x0A
+MULTISTEPPER_CONFIG = 0x20
+MULTISTEPPER_TO = 0x21
+MULTISTEPPER_STOP = 0x23
+MULTISTEPPER_MOVE_COMPLETE = 0x24
+
+DRIVER_INTERFACE = 0x10 # 001XXXX: step/direction driver, whole steps (microstepping is set on the driver), no enable pin
+HOMINGCHUNK = 16 # steps moved per firmware command while searching for a limit switch in the fast approach
+SLOWHOMINGCHUNK = 1 # steps moved per firmware command in the slow re-approach, so it stops on the step the switch trips
+SPINTIME = 500000 # ns before a step deadline at which pin stepping stops sleeping and spins on the clock
+HISTOGRAMBIN = 50 # width (us) of the step timing jitter histogram bins
+
+
+def encode_int32(value):
+    """
+    Encodes a signed integer as the five 7-bit bytes used by AccelStepperFirmata (sign-magnitude, sign in bit 3 of the last byte)
+    """
+    magnitude = abs(int(value))
+    data = [(magnitude >> shift) & 0x7F for shift in (0, 7, 14, 21, 28)]
+    if value < 0:
+        data[4] = data[4] | 0x08
+    return data
+
+def decode_int32(data):
+    """
+    Decodes five 7-bit bytes from AccelStepperFirmata into a signed integer
+    """
+    magnitude = data[0] | data[1] << 7 | data[2] << 14 | data[3] << 21 | (data[4] & 0x07) << 28
+    return -magnitude if data[4] & 0x08 else magnitude
+
+def encode_float(value):
+    """
+    Encodes a float as the four 7-bit byte custom float used by AccelStepperFirmata
+    (23 bit significand, 4 bit base 10 exponent with a bias of 11, 1 sign bit)
+    """
+    sign = 1 if value < 0 else 0
+    value = abs(value)
+
+    # Use the smallest exponent that still fits the significand in 23 bits to keep the most precision
+    exponent = -11
+    while exponent < 4 and round(value / 10**exponent) >= 1 << 23:
+        exponent = exponent + 1
+    significand = min(round(value / 10**exponent), (1 << 23) - 1)
+
+    return [significand & 0x7F,
+            (significand >> 7) & 0x7F,
+            (significand >> 14) & 0x7F,
+            ((significand >> 21) & 0x03) | ((exponent + 11) & 0x0F) << 2 | sign << 6]
+
+def decode_float(data):
+    """
+    Decodes the four 7-bit byte custom float used by AccelStepperFirmata
+    """
+    significand = data[0] | data[1] << 7 | data[2] << 14 | (data[3] & 0x03) << 21
+    exponent = ((data[3] >> 2) & 0x0F) - 11
+    value = significand * 10.0**exponent
+    return -value if (data[3] >> 6) & 0x01 else value
+
+
+class StepTimingStats:
+    """
+    Step interval statistics for one move, measured between the rising edges of consecutive step pulses.
+    Attributes:
+        steps: Number of step intervals measured
+        meanInterval: Mean measured interval (us)
+        meanNominal: Mean planned interval (us)
+        p99Jitter: 99th percentile of the absolute difference between measured and planned intervals (us)
+        maxJitter: Largest absolute difference between measured and planned intervals (us)
+        histogram (dict): Number of intervals in each jitter bin, keyed by the bin start (us, bins of HISTOGRAMBIN)
+    """
+    def __init__(self, intervals, nominals):
+        self.steps = len(intervals)
+        jitters = sorted(abs(interval - nominal)/1000 for interval, nominal in zip(intervals, nominals))
+        self.meanInterval = sum(intervals)/1000/len(intervals) if intervals else 0
+        self.meanNominal = sum(nominals)/1000/len(nominals) if nominals else 0
+        self.p99Jitter = jitters[min(int(0.99*len(jitters)), len(jitters) - 1)] if jitters else 0
+        self.maxJitter = jitters[-1] if jitters else 0
+        self.histogram = {}
+        for jitter in jitters:
+            binStart = int(jitter // HISTOGRAMBIN * HISTOGRAMBIN)
+            self.histogram[binStart] = self.histogram.get(binStart, 0) + 1
+
+    def to_dict(self):
+        """Returns the statistics as a dictionary that can be sent as JSON"""
+        return {"steps": self.steps,
+                "mean_interval_us": round(self.meanInterval, 1),
+                "mean_nominal_us": round(self.meanNominal, 1),
+                "p99_jitter_us": round(self.p99Jitter, 1),
+                "max_jitter_us": round(self.maxJitter, 1),
+                "histogram_us": {str(binStart): count for binStart, count in sorted(self.histogram.items())}}
+
+
+class StepScheduler:
+    """
+    Times step pulses against absolute deadlines from time.perf_counter_ns instead of sleeping a fixed time after each step,
+    so oversleeping on one step does not delay every step after it. Waits sleep until SPINTIME before the deadline and then
+    spin on the clock, because time.sleep on a loaded Raspberry Pi can oversleep by hundreds of microseconds.
+    Attributes:
+        clock: Provides sleep() and perf_counter_ns() (the time module, or simulation.SimulatedClock)
+        spinTime: Time (ns) before a deadline at which the scheduler stops sleeping and spins
+    """
+    def __init__(self, clock=time, spinTime=None):
+        self.clock = clock
+        self.spinTime = SPINTIME if spinTime is None else spinTime
+        self._start = 0
+        self._edges = []
+        self._nominals = []
+
+    def start(self):
+        """Starts timing a new move from now"""
+        self._start = self.clock.perf_counter_ns()
+        self._edges = []
+        self._nominals = []
+
+    def wait_until(self, deadline):
+        """
+        Waits until a deadline (ns from the start of the move).
+        Returns:
+            How late (ns) the wait finished after the deadline
+        """
+        target = self._start + deadline
+        while True:
+            now = self.clock.perf_counter_ns()
+            remaining = target - now
+            if remaining <= 0:
+                return -remaining
+            if remaining > self.spinTime:
+                self.clock.sleep((remaining - self.spinTime)/1e9)
+
+    def slip(self, lateness):
+        """
+        Moves every later deadline back by lateness (ns). Used when a step is so late that catching up would
+        send the following steps faster than planned.
+        """
+        self._start = self._start + lateness
+
+    def mark_step(self, nominal):
+        """Records the rising edge of a step pulse. nominal is the planned time (ns) since the previous step"""
+        self._edges.append(self.clock.perf_counter_ns())
+        self._nominals.append(nominal)
+
+    def stats(self):
+        """
+        Returns:
+            StepTimingStats for the steps marked since start()
+        """
+        intervals = [self._edges[i] - self._edges[i-1] for i in range(1, len(self._edges))]
+        return StepTimingStats(intervals, self._nominals[1:])
+
+
+class PinStepBackend:
+    """
+    Generates step pulses by writing the motor step pins over pyfirmata (four serial writes per step).
+    This is the original step generation method and is used as a fallback when the Arduino firmware does not support AccelStepperFirmata.
+    Each step is timed against a deadline by a StepScheduler and the measured step intervals of the last move are kept for the status publisher.
+    Attributes:
+        pulseWidth: Time (s) the step pin is held high
+        btwnSteps: Time (s) between the end of one step pulse and the start of the next at the default step rate
+        clock: Provides sleep() and perf_counter_ns() for step timing (the time module, or simulation.SimulatedClock to run without waiting)
+        scheduler (StepScheduler): Deadline based step timer
+        lastTiming (StepTimingStats): Measured step timing of the most recent move (None before the first move)
+        lastCheckInterval (int): Steps between checks of isTriggered in the most recent move_until (always 1)
+    """
+    def __init__(self, pulseWidth, btwnSteps, clock=time):
+        self.pulseWidth = pulseWidth
+        self.btwnSteps = btwnSteps
+        self.clock = clock
+        self.scheduler = StepScheduler(clock)
+        self.lastTiming = None
+        self.lastCheckInterval = 1
+
+    def _pulse(self, motors, deadline, nominal):
+        """
+        Internal method for sending one step pulse to several motors at a deadline (ns from the start of the move).
+        If the step is more than one interval late the later deadlines are moved back instead of rushing to catch up.
+        """
+        lateness = self.scheduler.wait_until(deadline)
+        if lateness > nominal:
+            self.scheduler.slip(lateness)
+        self.scheduler.mark_step(nominal)
+        for motor in motors:
+            motor.step_pin.write(1)
+        self.scheduler.wait_until(deadline + int(self.pulseWidth*1e9))
+        for motor in motors:
+            motor.step_pin.write(0)
+
+    def move(self, motors, deltas, rate=None, stopEvent=None, profile=None, softStopEvent=None, onStep=None):
+        """
+        Moves several motors at the same time. Motors with fewer steps are interpolated so that every motor finishes together.
+        Parameters:
+            motors: List of StepperMotor objects
+            deltas: How far and which direction to move each motor (in steps)
+            rate: Step rate in steps per second (default rate is used if None)
+            stopEvent: threading.Event which ends the move immediately when set
+            profile: MotionProfile giving the time between each step of the motor with the most steps (overrides rate)
+            softStopEvent: threading.Event which ends the move early when set, slowing down first so no steps are lost
+            onStep: Function called after every step with the list of signed steps executed so far by each motor
+        Returns:
+            List of signed steps actually executed by each motor
+        """
+        # Time (ns) from each step pulse to the next for the requested rate or profile
+        period = self.pulseWidth + self.btwnSteps if rate is None else max(1/rate, self.pulseWidth)
+        longest = max([abs(delta) for delta in deltas], default=0)
+        if profile is not None:
+            intervals = [int(max(delay, self.pulseWidth)*1e9) for delay in profile.delays]
+        else:
+            intervals = [int(period*1e9)]*longest
+
+        # Set the direction of each motor
+        for motor, delta in zip(motors, deltas):
+            motor.dir_pin.write(1 if delta >= 0 else 0)
+
+        # Interleave the steps of motors moving different distances so they all start and finish together
+        executed = [0]*len(motors)
+        self.scheduler.start()
+        deadline = 0
+        stopAt = longest
+        for i, flags in enumerate(interpolate_steps(deltas)):
+            if i >= stopAt or (stopEvent is not None and stopEvent.is_set()):
+                break
+            # On a soft stop replace the rest of the profile with a deceleration ramp
+            if stopAt == longest and softStopEvent is not None and softStopEvent.is_set():
+                decelDelays = plan_deceleration(profile, i) if profile is not None else []
+                intervals[i:i + len(decelDelays)] = [int(max(delay, self.pulseWidth)*1e9) for delay in decelDelays]
+                stopAt = i + len(decelDelays)
+                if i >= stopAt:
+                    break
+            self._pulse([motor for motor, flag in zip(motors, flags) if flag], deadline, intervals[i-1] if i > 0 else intervals[0])
+            deadline = deadline + intervals[i]
+            for j, flag in enumerate(flags):
+                if flag:
+                    executed[j] = executed[j] + (1 if deltas[j] >= 0 else -1)
+            if onStep is not None:
+                onStep(executed)
+
+        # Wait for the last step to complete
+        if longest > 0 and not (stopEvent is not None and stopEvent.is_set()):
+            self.scheduler.wait_until(deadline)
+        self.lastTiming = self.scheduler.stats()
+        return executed
+
+    def move_until(self, motors, directions, isTriggered, stopEvent=None, rate=None, profile=None, chunk=None):
+        """
+        Steps motors in the given directions until isTriggered returns True (used for homing).
+        Parameters:
+            motors: List of StepperMotor objects
+            directions: Direction pin value (1 or 0) for each motor
+            isTriggered: Function returning True when motion should end (eg. LimitSwitch.is_pressed)
+            stopEvent: threading.Event which ends the move early when set
+            rate: Step rate in steps per second (default rate is used if None)
+            profile: MotionProfile to accelerate with (overrides rate). Once the profile runs out the last step rate is held
+            chunk: Not used, isTriggered is checked before every step (kept so both backends can be called the same way)
+        Returns:
+            Number of steps made before isTriggered ended the move, or None if it was stopped
+        """
+        for motor, direction in zip(motors, directions):
+            motor.dir_pin.write(direction)
+
+        if profile is not None and profile.steps > 0:
+            intervals = [int(max(delay, self.pulseWidth)*1e9) for delay in profile.delays]
+        else:
+            intervals = [int((self.pulseWidth + self.btwnSteps if rate is None else max(1/rate, self.pulseWidth))*1e9)]
+        self.lastCheckInterval = 1
+        self.scheduler.start()
+        deadline = 0
+        steps = 0
+        while not isTriggered():
+            if stopEvent is not None and stopEvent.is_set():
+                self.lastTiming = self.scheduler.stats()
+                return None
+            interval = intervals[min(steps, len(intervals) - 1)]
+            self._pulse(motors, deadline, interval)
+            deadline = deadline + interval
+            steps = steps + 1
+        self.lastTiming = self.scheduler.stats()
+        return steps
+
+
+class FirmataStepperBackend:
+    """
+    Offloads step pulse generation to the Arduino. Each move is sent as a single AccelStepperFirmata sysex command
+    and the backend waits for the move complete report, so the step rate no longer depends on USB serial latency or
+    Python sleep granularity. Requires ConfigurableFirmata with AccelStepperFirmata on the Arduino.
+    Attributes:
+        board: pyfirmata board (or any object with send_sysex and add_cmd_handler)
+        devices (dict): Maps each StepperMotor to its firmware device number
+        positions (dict): Last position (in steps) reported by the firmware for each device
+        rate: Default step rate in steps per second
+        timeout: Extra time (s) allowed beyond the expected move duration before a move is considered failed
+        commandLock (threading.Lock): Thread lock for sending commands and reading reported positions
+        lastTiming: Always None as the step pulses are timed by the Arduino (kept so both backends can be read the same way)
+        clock: Provides perf_counter_ns() for timing homing (the time module)
+        lastCheckInterval (int): Steps moved between checks of isTriggered in the most recent move_until
+    """
+    def __init__(self, board, motors, rate, timeout=2.0):
+        self.board = board
+        self.lastTiming = None
+        self.lastCheckInterval = HOMINGCHUNK
+        self.clock = time
+        self.rate = rate
+        self.timeout = timeout
+        self.devices = {}
+        self.positions = {}
+        self.commandLock = threading.Lock()
+        self._complete = {}
+        self._reported = {}
+        self._groups = {}
+        self._groupComplete = {}
+
+        # Replies from the firmware are handled on the pyfirmata iterator thread
+        self.board.add_cmd_handler(ACCELSTEPPER_DATA, self._handle_reply)
+
+        # Configure one firmware stepper device per motor
+        for deviceNum, motor in enumerate(motors):
+            self.devices[motor] = deviceNum
+            self.positions[deviceNum] = 0
+            self._complete[deviceNum] = threading.Event()
+            self._reported[deviceNum] = threading.Event()
+            self._send(ACCELSTEPPER_CONFIG, deviceNum, DRIVER_INTERFACE, motor.stepPinNum, motor.dirPinNum)
+            self._send(ACCELSTEPPER_ZERO, deviceNum)
+            self._send(ACCELSTEPPER_SET_SPEED, deviceNum, *encode_float(rate))
+
+    @classmethod
+    def connect(cls, board, motors, rate, timeout=2.0):
+        """
+        Creates the backend if the Arduino firmware answers an AccelStepperFirmata position request.
+        Parameters:
+            board: pyfirmata board
+            motors: List of StepperMotor objects to drive from the firmware
+            rate: Default step rate in steps per second
+            timeout: Time (s) to wait for the firmware to answer
+        Returns:
+            FirmataStepperBackend or None if the firmware does not support AccelStepperFirmata
+        """
+        backend = cls(board, motors, rate)
+        if not backend.report_position(0, timeout):
+            return None
+        backend.timeout = timeout
+        return backend
+
+    def _send(self, *data):
+        """Sends one AccelStepperFirmata sysex message"""
+        self.board.send_sysex(ACCELSTEPPER_DATA, list(data))
+
+    def _handle_reply(self, *data):
+        """
+        Handles sysex replies from the firmware (called with the 7-bit data bytes following ACCELSTEPPER_DATA)
+        """
+        if data[0] == MULTISTEPPER_MOVE_COMPLETE and data[1] in self._groupComplete:
+            self._groupComplete[data[1]].set()
+        elif len(data) < 7 or data[1] not in self.positions:
+            return
+        elif data[0] == ACCELSTEPPER_MOVE_COMPLETE:
+            self.positions[data[1]] = decode_int32(data[2:7])
+            self._complete[data[1]].set()
+        elif data[0] == ACCELSTEPPER_REPORT_POSITION:
+            self.positions[data[1]] = decode_int32(data[2:7])
+            self._reported[data[1]].set()
+
+    def report_position(self, deviceNum, timeout=None):
+        """
+        Requests the current position of a device from the firmware.
+        Returns:
+            True if the firmware answered within the timeout
+        """
+        self._reported[deviceNum].clear()
+        self._send(ACCELSTEPPER_REPORT_POSITION, deviceNum)
+        return self._reported[deviceNum].wait(self.timeout if timeout is None else timeout)
+
+    def _get_group(self, deviceNums):
+        """Returns the firmware multistepper group for a set of devices, configuring a new group if required"""
+        if deviceNums not in self._groups:
+            groupNum = len(self._groups)
+            self._groups[deviceNums] = groupNum
+            self._groupComplete[groupNum] = threading.Event()
+            self._send(MULTISTEPPER_CONFIG, groupNum, *deviceNums)
+        return self._groups[deviceNums]
+
+    def move(self, motors, deltas, rate=None, stopEvent=None, profile=None, softStopEvent=None, onStep=None):
+        """
+        Moves several motors at the same time and waits for the firmware to report the move complete.
+        Without a profile a single motor is moved with a step command and several motors are moved together as a multistepper group
+        so that they all finish at the same time. With a profile every motor gets its own step command with the firmware acceleration
+        and maximum speed scaled to its share of the steps, so the motors still start and finish together.
+        Parameters:
+            motors: List of StepperMotor objects
+            deltas: How far and which direction to move each motor (in steps)
+            rate: Step rate in steps per second of the motor with the most steps (default rate is used if None)
+            stopEvent: threading.Event which stops the firmware move early when set
+            profile: MotionProfile for the motor with the most steps. The firmware generates a trapezoidal ramp using its
+                cruise rate and acceleration (AccelStepper does not limit jerk)
+            softStopEvent: threading.Event which stops the firmware move early when set. The firmware stop command already
+                slows down with the acceleration of the move, so this is handled the same as stopEvent
+            onStep: Function called with the list of signed steps executed by each motor once the firmware reports the move complete
+        Returns:
+            List of signed steps actually executed by each motor (taken from the positions reported by the firmware)
+        """
+        rate = self.rate if rate is None else rate
+        moving = [(self.devices[motor], delta) for motor, delta in zip(motors, deltas) if delta != 0]
+        if not moving:
+            return [0]*len(motors)
+        startPositions = [self.positions[self.devices[motor]] for motor in motors]
+        longest = max([abs(delta) for delta in deltas])
+
+        with self.commandLock:
+            if profile is not None:
+                # Accelerated moves: one step command per motor with rates scaled to the motor's share of the steps
+                for deviceNum, delta in moving:
+                    speed, acceleration = profile.scaled(abs(delta)/longest)
+                    self._complete[deviceNum].clear()
+                    self._send(ACCELSTEPPER_SET_ACCELERATION, deviceNum, *encode_float(acceleration))
+                    self._send(ACCELSTEPPER_SET_SPEED, deviceNum, *encode_float(speed))
+                    self._send(ACCELSTEPPER_STEP, deviceNum, *encode_int32(delta))
+                complete = _AllSet([self._complete[deviceNum] for deviceNum, delta in moving])
+            else:
+                if rate != self.rate:
+                    for deviceNum, delta in moving:
+                        self._send(ACCELSTEPPER_SET_SPEED, deviceNum, *encode_float(rate))
+                if len(moving) == 1:
+                    deviceNum, delta = moving[0]
+                    complete = self._complete[deviceNum]
+                    complete.clear()
+                    self._send(ACCELSTEPPER_STEP, deviceNum, *encode_int32(delta))
+                else:
+                    groupNum = self._get_group(tuple(deviceNum for deviceNum, delta in moving))
+                    complete = self._groupComplete[groupNum]
+                    complete.clear()
+                    targets = []
+                    for deviceNum, delta in moving:
+                        targets = targets + encode_int32(self.positions[deviceNum] + delta)
+                    self._send(MULTISTEPPER_TO, groupNum, *targets)
+
+        # Wait for the firmware to report the move complete, stopping the motors if requested
+        # (the firmware ramps up from standstill so accelerated moves are allowed an extra ramp time)
+        duration = longest/rate if profile is None else profile.moveTime + profile.cruiseRate/profile.acceleration
+        deadline = time.monotonic() + duration + self.timeout
+        stopped = False
+        while not complete.wait(0.01):
+            if not stopped and any(event is not None and event.is_set() for event in (stopEvent, softStopEvent)):
+                with self.commandLock:
+                    if len(moving) == 1 or profile is not None:
+                        for deviceNum, delta in moving:
+                            self._send(ACCELSTEPPER_STOP, deviceNum)
+                    else:
+                        self._send(MULTISTEPPER_STOP, groupNum)
+                stopped = True
+                deadline = time.monotonic() + self.timeout
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Stepper firmware did not report move complete for devices {[d for d, _ in moving]}")
+
+        # Multistepper moves only report completion so read back where each motor ended up
+        if len(moving) > 1 and profile is None:
+            for deviceNum, delta in moving:
+                if not stopped:
+                    self.positions[deviceNum] = self.positions[deviceNum] + delta
+                elif not self.report_position(deviceNum):
+                    raise TimeoutError(f"Stepper firmware did not report the position of device {deviceNum}")
+
+        # Restore the default speed (and constant speed stepping) for later moves
+        if rate != self.rate or profile is not None:
+            with self.commandLock:
+                for deviceNum, delta in moving:
+                    if profile is not None:
+                        self._send(ACCELSTEPPER_SET_ACCELERATION, deviceNum, *encode_float(0))
+                    self._send(ACCELSTEPPER_SET_SPEED, deviceNum, *encode_float(self.rate))
+
+        executed = [self.positions[self.devices[motor]] - start for motor, start in zip(motors, startPositions)]
+        if onStep is not None:
+            onStep(executed)
+        return executed
+
+    def move_until(self, motors, directions, isTriggered, stopEvent=None, rate=None, profile=None, chunk=HOMINGCHUNK):
+        """
+        Moves motors in the given directions in short firmware moves until isTriggered returns True (used for homing).
+        isTriggered is only checked between moves, so the move ends up to chunk - 1 steps after the switch trips.
+        Parameters:
+            motors: List of StepperMotor objects
+            directions: Direction pin value (1 or 0) for each motor
+            isTriggered: Function returning True when motion should end (eg. LimitSwitch.is_pressed)
+            stopEvent: threading.Event which ends the move early when set
+            rate: Step rate in steps per second (default rate is used if None)
+            profile: Accelerated moves are not possible in short moves, so the profile's start rate is used as the step rate
+            chunk: Steps per firmware move (1 to stop on the step the switch trips, at the cost of one command per step)
+        Returns:
+            Number of steps made before isTriggered ended the move, or None if it was stopped
+        """
+        if profile is not None:
+            rate = profile.startRate
+        self.lastCheckInterval = chunk
+        deltas = [chunk if direction else -chunk for direction in directions]
+        steps = 0
+        while not isTriggered():
+            if stopEvent is not None and stopEvent.is_set():
+                return None
+            executed = self.move(motors, deltas, rate=rate, stopEvent=stopEvent)
+            steps = steps + max([abs(step) for step in executed], default=0)
+        return steps
+
+
+class _AllSet:
+    """Waits on several threading events as if they were one (used to wait for every motor in a move)"""
+    def __init__(self, events):
+        self.events = events
+
+    def wait(self, timeout):
+        for event in self.events:
+            if not event.wait(timeout):
+                return False
+        return True
+
+
+class HomingResult:
+    """
+    Result of homing one axis with home_axis.
+    Attributes:
+        homingTime: Time (s) taken to home the axis
+        fastSteps: Steps made in the fast approach
+        slowSteps: Steps made in the slow re-approach after backing off. Its spread over several homings is the repeatability
+        resolution (int): Steps moved between checks of the switch in the slow re-approach (the smallest change slowSteps can show)
+    """
+    def __init__(self, homingTime, fastSteps, slowSteps, resolution=1):
+        self.homingTime = homingTime
+        self.fastSteps = fastSteps
+        self.slowSteps = slowSteps
+        self.resolution = resolution
+
+    def to_dict(self):
+        """Returns the result as a dictionary that can be sent as JSON"""
+        return {"homing_time": round(self.homingTime, 3), "fast_steps": self.fastSteps, "slow_steps": self.slowSteps,
+                "resolution_steps": self.resolution}
+
+
+def home_axis(backend, motors, directions, isTriggered, fastProfile, slowRate, backoffSteps, stopEvent=None):
+    """
+    Homes one axis in two phases: a fast accelerated approach to the limit switch, a fixed back-off, then a slow re-approach
+    which sets the precise home position. The fast approach can overshoot the switch, which the back-off and slow re-approach remove.
+    The fast approach checks the switch every HOMINGCHUNK steps on the firmware backend, the slow re-approach after every step.
+    Parameters:
+        backend: PinStepBackend or FirmataStepperBackend
+        motors: List of StepperMotor objects moving the axis
+        directions: Direction pin value (1 or 0) of each motor towards the switch
+        isTriggered: Function returning True when the limit switch is pressed
+        fastProfile: MotionProfile for the fast approach (long enough to cross the whole axis)
+        slowRate: Step rate (steps/s) for the slow re-approach
+        backoffSteps: Steps moved away from the switch before the slow re-approach
+        stopEvent: threading.Event which ends homing early when set
+    Returns:
+        HomingResult, or None if homing was stopped or the switch did not release after backing off
+    """
+    start = backend.clock.perf_counter_ns()
+
+    # Fast approach
+    fastSteps = backend.move_until(motors, directions, isTriggered, stopEvent, profile=fastProfile)
+    if fastSteps is None:
+        return None
+
+    # Back off so the switch releases
+    backend.move(motors, [-backoffSteps if direction else backoffSteps for direction in directions], rate=slowRate, stopEvent=stopEvent)
+    if isTriggered() or (stopEvent is not None and stopEvent.is_set()):
+        return None
+
+    # Slow re-approach
+    slowSteps = backend.move_until(motors, directions, isTriggered, stopEvent, rate=slowRate, chunk=SLOWHOMINGCHUNK)
+    if slowSteps is None:
+        return None
+    return HomingResult((backend.clock.perf_counter_ns() - start)/1e9, fastSteps, slowSteps, backend.lastCheckInterval)
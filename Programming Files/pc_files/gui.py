@@ -74,13 +74,16 @@ class MainApp(ctk.CTk):
             "mode" : "Unknown",
             "module_status" : "Unknown",
             "step_x" : 0,
-            "step_y" :0
+            "step_y" :0,
+            "adaptive" : False
         }
 
         #-------------- Flags/States -----------------#
         self.sample_loaded = False
         self.sampling_state = 0
         self.scanning_state = 0 
+        self.scan_plan = {}
+        self.skipped_tiles = set()
 
         #--------------- Threading -------------------#
         self.transfer_rpi_thread = Thread()
@@ -418,10 +421,14 @@ class MainApp(ctk.CTk):
         step_y = ctk.CTkEntry(image_scanning_window, placeholder_text="4")
         step_y.grid(row=3, column=1, padx=5, pady=5, sticky="ew")
 
+        # Adaptive scan checkbox (overview pass first, tiles without sample are skipped)
+        adaptive = ctk.CTkCheckBox(image_scanning_window, text="Skip empty")
+        adaptive.grid(row=2, column=2, columnspan=2, padx=5, pady=5, sticky="w")
+
         # OK button (closes the window, changes frame, empties rpi image buffer, sends scanning_data to rpi)
         ok_button = ctk.CTkButton(image_scanning_window, text="OK", 
                                 command=lambda: [
-                                    self.send_scanning_data(int(step_x.get()), int(step_y.get())),
+                                    self.send_scanning_data(float(step_x.get()), float(step_y.get()), bool(adaptive.get())),
                                     self.display_loading_frame(frame),
                                     image_scanning_window.destroy()], 
                                 width=80, state="disabled")  # Initially disabled
@@ -1120,6 +1127,7 @@ class MainApp(ctk.CTk):
         self.clear_frame(frame)
 
         self.expected_image_count = images_x * images_y
+        self.skipped_tiles = set(self.scan_plan.get("skipped") or [])
         self.current_image_index = 0
         self.image_folder_path = self.buffer_stitching_folder  # Save path for reuse
 
@@ -1140,10 +1148,10 @@ class MainApp(ctk.CTk):
                                       command=lambda:[self.display_main_tab(), self.create_transfer_folder_pc(self.buffer_stitching_folder,new_folder_path)])
         finish_button.pack(side=ctk.RIGHT, expand=True, padx=1, pady=1)
 
-        #Stop button
+        #Stop button (soft stop keeps the module homed so the next scan can start without homing)
         stop_button = ctk.CTkButton(button_frame, text="STOP", fg_color="red", 
                                     command=lambda:[self.display_main_tab(), 
-                                                    self.send_simple_command("exe_stop",False)])
+                                                    self.send_simple_command("exe_soft_stop",False)])
         stop_button.pack(side=ctk.RIGHT, expand=True, padx=5, pady=1)
 
         #Layout
@@ -1171,7 +1179,7 @@ class MainApp(ctk.CTk):
             col = i // images_y
             row = (images_y - 1) - (i % images_y)
 
-            placeholder_label = ctk.CTkLabel(grid_container, text="")
+            placeholder_label = ctk.CTkLabel(grid_container, text="Skipped" if i in self.skipped_tiles else "")
             placeholder_label.grid(row=row, column=col, padx=0, pady=0, sticky='nsew')
             self.image_labels.append(placeholder_label)
 
@@ -1241,10 +1249,10 @@ class MainApp(ctk.CTk):
         button_frame = ctk.CTkFrame(self.random_sampling_frame)
         button_frame.grid(row = 2, column = 0, columnspan = self.total_columns, pady=5, padx=10)
  
-        # STOP button 
+        # STOP button (soft stop keeps the module homed so the next operation can start without homing)
         stop_button = ctk.CTkButton(button_frame, text="STOP", fg_color="red", 
                                     command=lambda: [self.display_main_tab(), 
-                                                     self.send_simple_command("exe_stop", False),
+                                                     self.send_simple_command("exe_soft_stop", False),
                                                      self.empty_folder_rpi()])
         stop_button.pack(side='left', padx=5, fill = 'x', pady=5)
  
@@ -1364,11 +1372,12 @@ class MainApp(ctk.CTk):
             match = re.match(r'^(\d+)', os.path.basename(filename))
             return int(match.group(1)) if match else float('inf')  # Put invalid files at the end
 
-        # Sort based on extracted numeric index
-        images = sorted(images, key=extract_index)
+        # Sort based on extracted numeric index, only keeping images that belong to the grid
+        images = [img_path for img_path in sorted(images, key=extract_index) if extract_index(img_path) < self.expected_image_count]
 
-        # Only process up to the expected number of images
-        for index, img_path in enumerate(images[:self.expected_image_count]):
+        # Place each image at its grid index (skipped tiles have no image)
+        for img_path in images:
+            index = extract_index(img_path)
             try:
                 img = Image.open(img_path)
                 img = img.resize((int(1.3342 * self.get_image_layout_parameters(1, 1)[0]),
@@ -1385,7 +1394,7 @@ class MainApp(ctk.CTk):
                 print(f"Failed to load image {img_path}: {e}")
 
         # Enable button if all images are filled
-        if len(images) >= self.expected_image_count:
+        if len(images) >= self.expected_image_count - len(self.skipped_tiles):
             self.complete_image_btn.configure(state="normal")
         else:
             self.after(1000, self.poll_for_new_images)
@@ -1778,6 +1787,9 @@ class MainApp(ctk.CTk):
             self.image_count = data.get("image_count", 0)
             self.curr_sample_id = data.get("curr_sample_id", "Unknown")
 
+            #Scan plan (grid size and tile overlap of the last scan)
+            self.scan_plan = data.get("scan_plan") or {}
+
         except Exception as e:
             print(f"Error unpacking JSON data: {e}")
     
@@ -1850,8 +1862,13 @@ class MainApp(ctk.CTk):
 
         #When folders transfered, calculate x and y grid, empty folder on rpi, and start image stitching thread
         if self.scanning_state == 2 and not self.transfer_rpi_thread.is_alive() :
-            self.scanning_grid_x , self.scanning_grid_y = self.extract_unique_positions(self.buffer_stitching_folder) 
-            self.start_stitching(self.scanning_grid_x, self.scanning_grid_y, self.buffer_stitching_folder, self.buffer_stitching_folder, self.curr_sample_id)
+            #Grid size from the scan plan, or counted from the image positions if the Raspberry Pi did not send one
+            if self.scan_plan.get("grid_x") and self.scan_plan.get("grid_y"):
+                self.scanning_grid_x, self.scanning_grid_y = self.scan_plan["grid_x"], self.scan_plan["grid_y"]
+            else:
+                self.scanning_grid_x , self.scanning_grid_y = self.extract_unique_positions(self.buffer_stitching_folder) 
+            tile_overlap = self.scan_plan.get("tile_overlap") or 20
+            self.start_stitching(self.scanning_grid_x, self.scanning_grid_y, self.buffer_stitching_folder, self.buffer_stitching_folder, self.curr_sample_id, tile_overlap)
             self.display_scanning_layout(self.scanning_grid_x, self.scanning_grid_y, self.main_right_frame)
             self.empty_folder_rpi()
 
@@ -1976,13 +1993,14 @@ class MainApp(ctk.CTk):
             messagebox.showerror("Status not in idle, wait to request scanning mode.")
     
 
-    def send_scanning_data(self, step_x, step_y):
+    def send_scanning_data(self, step_x, step_y, adaptive=False):
         """
         Store and send scanning data to Raspberry Pi.
 
         Args:
             step_x (float): The step size in the x direction.
             step_y (float): The step size in the y direction.
+            adaptive (bool): If True, only tiles with sample in them (found by an overview pass) are captured.
 
         Returns:
             None
@@ -2002,6 +2020,7 @@ class MainApp(ctk.CTk):
             self.scanning_data['module_status'] = self.module_status
             self.scanning_data['step_x'] = step_x
             self.scanning_data['step_y'] = step_y
+            self.scanning_data['adaptive'] = adaptive
 
             #Send scanning data
             success_message = "Scanning request sent."
@@ -2112,7 +2131,7 @@ class MainApp(ctk.CTk):
 
         self.stitcher = stitcher
 
-    def start_stitching(self, grid_x, grid_y, input_dir, output_dir, sample_id) :
+    def start_stitching(self, grid_x, grid_y, input_dir, output_dir, sample_id, tile_overlap=20) :
         """
         
         Starts thread for stitching. 
@@ -2124,13 +2143,14 @@ class MainApp(ctk.CTk):
             input_dir (str): The directory containing the images to stitch.
             output_dir (str): The directory to save the stitched image.
             sample_id (str): The ID of the current sample.
+            tile_overlap (int): Overlap of neighbouring images in percent (from the scan plan).
 
         Returns:
             None
         """
 
         # Using a lambda function to pass the arguments to run_stitching
-        self.stitching_thread = Thread(target=lambda: self.stitcher.run_stitching(grid_x, grid_y, input_dir, output_dir, sample_id), daemon=True)
+        self.stitching_thread = Thread(target=lambda: self.stitcher.run_stitching(grid_x, grid_y, input_dir, output_dir, sample_id, tile_overlap), daemon=True)
         self.stitching_thread.start()
 
 
@@ -1,5 +1,6 @@
 import subprocess
 import os
+import json
 
 class ImageStitcher:
     """
@@ -22,7 +23,54 @@ class ImageStitcher:
         self.macro_path = macro_path or os.path.join(os.path.expanduser('~'), "Fiji", "macros", "StitchingMacro.ijm")
     
 
-    def run_stitching(self, grid_x, grid_y, input_dir, output_dir, sample_id):
+    def write_tile_configuration(self, input_dir, sample_id, manifest_name="tile_manifest.json", layout_name="TileConfiguration_planned.txt"):
+        """
+        Write a Fiji TileConfiguration file placing the captured tiles at their planned positions, 
+        using the tile manifest saved by the Raspberry Pi with the images.
+
+        A grid layout needs every tile of the grid, so the layout file is only written if the scan skipped tiles.
+
+        Args:
+            input_dir (str): Path to the folder containing the images and the tile manifest.
+            sample_id (str): Unique identifier for the current sample (used in the image names).
+            manifest_name (str, optional): File name of the tile manifest.
+            layout_name (str, optional): File name of the TileConfiguration file written.
+
+        Returns:
+            str: File name of the TileConfiguration file, or None if there is no manifest or no tiles were skipped.
+        """
+
+        try:
+            with open(os.path.join(input_dir, manifest_name), 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"No tile manifest: {e}")
+            return None
+
+        captured = [tile for tile in manifest.get("tiles", []) if tile.get("captured")]
+        if not manifest.get("skipped") or not captured or not manifest.get("pixel_size"):
+            return None
+
+        # Fiji positions are in pixels from the top left; the top of an image is towards +y on the stage
+        pixel_size = manifest["pixel_size"]
+        min_x = min(tile["x"] for tile in captured)
+        max_y = max(tile["y"] for tile in captured)
+
+        lines = ["# Define the number of dimensions we are working on", "dim = 2", "", "# Define the image coordinates"]
+        for tile in captured:
+            lines.append(f"{tile['index']}_{sample_id}.jpg; ; ({(tile['x'] - min_x)/pixel_size:.1f}, {(max_y - tile['y'])/pixel_size:.1f})")
+
+        try:
+            with open(os.path.join(input_dir, layout_name), 'w') as file:
+                file.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"Error writing tile configuration: {e}")
+            return None
+        print(f"{len(manifest['skipped'])} skipped tiles, stitching {len(captured)} tiles from {layout_name}")
+        return layout_name
+
+
+    def run_stitching(self, grid_x, grid_y, input_dir, output_dir, sample_id, tile_overlap=20):
         """
         Run the image stitching macro in Fiji/ImageJ in headless mode.
 
@@ -32,14 +80,19 @@ class ImageStitcher:
             input_dir (str): Path to the folder containing input images.
             output_dir (str): Path to the folder where stitched images will be saved.
             sample_id (str): Unique identifier for the current sample (used in naming outputs).
+            tile_overlap (int): Overlap of neighbouring images in percent (Fiji uses it as the starting guess for compute_overlap).
 
         Notes:
             - Uses Fiji in headless mode to avoid launching the GUI.
+            - If the tile manifest lists skipped tiles, the captured tiles are stitched from their planned positions instead of a grid.
             - Errors are caught and printed, but not re-raised.
         """
          
         try:
-            macro_args = f'{grid_x},{grid_y},{input_dir},{output_dir},{sample_id}'
+            macro_args = f'{grid_x},{grid_y},{input_dir},{output_dir},{sample_id},{tile_overlap}'
+            layout_file = self.write_tile_configuration(input_dir, sample_id)
+            if layout_file:
+                macro_args = f'{macro_args},{layout_file}'
 
             # Use --console to debug with console output. Disabled in final use.
             # Example with console output: